@@ -0,0 +1,77 @@
+import os
+import sys
+import json
+import time
+import argparse
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import invoice_process
+
+from models import engine
+from storage import LocalStorage, get_storage, use_storage
+
+
+INVOICE_EXTENSIONS = ('.xlsx', '.xlsm')
+BACKFILL_WORKERS = int(os.getenv('BACKFILL_WORKERS', os.cpu_count() or 1))
+
+
+def init_worker(local_dir):
+    # never share pooled connections with the parent process
+    engine.dispose()
+    if local_dir:
+        use_storage(LocalStorage(local_dir))
+
+
+def process(file_name, force):
+    started = time.monotonic()
+    try:
+        result, log_file, email_body = invoice_process.process_file(file_name, False, force)
+    except Exception as e:
+        result, log_file, email_body = False, None, traceback.format_exc().splitlines()[-1]
+
+    return {'file': file_name, 'result': result, 'status': email_body, 'log': log_file, 'seconds': round(time.monotonic() - started, 3)}
+
+
+def list_invoices(prefix):
+    return [key for key in get_storage().list(prefix) if key.lower().endswith(INVOICE_EXTENSIONS)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Reprocess every invoice under a prefix, e.g. 2026/9/')
+    parser.add_argument('prefix', help='<year>/<month>/[<facility>/[<source>/]]')
+    parser.add_argument('--local-dir', help='read the invoices from this directory (laid out like the bucket) instead of S3')
+    parser.add_argument('--workers', type=int, default=BACKFILL_WORKERS)
+    parser.add_argument('--force', action='store_true', help='also reload files that are the last load of their month')
+    parser.add_argument('--results', help='write one JSON line per file to this file')
+    args = parser.parse_args()
+
+    if args.local_dir:
+        use_storage(LocalStorage(args.local_dir))
+    file_names = list_invoices(args.prefix)
+    print(f"{len(file_names)} invoices under {args.prefix}")
+
+    started = time.monotonic()
+    statuses = {}
+    results_file = open(args.results, 'w') if args.results else None
+    with ProcessPoolExecutor(max_workers=args.workers, initializer=init_worker, initargs=(args.local_dir,)) as pool:
+        futures = [pool.submit(process, file_name, args.force) for file_name in file_names]
+        for done, future in enumerate(as_completed(futures), 1):
+            result = future.result()
+            statuses[result['status']] = statuses.get(result['status'], 0) + 1
+            print(f"[{done}/{len(file_names)}] {result['file']}: {result['status']} ({result['seconds']:.1f}s)", flush=True)
+            if results_file:
+                print(json.dumps(result), file=results_file, flush=True)
+    if results_file:
+        results_file.close()
+
+    elapsed = time.monotonic() - started
+    print(f"{len(file_names)} files in {elapsed:.1f}s ({len(file_names) / elapsed if elapsed else 0:.2f} files/s, {args.workers} workers)")
+    for status, count in sorted(statuses.items()):
+        print(f"  {status}: {count}")
+
+    return 0 if all(status in ('Uploaded successfully', 'Already loaded, skipped') for status in statuses) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
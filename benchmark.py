@@ -0,0 +1,548 @@
+import io
+import os
+import re
+import sys
+import json
+import time
+import hashlib
+import random
+import argparse
+import datetime
+import tempfile
+import resource
+import statistics
+import subprocess
+
+# the stage benchmark runs against its own SQLite database, never the configured one
+os.environ['db_url'] = os.getenv('BENCHMARK_DB_URL', 'sqlite://')
+
+from openpyxl import Workbook
+from sqlalchemy import event
+from sqlalchemy.ext.compiler import compiles
+
+import models
+from models import *
+from loaders import LOAD_COLUMNS, STAGING_TABLE
+from row_mapping import LAYOUTS, map_invoice
+import legacy_row_mapping
+from utilities import ErrorCollector, RawInvoiceField, compile_validation_plan, get_payer_group_index, reset_validation_plan, validate_row
+from frame_validation import validate_frame
+from parallel_validation import VALIDATION_WORKERS, validate_parallel
+
+
+# cleaned values for the source fields the layouts read; anything else is text
+SAMPLE_VALUES = {
+    'patient': 'DOE,JOHN', 'resident': 'DOE,JOHN', 'patient_nm': 'DOE,JOHN', 'full_nm': 'DOE,JOHN',
+    'name': 'DOE,JOHN', 'resident_nm': 'DOE,JOHN',
+    'ssn_no': '123-45-6789', 'ssn': '123-45-6789', 'patient_ssn': '123-45-6789', 'res_ssn': '123-45-6789',
+    'b_or_g': 'B', 'b_g': 'G', 'sex': 'M',
+    'copay': 'COPAY', 'is_a_copay': 'Y', 'copay_amt': 2.5,
+    'rx_no': 1234567, 'rx_nbr': 1234567.0, 'rx': 1234567,
+    'qty': 30.0, 'quantity': 30.0, 'tot_qty_disp': 30.0, 'ds': 30.0, 'days_supply': 30.0,
+    'billamt': 12.5, 'bill': 12.5, 'amount': 12.5, 'amount_due': 12.5, 'trans_amount': 12.5, 'bill_amt': 12.5,
+    'dispdt': datetime.datetime(2020, 10, 2), 'dispensed': datetime.datetime(2020, 10, 2),
+    'disp_dt': datetime.datetime(2020, 10, 2), 'dispense_dt': datetime.datetime(2020, 10, 2),
+    'dispense_date': datetime.datetime(2020, 10, 2), 'transaction_dt': datetime.datetime(2020, 10, 2),
+    'service_dt': datetime.datetime(2020, 10, 2), 'birth_date': datetime.datetime(1940, 5, 17),
+}
+
+
+def sample_rows(layout_name, count):
+    layout = LAYOUTS[layout_name]
+    fields = re.findall(r"row\['(\w+)'\]", ' '.join(layout.columns.values()))
+    row = {name: SAMPLE_VALUES.get(name, 'TEXT') for name in fields}
+    row[layout.payer_group_field] = 'MEDICARE'
+
+    return [dict(row) for _ in range(count)]
+
+
+def bench_row_mapping(layout_name, count):
+    """(old function, compiled) rows/s of one layout.
+
+    The old function is the layout's _process_row_* from
+    legacy_row_mapping, with its PharmacyInvoice per row and its payer group
+    query per row; both have to give the same rows. Needs the reference data
+    of seed_benchmark_database().
+    """
+    rows = sample_rows(layout_name, count)
+    pharmacy_id = 1
+    args = (1, pharmacy_id, 1, BENCHMARK_INVOICE_DT, 1)
+
+    legacy = getattr(legacy_row_mapping, f'_process_row_{layout_name}')
+    started = time.perf_counter()
+    result, legacy_data = legacy(rows, *args, io.StringIO())
+    baseline = time.perf_counter() - started
+    assert result
+
+    started = time.perf_counter()
+    result, load_data = map_invoice(layout_name, rows, *args, get_payer_group_index(pharmacy_id), io.StringIO())
+    compiled = time.perf_counter() - started
+    assert result
+    assert load_data == [tuple(getattr(invoice, column) for column in LOAD_COLUMNS) for invoice in legacy_data]
+
+    return count / baseline, count / compiled
+
+
+VALIDATION_FIELDS = [
+    ('Patient', 'string', 'IsNotEmpty,Name'),
+    ('SSN', 'string', 'Ssn'),
+    ('B/G', 'char', 'BorG'),
+    ('Disp Dt', 'date', 'IsNotEmpty'),
+    ('Drug', 'string', 'IsNotEmpty,MaxLength150'),
+    ('Rx No', 'int', 'IsNotEmpty'),
+    ('Qty', 'decimal', ''),
+    ('Bill', 'decimal', 'IsNotEmpty'),
+    ('Note', 'string', 'MaxLength500'),
+    ('Physician', 'string', 'MaxLength50'),
+    ('Inv Grp', 'string', 'IsNotEmpty'),
+    ('Copay', 'char', ''),
+]
+
+
+def sample_sheet(count):
+    # repeats patients, drugs and dates the way real invoices do
+    rnd = random.Random(0)
+    patients = [(f'PATIENT{i},JOHN', f'{rnd.randint(100, 999)}-{rnd.randint(10, 99)}-{rnd.randint(1000, 9999)}', rnd.choice('BG')) for i in range(2000)]
+    rows = []
+    for i in range(count):
+        patient, ssn, b_g = rnd.choice(patients)
+        rows.append((i + 2, (
+            patient, ssn, b_g, f'10/{rnd.randint(1, 28):02d}/2020', f'DRUG {rnd.randint(1, 300)} 10MG TAB',
+            1000000 + i, float(rnd.choice([1, 14, 28, 30, 60, 90, 0.5])), f'${rnd.randint(1, 300)}.{rnd.randint(0, 99):02d}',
+            None if i % 7 else 'Billed', f'DR {rnd.randint(1, 40)}', rnd.choice(['MEDICARE', 'MEDICAID', 'PRIVATE']), rnd.choice('YN'))))
+    return rows
+
+
+def bench_validation(count):
+    fields = [RawInvoiceField(field_name=name.lower().replace(' ', '_'), sheet_column_name=name, field_type=field_type,
+                              field_validations=validations, is_optional=name == 'Note')
+              for name, field_type, validations in VALIDATION_FIELDS]
+    header = [name for name, field_type, validations in VALIDATION_FIELDS]
+    rows = sample_sheet(count)
+
+    plan = compile_validation_plan(fields, header)
+    reset_validation_plan(plan)
+    started = time.perf_counter()
+    row_data = []
+    for row_no, row in rows:
+        is_valid, data = validate_row(plan, row, row_no, ErrorCollector())
+        if is_valid:
+            row_data.append(data)
+    row_by_row = time.perf_counter() - started
+
+    plan = compile_validation_plan(fields, header)
+    reset_validation_plan(plan)
+    started = time.perf_counter()
+    result, frame_data = validate_frame(plan, iter(rows), ErrorCollector())
+    by_column = time.perf_counter() - started
+    assert result and frame_data == row_data
+
+    plan = compile_validation_plan(fields, header)
+    reset_validation_plan(plan)
+    started = time.perf_counter()
+    result, parallel_data = validate_parallel(plan, iter(rows), ErrorCollector(), min_rows=0)
+    in_parallel = time.perf_counter() - started
+    assert result and parallel_data == row_data
+
+    return count / row_by_row, count / by_column, count / in_parallel
+
+
+# SQL Server types and functions the models use, for SQLite
+@compiles(MONEY, 'sqlite')
+def _compile_money(type_, compiler, **kw):
+    return 'NUMERIC'
+
+
+@compiles(BIT, 'sqlite')
+@compiles(TINYINT, 'sqlite')
+def _compile_small_int(type_, compiler, **kw):
+    return 'INTEGER'
+
+
+if models.engine.dialect.name == 'sqlite':
+    @event.listens_for(models.engine, 'connect')
+    def _sqlite_functions(dbapi_connection, connection_record):
+        dbapi_connection.create_function('getdate', 0, lambda: datetime.datetime.now().isoformat(' '))
+        dbapi_connection.create_collation('SQL_Latin1_General_CP1_CI_AS', lambda a, b: (a.lower() > b.lower()) - (a.lower() < b.lower()))
+
+
+# Reader settings of the stage benchmark, one per layout: (pharmacy, source,
+# header row index, raw invoice fields). Fields are (field_name,
+# sheet_column_name, field_type, field_validations, is_optional). They are
+# loaded into the benchmark database, and the synthetic workbooks are
+# generated from the same fields.
+BENCHMARK_READER_SETTINGS = {
+    'specialty_rx_email': ('Specialty Rx', 'Email', 0, [
+        ('patient', 'Patient', 'string', 'IsNotEmpty,Name', False),
+        ('invgrp', 'InvoiceGrp', 'string', 'IsNotEmpty', False),
+        ('ssn_no', 'SSN', 'string', 'Ssn', True),
+        ('dispdt', 'DispenseDt', 'date', 'IsNotEmpty', False),
+        ('rx_otc', 'RxOtcInd', 'string', '', False),
+        ('drug', 'DrugLabelName', 'string', 'IsNotEmpty,MaxLength150', False),
+        ('rx_no', 'RxNo', 'int', 'IsNotEmpty', False),
+        ('ndc', 'NDC', 'string', 'MaxLength50', False),
+        ('qty', 'Qty', 'decimal', '', False),
+        ('ds', 'DaysSupply', 'decimal', '', False),
+        ('billamt', 'BillAmt', 'decimal', 'IsNotEmpty', False),
+        ('copay', 'CoPayInd', 'string', '', False),
+        ('comment', 'Comment', 'string', 'MaxLength500', True),
+    ]),
+    'specialty_rx_portal': ('Specialty Rx', 'Portal', 0, [
+        ('resident', 'Resident', 'string', 'IsNotEmpty,Name', False),
+        ('group', 'Group', 'string', 'IsNotEmpty', False),
+        ('dispensed', 'Dispensed', 'date', 'IsNotEmpty', False),
+        ('rx_type', 'Rx Type', 'string', '', False),
+        ('drug_nm', 'Drug Name', 'string', 'IsNotEmpty,MaxLength150', False),
+        ('rx_no', 'Rx #', 'int', 'IsNotEmpty', False),
+        ('quantity', 'Quantity', 'decimal', '', False),
+        ('days_supply', 'Days Supply', 'decimal', '', False),
+        ('amount', 'Amount', 'decimal', 'IsNotEmpty', False),
+        ('is_a_copay', 'Copay', 'string', '', True),
+        ('billing_comment', 'Billing Comment', 'string', 'MaxLength500', True),
+    ]),
+    'pharmscripts_portal': ('Pharmscripts', 'Portal', 1, [
+        ('patient_nm', 'P.Name', 'string', 'IsNotEmpty,Name', False),
+        ('inv_grp', 'InvGrp', 'string', 'IsNotEmpty', False),
+        ('ssn', 'SSN', 'string', 'Ssn', True),
+        ('b_or_g', 'B/G', 'char', 'BorG', False),
+        ('disp_dt', 'Disp.Dt', 'date', 'IsNotEmpty', False),
+        ('rx_type', 'RxType', 'string', '', False),
+        ('drug', 'Drug', 'string', 'IsNotEmpty,MaxLength150', False),
+        ('physician', 'Physician', 'string', 'MaxLength50', False),
+        ('rx_no', 'RxNo', 'int', 'IsNotEmpty', False),
+        ('ndc', 'NDC', 'string', 'MaxLength50', False),
+        ('qty', 'Qty', 'decimal', '', False),
+        ('ds', 'DS', 'decimal', '', False),
+        ('bill', 'Bill', 'decimal', 'IsNotEmpty', False),
+        ('copay', 'Copay', 'char', '', False),
+        ('billing_comment', 'BillingComment', 'string', 'MaxLength500', True),
+    ]),
+    'pharmscripts_email': ('Pharmscripts', 'Email', 0, [
+        ('patient', 'Patient', 'string', 'IsNotEmpty,Name', False),
+        ('invoice_grp', 'InvoiceGrp', 'string', 'IsNotEmpty', False),
+        ('ssn', 'SSN', 'string', 'Ssn', True),
+        ('b_g', 'B/G', 'char', 'BorG', False),
+        ('disp_dt', 'DispDt', 'date', 'IsNotEmpty', False),
+        ('otc_rx', 'OTC/Rx', 'string', '', False),
+        ('drug', 'Drug', 'string', 'IsNotEmpty,MaxLength150', False),
+        ('physician', 'Physician', 'string', 'MaxLength50', False),
+        ('rx_no', 'Rx#', 'int', 'IsNotEmpty', False),
+        ('ndc', 'NDC', 'string', 'MaxLength50', False),
+        ('tot_qty_disp', 'TotQtyDisp', 'decimal', '', False),
+        ('ds', 'DS', 'decimal', '', False),
+        ('tot_bill_amt', 'TotBillAmt', 'decimal', 'IsNotEmpty', False),
+        ('is_a_copay', 'IsACoPay', 'char', '', False),
+    ]),
+    'geriscript_general': ('Geriscript', None, 0, [
+        ('full_nm', 'Full Name', 'string', 'IsNotEmpty,Name', False),
+        ('invoice_grp', 'InvoiceGrp', 'string', 'IsNotEmpty', False),
+        ('ssn', 'SSN', 'string', 'Ssn', False),
+        ('birth_date', 'BirthDate', 'date', '', False),
+        ('sex', 'Sex', 'char', 'MorF', False),
+        ('dispense_dt', 'DispenseDt', 'date', 'IsNotEmpty', False),
+        ('rx_otc', 'RxOTC', 'string', '', False),
+        ('drug_label_nm', 'DrugLabelName', 'string', 'IsNotEmpty,MaxLength150', False),
+        ('doctor', 'Doctor', 'string', 'MaxLength50', False),
+        ('rx_no', 'RxNo', 'int', 'IsNotEmpty', False),
+        ('ndc', 'NDC', 'string', 'MaxLength50', False),
+        ('qty', 'Qty', 'decimal', '', False),
+        ('days_supply', 'DaysSupply', 'decimal', '', False),
+        ('bill_amt', 'BillAmt', 'decimal', 'IsNotEmpty', False),
+        ('copay_amt', 'CopayAmt', 'decimal', '', True),
+        ('billing_comment', 'BillingComment', 'string', 'MaxLength500', True),
+    ]),
+    'medwiz_general': ('Medwiz', None, 0, [
+        ('name', 'Name', 'string', 'IsNotEmpty,Name', False),
+        ('invoice_group', 'Invoice Group', 'string', 'IsNotEmpty', False),
+        ('dispense_date', 'Dispense Date', 'date', 'IsNotEmpty', False),
+        ('distribution_code', 'Distribution Code', 'string', '', False),
+        ('description', 'Description', 'string', 'IsNotEmpty,MaxLength150', False),
+        ('rx_no', 'Rx No', 'int', 'IsNotEmpty', False),
+        ('ndc', 'NDC', 'string', 'MaxLength50', False),
+        ('qty', 'Qty', 'decimal', '', False),
+        ('days_supply', 'Days Supply', 'decimal', '', False),
+        ('amount', 'Amount', 'decimal', 'IsNotEmpty', False),
+        ('copay', 'Copay', 'string', '', False),
+        ('billing_comment', 'Billing Comment', 'string', 'MaxLength500', True),
+    ]),
+    'omnicare_general': ('Omnicare', None, 0, [
+        ('patient_first_nm', 'Patient First Name', 'string', 'IsNotEmpty', False),
+        ('patient_last_nm', 'Patient Last Name', 'string', 'IsNotEmpty', False),
+        ('pay_type_description', 'Pay Type Description', 'string', 'IsNotEmpty', False),
+        ('patient_ssn', 'Patient SSN', 'string', 'Ssn', True),
+        ('transaction_dt', 'Transaction Date', 'date', 'IsNotEmpty', False),
+        ('inventory_category', 'Inventory Category', 'string', '', False),
+        ('description', 'Description', 'string', 'IsNotEmpty,MaxLength150', False),
+        ('physician', 'Physician', 'string', 'MaxLength50', False),
+        ('rx', 'Rx', 'int', 'IsNotEmpty', False),
+        ('ndc', 'NDC', 'string', 'MaxLength50', False),
+        ('reject_codes', 'Reject Codes', 'string', 'MaxLength150', True),
+        ('qty', 'Qty', 'decimal', '', False),
+        ('days_supply', 'Days Supply', 'decimal', '', False),
+        ('amount', 'Amount', 'decimal', 'IsNotEmpty', False),
+        ('copay', 'CoPay', 'string', '', True),
+        ('statement_note', 'Statement Note', 'string', 'MaxLength500', True),
+    ]),
+    'pharmerica_email': ('Pharmerica', 'Email', 0, [
+        ('resident_nm', 'Resident Name', 'string', 'IsNotEmpty,Name', False),
+        ('fin_plan', 'Fin Plan', 'string', 'IsNotEmpty', False),
+        ('res_ssn', 'Res SSN', 'string', 'Ssn', True),
+        ('service_dt', 'Date of Service', 'date', 'IsNotEmpty', False),
+        ('product_category', 'Product Category', 'string', '', False),
+        ('sales_type', 'Sales Type', 'string', '', False),
+        ('trans_desc', 'Trans Desc', 'string', 'IsNotEmpty,MaxLength150', False),
+        ('doctor_nm', 'Doctor Name', 'string', 'MaxLength50', False),
+        ('rx_nbr', 'RX NBR', 'int', 'IsNotEmpty', False),
+        ('ndc_nbr', 'NDC NBR', 'string', 'MaxLength50', False),
+        ('quantity', 'Quantity', 'decimal', '', False),
+        ('days_supply', 'Days Supply', 'decimal', '', False),
+        ('amount_due', 'Amount Due', 'decimal', 'IsNotEmpty', False),
+        ('task_manager_notes', 'Task Manager Notes', 'string', 'MaxLength500', True),
+    ]),
+    'pharmerica_portal': ('Pharmerica', 'Portal', 0, [
+        ('resident_nm', 'Resident Name', 'string', 'IsNotEmpty,Name', False),
+        ('fin_plan', 'Fin Plan', 'string', 'IsNotEmpty', False),
+        ('res_ssn', 'Res SSN', 'string', 'Ssn', True),
+        ('service_dt', 'Date of Service', 'date', 'IsNotEmpty', False),
+        ('product_category', 'Product Category', 'string', '', False),
+        ('trans_desc', 'Trans Desc', 'string', 'IsNotEmpty,MaxLength150', False),
+        ('doctor_nm', 'Doctor Name', 'string', 'MaxLength50', False),
+        ('rx_nbr', 'RX NBR', 'int', 'IsNotEmpty', False),
+        ('ndc_nbr', 'NDC NBR', 'string', 'MaxLength50', False),
+        ('quantity', 'Quantity', 'decimal', '', False),
+        ('days_supply', 'Days Supply', 'decimal', '', False),
+        ('trans_amount', 'Trans Amt', 'decimal', 'IsNotEmpty', False),
+        ('task_manager_notes', 'Task Manager Notes', 'string', 'MaxLength500', True),
+    ]),
+}
+
+BENCHMARK_PAYER_GROUPS = ('MEDICARE', 'MEDICAID', 'PRIVATE', 'HOSPICE', 'MANAGED CARE')
+BENCHMARK_INVOICE_DT = datetime.date(2020, 10, 1)
+BENCHMARK_SIZES = (1000, 10000, 100000)
+# the order stages are reported in
+BENCHMARK_STAGES = (
+    'reference lookup', 'stat', 'fingerprint check', 'sheet cache', 'download', 'workbook load',
+    'validation', 'payer lookup', 'delete', 'transformation', 'insert', 'commit',
+)
+
+
+def get_benchmark_fields(layout_name):
+    pharmacy, source, header_row_index, fields = BENCHMARK_READER_SETTINGS[layout_name]
+    return [RawInvoiceField(field_name=field_name, sheet_column_name=column_name, field_type=field_type,
+                            field_validations=validations, is_optional=is_optional)
+            for field_name, column_name, field_type, validations, is_optional in fields]
+
+
+def get_benchmark_path(layout_name, rows):
+    # the file name changes with the configuration, so a stale workbook is never reused
+    pharmacy, source, header_row_index, fields = BENCHMARK_READER_SETTINGS[layout_name]
+    config = hashlib.sha1(repr(BENCHMARK_READER_SETTINGS[layout_name]).encode()).hexdigest()[:8]
+    return f'{BENCHMARK_INVOICE_DT:%Y/%m}/{pharmacy} Facility/{source or "General"}/{layout_name} {rows} {config}.xlsx'
+
+
+def seed_benchmark_database():
+    # reference data for every benchmark layout, in a fresh schema
+    Base.metadata.drop_all(models.engine)
+    Base.metadata.create_all(models.engine)
+    # on SQL Server it comes from migrations/002_pharmacy_invoices_staging.sql
+    STAGING_TABLE.drop(models.engine, checkfirst=True)
+    STAGING_TABLE.create(models.engine)
+    db = Session()
+    sources = {}
+    pharmacies = {}
+    for layout_name, (pharmacy_nm, source_nm, header_row_index, fields) in BENCHMARK_READER_SETTINGS.items():
+        if source_nm and source_nm not in sources:
+            sources[source_nm] = InvoiceSource(source_nm=source_nm, create_by=0)
+            db.add(sources[source_nm])
+        if pharmacy_nm not in pharmacies:
+            pharmacy = pharmacies[pharmacy_nm] = Pharmacy(pharmacy_nm=pharmacy_nm, raw_invoice_table_nm='')
+            facility = Facility(facility_nm=f'{pharmacy_nm} Facility', create_by=0)
+            db.add_all([pharmacy, facility])
+            db.flush()
+            db.add(FacilityPharmacyMap(facility_id=facility.id, pharmacy_id=pharmacy.id, start_dt=datetime.datetime(2020, 1, 1), create_by=0))
+            for payer_group_id, name in enumerate(BENCHMARK_PAYER_GROUPS, 1):
+                db.add(PayerGroupPharmacyMap(payer_group_id=payer_group_id, pharmacy_id=pharmacy.id, name=name))
+        db.flush()
+
+        reader_setting = PharmacyInvoiceReaderSetting(
+            pharmacy_id=pharmacies[pharmacy_nm].id,
+            invoice_source_id=sources[source_nm].id if source_nm else 0,
+            invoice_reader_classname=layout_name,
+            header_row_index=header_row_index,
+            skip_rows_after_header=0,
+            skip_ending_rows=0)
+        reader_setting.raw_invoice_fields = get_benchmark_fields(layout_name)
+        db.add(reader_setting)
+    db.commit()
+    db.close()
+
+
+def sample_cell(field, rnd, payer_group_field):
+    # a cell the field accepts, drawn from a small set of values the way
+    # patients, drugs and dates repeat in real invoices
+    rules = (field.field_validations or '').split(',')
+    if field.is_optional and rnd.random() < 0.2:
+        return None
+    if field.field_name == payer_group_field:
+        return rnd.choice(BENCHMARK_PAYER_GROUPS)
+    if field.field_type == 'date':
+        return datetime.datetime.combine(BENCHMARK_INVOICE_DT, datetime.time()) + datetime.timedelta(days=rnd.randrange(28))
+    if field.field_type in ('int', 'long'):
+        return rnd.randint(1000000, 9999999)
+    if field.field_type == 'decimal':
+        return rnd.choice((1.0, 14.0, 28.0, 30.0, 60.0, 90.0, 0.5)) if 'IsNotEmpty' not in rules else round(rnd.uniform(1, 500), 2)
+    if 'BorG' in rules:
+        return rnd.choice('BG')
+    if 'MorF' in rules:
+        return rnd.choice('MF')
+    if 'Name' in rules:
+        return f'PATIENT{rnd.randrange(2000)},JOHN'
+    if 'Ssn' in rules:
+        return f'{rnd.randint(100, 999)}-{rnd.randint(10, 99)}-{rnd.randint(1000, 9999)}'
+    if field.field_type == 'char':
+        return rnd.choice('YN')
+    if 'copay' in field.field_name:
+        return rnd.choice(('COPAY', 'copay', 'Y', 'N'))
+    return f'{field.sheet_column_name.upper()} {rnd.randrange(300)}'
+
+
+def write_benchmark_workbook(layout_name, rows, file_path):
+    # the same file for the same layout and size on every run
+    pharmacy, source, header_row_index, fields = BENCHMARK_READER_SETTINGS[layout_name]
+    fields = get_benchmark_fields(layout_name)
+    payer_group_field = LAYOUTS[layout_name].payer_group_field
+    rnd = random.Random(f'{layout_name} {rows}')
+
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet('Invoice')
+    for row_no in range(header_row_index):
+        ws.append([f'{pharmacy} invoice'])
+    ws.append([field.sheet_column_name for field in fields])
+    for row_no in range(rows):
+        ws.append([sample_cell(field, rnd, payer_group_field) for field in fields])
+    wb.save(file_path)
+
+
+def run_stage_case(layout_name, rows):
+    # runs in a process of its own (see bench_stages); prints one JSON line
+    import invoice_process
+
+    seed_benchmark_database()
+    baseline_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    started = time.perf_counter()
+    result, log_path, invoice_info = invoice_process.validate_file(get_benchmark_path(layout_name, rows), test_mode=True, force=True)
+    if not result:
+        raise Exception(f"{layout_name}: validation failed, see {log_path}")
+    if not invoice_process.process_invoice(invoice_info, log_path, test_mode=True):
+        raise Exception(f"{layout_name}: processing failed, see {log_path}")
+    total = time.perf_counter() - started
+
+    timer = invoice_info[-1]
+    print(json.dumps({
+        'layout': layout_name,
+        'rows': rows,
+        'stages': {stage.name: {'seconds': stage.seconds, 'rows': stage.rows} for stage in timer.stages.values()},
+        'total': total,
+        # ru_maxrss is in KB on Linux
+        'peak_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        'baseline_mb': baseline_kb / 1024,
+    }))
+
+
+def bench_stages(layout_names, sizes, repeat, work_dir):
+    """validate_file + process_invoice per layout and size, in a fresh process each time.
+
+    Workbooks are generated into work_dir/test_files (and reused if they
+    are there already); the runs use test mode, a SQLite database in
+    work_dir and no sheet cache. With repeat > 1 the median of each
+    number is reported.
+    """
+    os.makedirs(os.path.join(work_dir, 'test_files'), exist_ok=True)
+    os.makedirs(os.path.join(work_dir, 'logs'), exist_ok=True)
+    env = dict(os.environ,
+               BENCHMARK_DB_URL=f'sqlite:///{os.path.join(work_dir, "benchmark.sqlite")}',
+               SHEET_CACHE_MAX_BYTES='0',
+               PYTHONHASHSEED='0')
+
+    results = []
+    for layout_name in layout_names:
+        for rows in sizes:
+            file_path = os.path.join(work_dir, 'test_files', get_benchmark_path(layout_name, rows).split('/')[-1])
+            if not os.path.exists(file_path):
+                write_benchmark_workbook(layout_name, rows, file_path)
+
+            runs = []
+            for _ in range(repeat):
+                output = subprocess.run(
+                    [sys.executable, os.path.abspath(__file__), '--case', layout_name, str(rows)],
+                    cwd=work_dir, env=env, stdout=subprocess.PIPE, check=True, universal_newlines=True).stdout
+                runs.append(json.loads(output.splitlines()[-1]))
+
+            stages = {}
+            for name in BENCHMARK_STAGES:
+                seconds = [run['stages'][name]['seconds'] for run in runs if name in run['stages']]
+                if seconds:
+                    stages[name] = {'seconds': statistics.median(seconds), 'rows': runs[0]['stages'][name]['rows']}
+            result = {
+                'layout': layout_name,
+                'rows': rows,
+                'stages': stages,
+                'total': statistics.median(run['total'] for run in runs),
+                'peak_mb': statistics.median(run['peak_mb'] for run in runs),
+                'baseline_mb': statistics.median(run['baseline_mb'] for run in runs),
+            }
+            results.append(result)
+            print(f"{layout_name:20} {rows:>7} rows  total {result['total']:7.2f}s  peak {result['peak_mb']:5.0f}MB"
+                  f" (+{result['peak_mb'] - result['baseline_mb']:.0f})  "
+                  + '  '.join(f"{name} {stage['seconds']:.2f}" for name, stage in stages.items()))
+
+    return results
+
+
+def get_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                              stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True).stdout.strip() or None
+    except OSError as e:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Invoice processing benchmarks')
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--layout', choices=sorted(LAYOUTS), action='append')
+    parser.add_argument('--stages', action='store_true', help='time the stages of validate_file/process_invoice on synthetic workbooks')
+    parser.add_argument('--sizes', type=int, nargs='+', default=list(BENCHMARK_SIZES), help='rows per workbook (--stages)')
+    parser.add_argument('--repeat', type=int, default=1, help='runs per layout and size (--stages)')
+    parser.add_argument('--work-dir', default=os.path.join(tempfile.gettempdir(), 'invoice-benchmark'), help='workbooks, database and logs (--stages)')
+    parser.add_argument('--json', help='also write the --stages results to this file')
+    parser.add_argument('--case', nargs=2, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.case:
+        run_stage_case(args.case[0], int(args.case[1]))
+        return
+
+    if args.stages:
+        results = bench_stages(args.layout or sorted(BENCHMARK_READER_SETTINGS), args.sizes, args.repeat, os.path.abspath(args.work_dir))
+        if args.json:
+            with open(args.json, 'w') as f:
+                json.dump({'commit': get_commit(), 'python': sys.version.split()[0], 'load_mode': os.getenv('LOAD_MODE', 'orm'),
+                           'results': results}, f, indent=1)
+        return
+
+    seed_benchmark_database()
+    print(f"Row mapping, {args.rows} rows (rows/s)")
+    for layout_name in args.layout or LAYOUTS:
+        baseline, compiled = bench_row_mapping(layout_name, args.rows)
+        print(f"{layout_name:22} old function {baseline:>10.0f}  compiled {compiled:>10.0f}  x{compiled / baseline:.1f}")
+
+    print(f"Validation, {args.rows} rows x {len(VALIDATION_FIELDS)} columns (rows/s)")
+    row_by_row, by_column, in_parallel = bench_validation(args.rows)
+    print(f"{'':22} row by row {row_by_row:>10.0f}  by column {by_column:>10.0f}  x{by_column / row_by_row:.1f}")
+    print(f"{'':22} {VALIDATION_WORKERS} processes {in_parallel:>10.0f}  x{in_parallel / row_by_row:.1f}")
+
+
+if __name__ == '__main__':
+    main()
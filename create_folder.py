@@ -1,24 +1,70 @@
-from datetime import datetime
+import os
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy import func
 
 from utilities import *
 
 
+PROVISION_WORKERS = int(os.getenv('PROVISION_WORKERS', AWS_MAX_POOL_CONNECTIONS))
+
+SOURCE_FOLDERS = {1: 'Portal', 2: 'Email'}
+
+
+def get_month_folders(year, month):
+    # facility -> its first pharmacy map -> that pharmacy's reader settings, in one query
+    first_maps = session.query(func.min(FacilityPharmacyMap.id)).group_by(FacilityPharmacyMap.facility_id)
+    rows = session.query(Facility.facility_nm, PharmacyInvoiceReaderSetting.invoice_source_id).join(
+        FacilityPharmacyMap, FacilityPharmacyMap.facility_id==Facility.id).join(
+        PharmacyInvoiceReaderSetting, PharmacyInvoiceReaderSetting.pharmacy_id==FacilityPharmacyMap.pharmacy_id).filter(
+        Facility.delete_by==None,
+        FacilityPharmacyMap.id.in_(first_maps)).distinct()
+
+    return sorted({f"{year}/{month}/{facility_nm}/{SOURCE_FOLDERS.get(source_id, 'General')}/" for facility_nm, source_id in rows})
+
+
+def get_existing_folders(prefix):
+    # every facility/source folder under the prefix that has the folder object or any file in it
+    folders = set()
+    paginator = get_s3_client().get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=get_s3_bucket(), Prefix=prefix):
+        for obj in page.get('Contents', []):
+            folders.add(get_folder(obj['Key']))
+
+    return folders
+
+
+def get_folder(key):
+    # <year>/<month>/<facility>/<source>/ of a key
+    return '/'.join(key.split('/')[:4]) + '/'
+
+
+def create_folder(folder):
+    get_s3_client().put_object(Bucket=get_s3_bucket(), Key=folder)
+    return folder
+
+
 def main():
-    year = datetime.now().year
-    month = datetime.now().month
-
-    facilities = get_facilities()
-
-    for facility in facilities:
-        pharmacy_map = get_pharmacy(facility)
-        if not pharmacy_map:
-            continue
-        pharmacy = pharmacy_map.pharmacy
-        reader_settings = get_reader_settings(pharmacy)
-        for rs in reader_settings:
-            source = 'Portal' if rs.invoice_source_id == 1 else 'Email' if rs.invoice_source_id == 2 else 'General'
-            directory_name = f"{year}/{month}/{facility.facility_nm}/{source}/"
-            get_s3_client().put_object(Bucket=get_s3_bucket(), Key=(directory_name))
+    parser = argparse.ArgumentParser(description='Create the facility/source folders of a month in the invoice bucket')
+    parser.add_argument('--year', type=int, default=datetime.date.today().year)
+    parser.add_argument('--month', type=int, default=datetime.date.today().month)
+    parser.add_argument('--dry-run', action='store_true', help='only list the folders that would be created')
+    args = parser.parse_args()
+
+    folders = get_month_folders(args.year, args.month)
+    existing = get_existing_folders(f"{args.year}/{args.month}/")
+    missing = [folder for folder in folders if folder not in existing]
+
+    if args.dry_run:
+        for folder in missing:
+            print(folder)
+    else:
+        with ThreadPoolExecutor(max_workers=PROVISION_WORKERS) as pool:
+            for folder in pool.map(create_folder, missing):
+                print(folder)
+
+    print(f"{len(missing)} {'to create' if args.dry_run else 'created'}, {len(folders) - len(missing)} already there")
 
 
 if __name__ == '__main__':
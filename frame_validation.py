@@ -0,0 +1,198 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+from utilities import *
+
+
+# invoices with at least this many rows are validated column by column
+FRAME_VALIDATION_MIN_ROWS = int(os.getenv('FRAME_VALIDATION_MIN_ROWS', 5000))
+
+
+def _to_decimal(val):
+    return float(val.replace("$", "").replace("(", "").replace(")", ""))
+
+
+def _convert_column(convert):
+    # the column converts in one go unless it has bad cells; only then is
+    # every cell tried on its own
+    def convert_column(values):
+        try:
+            converted = np.empty(len(values), dtype=object)
+            converted[:] = [convert(val) for val in values]
+            return np.ones(len(values), dtype=bool), converted
+        except Exception as e:
+            pass
+
+        valid = np.zeros(len(values), dtype=bool)
+        converted = np.empty(len(values), dtype=object)
+        for i, val in enumerate(values):
+            try:
+                converted[i] = convert(val)
+                valid[i] = True
+            except Exception as e:
+                pass
+        return valid, converted
+
+    return convert_column
+
+
+def _chars(values):
+    return (values.str.len() == 1).to_numpy(bool), values.to_numpy(object)
+
+
+def _names(values):
+    comma = values.str.find(',')
+    return ((values.str.count(',') == 1) & (comma < 25) & (values.str.len() - comma - 1 < 25)).to_numpy(bool)
+
+
+# column versions of FIELD_CONVERTERS: (cells they are sure about, converted values)
+FRAME_CONVERTERS = {
+    'int': _convert_column(int),
+    'long': _convert_column(int),
+    'char': _chars,
+    'decimal': _convert_column(_to_decimal),
+}
+
+# column versions of FIELD_RULES: cells that pass the rule
+FRAME_RULES = {
+    'Ssn': lambda values: (values.str.match(SSN_PATTERN.pattern) | values.str.match(BLANK_SSN_PATTERN.pattern)).to_numpy(bool),
+    'MorF': lambda values: values.str.upper().isin(('M', 'F')).to_numpy(bool),
+    'BorG': lambda values: values.str.upper().isin(('B', 'G')).to_numpy(bool),
+    'MaxLength50': lambda values: (values.str.len() < 50).to_numpy(bool),
+    'MaxLength150': lambda values: (values.str.len() < 150).to_numpy(bool),
+    'MaxLength500': lambda values: (values.str.len() < 500).to_numpy(bool),
+    'MaxLength1000': lambda values: (values.str.len() < 1000).to_numpy(bool),
+    'Name': _names,
+}
+
+
+def factorize_column(values):
+    """Distinct cleaned values of a column and the code of every cell (-1 for None).
+
+    Columns of only strings, only ints or only non-zero floats are
+    factorized before cleaning, as equal cells clean to the same text;
+    anything else is cleaned first so that e.g. 1, 1.0 and True (or 0.0
+    and -0.0) stay apart.
+    """
+    kind = pd.api.types.infer_dtype(values, skipna=True)
+    if kind in ('string', 'integer') or kind == 'floating' and not np.equal(values, 0).any():
+        codes, uniques = pd.factorize(values)
+        # NaN would be missing to factorize but is text to clean_text
+        if np.count_nonzero(codes < 0) == np.count_nonzero(np.equal(values, None)):
+            return codes, [str(val).strip() for val in uniques]
+
+    codes, uniques = pd.factorize(np.array([None if val is None else str(val).strip() for val in values], dtype=object))
+    return codes, list(uniques)
+
+
+def validate_values(field, validate, values):
+    """validate() over an array of distinct, non-empty values.
+
+    The column versions of the converter and the rules find the values
+    that are valid without a message; only the rest go through validate().
+    """
+    series = pd.Series(values, dtype=object)
+    rules = [rule for rule in (field.field_validations or '').split(',') if rule in FIELD_RULES]
+    convert = FRAME_CONVERTERS.get(field.field_type)
+    if field.field_type in FIELD_CONVERTERS and not convert or any(rule not in FRAME_RULES for rule in rules):
+        sure, converted = np.zeros(len(values), dtype=bool), values
+    elif convert:
+        sure, converted = convert(series)
+    else:
+        sure, converted = np.ones(len(values), dtype=bool), values
+
+    for rule in rules:
+        sure = sure & FRAME_RULES[rule](series)
+
+    is_valid = sure.copy()
+    msgs = np.full(len(values), '', dtype=object)
+    # `_val or val`: a zero keeps the text it was converted from
+    results = np.where(np.equal(converted, 0) | np.equal(converted, None), values, converted)
+    for i in np.flatnonzero(~sure):
+        is_valid[i], msgs[i], results[i] = validate(values[i])
+
+    return is_valid, msgs, results
+
+
+def validate_column(entry, column, row_count):
+    """(is_valid, msg, value) arrays over the rows of one plan entry."""
+    field_name, column_name, idx, validate, required, date_parser, field = entry
+    if column is None:
+        codes, uniques = np.full(row_count, -1), []
+    else:
+        codes, uniques = factorize_column(column)
+
+    # code -1 (None) is the last slot
+    uniques = np.array(uniques + [None], dtype=object)
+    overrides = []
+
+    # formats are learned from the first dates in row order, so those
+    # cells are validated one by one; afterwards each value parses the same
+    counts = None
+    if date_parser:
+        start = 0
+        for start, code in enumerate(codes):
+            if date_parser.samples >= date_parser.sample_size:
+                break
+            if uniques[code]:
+                overrides.append((start, validate(uniques[code])))
+        else:
+            start = len(codes)
+        counts = np.bincount(codes[start:] % len(uniques), minlength=len(uniques))
+
+    filled = np.array([bool(val) for val in uniques]) if counts is None else np.array([bool(val) for val in uniques]) & (counts > 0)
+    is_valid = np.full(len(uniques), not required)
+    msgs = np.full(len(uniques), "Should not be empty", dtype=object)
+    values = uniques.copy()
+
+    filled = np.flatnonzero(filled)
+    if date_parser:
+        for i in filled:
+            fast, fallback = date_parser.fast, date_parser.fallback
+            is_valid[i], msgs[i], values[i] = validate(uniques[i])
+            date_parser.fast += (date_parser.fast - fast) * (counts[i] - 1)
+            date_parser.fallback += (date_parser.fallback - fallback) * (counts[i] - 1)
+    elif len(filled):
+        is_valid[filled], msgs[filled], values[filled] = validate_values(field, validate, uniques[filled])
+
+    is_valid, msgs, values = is_valid.take(codes), msgs.take(codes), values.take(codes)
+    for i, (_is_valid, msg, val) in overrides:
+        is_valid[i], msgs[i], values[i] = _is_valid, msg, val
+
+    return is_valid, msgs, values
+
+
+def validate_frame(plan, rows, errors):
+    """Validates rows of (row_no, values) like validate_row, a column at a time.
+
+    Gives the same data, errors and date format counters as calling
+    validate_row on every row.
+    """
+    row_nos = []
+    cells = []
+    for row_no, row in rows:
+        row_nos.append(row_no)
+        cells.append(row)
+    frame = pd.DataFrame(cells, dtype=object) if cells else pd.DataFrame()
+
+    columns = []
+    for entry in plan:
+        idx = entry[2]
+        column = frame[idx].to_numpy(object) if idx is not None and idx < frame.shape[1] else None
+        columns.append(validate_column(entry, column, len(row_nos)))
+
+    if not columns:
+        return True, [{} for _ in row_nos]
+
+    invalid = np.column_stack([~is_valid for is_valid, msgs, values in columns])
+    # row major, so errors come out in the same order as validate_row's
+    for row, col in zip(*np.nonzero(invalid)):
+        errors.add(row_nos[row], plan[col][1], columns[col][1][row])
+
+    valid_rows = np.flatnonzero(~invalid.any(axis=1))
+    field_names = [entry[0] for entry in plan]
+    data = [dict(zip(field_names, row)) for row in zip(*[values[valid_rows].tolist() for is_valid, msgs, values in columns])]
+
+    return len(valid_rows) == len(row_nos), data
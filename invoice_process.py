@@ -1,16 +1,57 @@
-import math
+import hashlib
 import datetime
+import itertools
 import traceback
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
 
 from openpyxl import load_workbook
 
 from utilities import *
+from loaders import *
+from storage import get_storage
+from sheet_cache import sheet_cache
+from frame_validation import FRAME_VALIDATION_MIN_ROWS
+from parallel_validation import validate_parallel
+from row_mapping import LAYOUTS, map_invoice
 
 
-def validate_file(invoice_path, test_mode=False):
-    log_file_path = datetime.datetime.now().strftime("logs/%Y%m%d-%H%M%S.txt")
-    log_file = open(log_file_path, "w")
+_prefetch = ThreadPoolExecutor(max_workers=1)
+
+
+def download_invoice(storage, invoice_path, stat):
+    # queued on _prefetch behind the stat, so it starts as soon as the HEAD
+    # request has the version to pin the download to
+    object_key, version_id, file_fingerprint = stat.result()
+    return storage.open(invoice_path, version_id)
+
+
+def close_download(download):
+    # a download that turned out not to be needed (a skipped duplicate, a
+    # sheet cache hit) is cancelled if it hasn't started; otherwise the file
+    # is closed once it is there, without holding up the return
+    if not download.cancel():
+        download.add_done_callback(_close_downloaded)
+
+
+def _close_downloaded(download):
+    if not download.exception():
+        download.result().close()
+
+
+def validate_file(invoice_path, test_mode=False, force=False):
+    # whichever way it returns, the workbook and the downloaded file are closed
+    with contextlib.ExitStack() as cleanup:
+        return _validate_file(invoice_path, test_mode, force, cleanup)
+
+
+def _validate_file(invoice_path, test_mode, force, cleanup):
+    # unique across the workers of a backfill or the poller
+    log_file_path = datetime.datetime.now().strftime("logs/%Y%m%d-%H%M%S-%f") + f"-{os.getpid()}.txt"
+    log_file = open(log_file_path, "w", buffering=LOG_BUFFER_BYTES)
     result = True
+    timer = StageTimer()
+    errors = ErrorCollector()
     print("File Path:", invoice_path, '\n', file=log_file)
     print("1. Validating invoice:", file=log_file)
 
@@ -23,587 +64,247 @@ def validate_file(invoice_path, test_mode=False):
         log_file.close()
         return False, log_file_path, None
 
-    facility = get_facility(invoice_path)
-    source = get_source(invoice_path)
-    facility_pharmacy_map = get_pharmacy(facility)
-    pharmacy = facility_pharmacy_map.pharmacy
-    invoice_reader_settings = get_reader_setting(pharmacy, source)
+    if not test_mode:
+        # (object key, version id, fingerprint), then the file itself, fetched
+        # while the reference data is looked up below
+        storage = get_storage()
+        prefetch = _prefetch.submit(storage.stat, invoice_path)
+        download = _prefetch.submit(download_invoice, storage, invoice_path, prefetch)
+        cleanup.callback(close_download, download)
+
+    with timer.stage('reference lookup'):
+        facility = get_facility(invoice_path)
+        source = get_source(invoice_path)
+        facility_pharmacy_map = get_pharmacy(facility)
+        pharmacy = facility_pharmacy_map.pharmacy
+        invoice_reader_settings = get_reader_setting(pharmacy, source)
 
     if not invoice_reader_settings:
         print("Reader setting is not available", file=log_file)
         log_file.close()
         return False, log_file_path, None
 
-    # download invoice
     if not test_mode:
-        file_name = 'invoice.xlsx'
-        invoice_path = get_s3_client().download_file(get_s3_bucket(), invoice_path, file_name)
+        # only the part that didn't overlap the lookups
+        with timer.stage('stat'):
+            object_key, version_id, file_fingerprint = prefetch.result()
     else:
-        file_name = 'test_files/' + invoice_path.split('/')[-1]
+        invoice_file = 'test_files/' + invoice_path.split('/')[-1]
+        stat = os.stat(invoice_file)
+        object_key = (invoice_file, stat.st_mtime_ns, stat.st_size)
+        # test loads go to their own (duplicate) rows
+        with open(invoice_file, 'rb') as f:
+            file_fingerprint = 'test:sha1:' + hashlib.sha1(f.read()).hexdigest()
+
+    # the same file again has nothing new for the month
+    with timer.stage('fingerprint check'):
+        last_file_fingerprint = get_last_file_fingerprint(facility_pharmacy_map, invoice_dt)
+    if not force and file_fingerprint == last_file_fingerprint:
+        print("Same file as the last successful load for this month (", file_fingerprint, "), skipped", file=log_file)
+        log_file.close()
+        return True, log_file_path, None
 
-    # parse invoice
-    wb = load_workbook(file_name)
+    # a re-queued invoice is served from the sheet cache while the file is unchanged
+    with timer.stage('sheet cache'):
+        cached = sheet_cache.get(object_key, invoice_reader_settings.sheet_name, log_file)
+    if cached:
+        sheet_name, sheet_rows = cached
+    else:
+        if not test_mode:
+            # only the part that didn't overlap the lookups and the checks
+            with timer.stage('download'):
+                invoice_file = download.result()
 
-    try:
-        sheet_name = invoice_reader_settings.sheet_name or wb.sheetnames[0]
-        ws = wb[sheet_name]
-    except Exception as e:
-        print(f"Required sheet ({sheet_name}) not found.", file=log_file)
-        log_file.close()
-        return False, log_file_path, None
+        # parse invoice
+        with timer.stage('workbook load'):
+            wb = load_workbook(invoice_file, read_only=True)
+        cleanup.callback(wb.close)
 
-    nrows = get_valid_rows_count(ws)
-    if not nrows:
+        try:
+            sheet_name = invoice_reader_settings.sheet_name or wb.sheetnames[0]
+            ws = wb[sheet_name]
+        except Exception as e:
+            print(f"Required sheet ({sheet_name}) not found.", file=log_file)
+            log_file.close()
+            return False, log_file_path, None
+
+        # dimensions written by some exporters are wrong; read until the data ends
+        ws.reset_dimensions()
+        # rows stream from the workbook into validation, so reading them is
+        # part of that stage; the sheet cache writes them as they go by
+        sheet_rows = ws.iter_rows(values_only=True)
+        if sheet_cache.max_bytes:
+            sheet_rows = sheet_cache.put(object_key, invoice_reader_settings.sheet_name, sheet_name,
+                                         (values for row_no, values in iter_sheet_rows(sheet_rows)), log_file)
+    # releases the cache file (or drops a partly written entry) on an early return
+    cleanup.callback(sheet_rows.close)
+
+    # get meta info from [pharmacy_invoice_reader_settings]
+    header, rows = read_sheet(
+        sheet_rows,
+        invoice_reader_settings.header_row_index,
+        invoice_reader_settings.skip_rows_after_header,
+        invoice_reader_settings.skip_ending_rows
+    )
+    if header is None:
         print(f"The sheet ({sheet_name}) is invalid.", file=log_file)
         log_file.close()
         return False, log_file_path, None
 
-    # get meta info from [pharmacy_invoice_reader_settings]
-    start_index = invoice_reader_settings.header_row_index + invoice_reader_settings.skip_rows_after_header + 1
-    nrows = nrows - invoice_reader_settings.skip_ending_rows
-
-    header = [get_clean_header_column(ii.value) for ii in ws[invoice_reader_settings.header_row_index+1] if ii.value]
-
     # for field in invoice_reader_settings.raw_invoice_fields:
     #     if field.sheet_column_name not in header and not field.is_optional:
     #         result = False
     #         print(f"Column '{field.sheet_column_name}' not found", file=log_file)
 
-    data = []
-    # validate each row using field validator
-    for row_idx in range(start_index, nrows):
-        is_valid, cleaned_data = validate_row(invoice_reader_settings.raw_invoice_fields, header, ws[row_idx+1], row_idx+1, log_file)
-        if is_valid:
-            data.append(cleaned_data)
+    with timer.stage('validation') as stage:
+        plan = get_validation_plan(invoice_reader_settings, header)
+        reset_validation_plan(plan)
+
+        # large invoices are validated a column at a time, huge ones also
+        # in chunks across processes
+        head = list(itertools.islice(rows, FRAME_VALIDATION_MIN_ROWS))
+        if len(head) == FRAME_VALIDATION_MIN_ROWS:
+            result, data = validate_parallel(plan, itertools.chain(head, rows), errors)
         else:
-            result = False
+            data = []
+            # validate each row using field validator
+            for row_idx, row in head:
+                is_valid, cleaned_data = validate_row(plan, row, row_idx, errors)
+                if is_valid:
+                    data.append(cleaned_data)
+                else:
+                    result = False
+        stage.rows = len(data)
+        stage.hits, stage.misses = get_memo_stats(plan)
+
+    errors.log(log_file)
+    log_date_parsers(plan, log_file)
+    timer.log(log_file)
 
     if result:
         print("Invoice is valid.\n", file=log_file)
 
-    invoice_info = (facility_pharmacy_map, invoice_dt, source, data)
+    invoice_info = (facility_pharmacy_map, invoice_dt, source, data, invoice_reader_settings, file_fingerprint, timer)
     log_file.close()
 
     return result, log_file_path, invoice_info
 
 
 def process_invoice(invoice_info, log_path, test_mode=False):
-    (facility_pharmacy_map, invoice_dt, source, invoice_data) = invoice_info
-    log_file = open(log_path, 'a')
+    (facility_pharmacy_map, invoice_dt, source, invoice_data, invoice_reader_settings, file_fingerprint, timer) = invoice_info
+    log_file = open(log_path, 'a', buffering=LOG_BUFFER_BYTES)
 
     print("2. Processing Invoice:", file=log_file)
     # create a log
     source_id = source.id if source else 0
     source_name = source.source_nm.lower() if source else 'general'
-    invoice_batch_log_id = start_batch_logging(facility_pharmacy_map, invoice_dt, source_id)
+    invoice_batch_log_id = start_batch_logging(facility_pharmacy_map, invoice_dt, source_id, timer.started_at.time())
     pharmacy_name = facility_pharmacy_map.pharmacy.pharmacy_nm.lower().replace(' ', '_')
     pharmacy_id = facility_pharmacy_map.pharmacy.id
     facility_id = facility_pharmacy_map.facility.id
-    process_invoice_func = globals().get(f'_process_row_{pharmacy_name}_{source_name}')
+    layout = f'{pharmacy_name}_{source_name}'
+    staged_load = False
 
     try:
-        # delete any pre-existing records
-        session.query(PharmacyInvoice).filter(
+        # resolve every distinct invoice group before transforming the rows
+        with timer.stage('payer lookup'):
+            payer_groups = get_payer_group_index(pharmacy_id)
+            layout_info = LAYOUTS[layout]
+            unresolved = payer_groups.unresolved({row.get(layout_info.payer_group_field) for row in invoice_data}, source_id if layout_info.by_source else None)
+        if unresolved:
+            print("Payer group not found:", ', '.join(unresolved), file=log_file)
+            raise Exception("Payer group lookup failed.")
+
+        # pre-existing records of the invoice
+        invoice_filters = (
             PharmacyInvoice.duplicate_flg==test_mode,
             PharmacyInvoice.pharmacy_id==pharmacy_id,
             PharmacyInvoice.facility_id==facility_id,
-            PharmacyInvoice.invoice_dt==invoice_dt).delete()
-
-        result, load_data = process_invoice_func(
-            invoice_data,
-            invoice_batch_log_id,
-            pharmacy_id,
-            facility_id,
-            invoice_dt,
-            source_id,
-            log_file,
-            test_mode
-        )
+            PharmacyInvoice.invoice_dt==invoice_dt)
+        # the stored procedures always load the whole invoice
+        diff_reload = RELOAD_MODE == 'diff' and not invoice_reader_settings.bulk_insert_sp_name
+        # staged loads delete the old rows only when swapping the new ones in
+        staged_load = LOAD_MODE == 'staging' and not diff_reload and not invoice_reader_settings.bulk_insert_sp_name
+        if not diff_reload and not staged_load:
+            with timer.stage('delete') as stage:
+                stage.rows = session.query(PharmacyInvoice).filter(*invoice_filters).delete()
+
+        with timer.stage('transformation') as stage:
+            result, load_data = map_invoice(
+                layout,
+                invoice_data,
+                invoice_batch_log_id,
+                pharmacy_id,
+                facility_id,
+                invoice_dt,
+                source_id,
+                payer_groups,
+                log_file,
+                test_mode
+            )
+            stage.rows = len(load_data)
 
         if not result:
             raise Exception("Transformation failed.")
 
-        session.add_all(load_data)
-        session.commit()
+        if diff_reload:
+            with timer.stage('delete'):
+                load_data = diff_invoice_lines(load_data, invoice_filters, log_file)
+
+        with timer.stage('insert') as stage:
+            if invoice_reader_settings.bulk_insert_sp_name:
+                call_bulk_insert_sp(invoice_reader_settings.bulk_insert_sp_name, invoice_batch_log_id, load_data, log_file)
+            elif staged_load:
+                stage_invoices(load_data, log_file)
+            elif LOAD_MODE in ('bulk', 'staging'):
+                bulk_insert_invoices(load_data, log_file)
+            else:
+                session.add_all([PharmacyInvoice(**dict(zip(LOAD_COLUMNS, row))) for row in load_data])
+                # the orm inserts when flushing, not on commit
+                session.flush()
+            stage.rows = len(load_data)
+        if staged_load:
+            # pharmacy_invoices stays locked from the swap to the commit
+            with timer.stage('swap') as stage:
+                stage.rows = swap_staged_invoices(invoice_batch_log_id, invoice_filters, log_file)
+                session.commit()
+            print(f"pharmacy_invoices locked for {stage.seconds:.3f}s", file=log_file)
+        else:
+            with timer.stage('commit'):
+                session.commit()
         print("Invoice uploaded successfully", file=log_file)
     except Exception as e:
         session.rollback()
         result = False
         print(traceback.format_exc(), file=log_file)
-    
-    res = stop_batch_logging(invoice_batch_log_id)
+        if staged_load:
+            discard_staged_invoices(invoice_batch_log_id, log_file)
+
+    timer.log(log_file)
+    print(f"Total: {(datetime.datetime.now() - timer.started_at).total_seconds():.3f}s", file=log_file)
+    res = stop_batch_logging(invoice_batch_log_id, file_fingerprint if result else None)
     log_file.close()
 
     return result
 
 
-def _process_row_specialty_rx_email(invoice_data, invoice_batch_log_id, pharmacy_id, facility_id, invoice_dt, source, log_file, test_mode=False):
-    result = True
-    load_data = []
-
-    for row in invoice_data:
-        try:
-            first_nm = get_first_name(row['patient'])
-            last_nm = get_last_name(row['patient'])
-            payer_group_id = get_payer_group(pharmacy_id, row['invgrp'], source)
-            ssn = row['ssn_no'][:3]+row['ssn_no'][4:6]+row['ssn_no'][7:11] if row['ssn_no'] and row['ssn_no'][0] != '_' else 0
-
-            record = {
-                'invoice_batch_id': invoice_batch_log_id,
-                'pharmacy_id': pharmacy_id,
-                'facility_id': facility_id,
-                'payer_group_id': payer_group_id,
-                'invoice_dt': invoice_dt,
-                'first_nm': first_nm,
-                'last_nm': last_nm,
-                'ssn': ssn,
-                'dob': None,
-                'gender': None,
-                'dispense_dt': row['dispdt'],
-                'product_category': row['rx_otc'],
-                'drug_nm': row['drug'],
-                'doctor': None,
-                'rx_nbr': row['rx_no'],
-                'ndc': row['ndc'],
-                'reject_cd': None,
-                'quantity': row['qty'],
-                'days_supplied': row['ds'],
-                'charge_amt': row['billamt'],
-                'copay_amt': None,
-                'copay_flg': 'Y' if row['copay'].upper() == 'COPAY' else None,
-                'census_match_cd': None,
-                'status_cd': None,
-                'charge_confirmed_flg': None,
-                'duplicate_flg': test_mode,
-                'note': row['comment'],
-                'request_credit_flg': None,
-                'credit_request_dt': None,
-                'credit_request_cd': None,
-                'days_overbilled': None
-            }
-
-            load_data.append(PharmacyInvoice(**record))
-        except Exception as e:
-            print(traceback.format_exc(), file=log_file)
-            result = False
-
-    return result, load_data
-
-
-def _process_row_specialty_rx_portal(invoice_data, invoice_batch_log_id, pharmacy_id, facility_id, invoice_dt, source, log_file, test_mode=False):
-    result = True
-    load_data = []
-
-    for row in invoice_data:
-        try:
-            first_nm = get_first_name(row['resident'])
-            last_nm = get_last_name(row['resident'])
-            payer_group_id = get_payer_group(pharmacy_id, row['group'], source)
-
-            record = {
-                'invoice_batch_id': invoice_batch_log_id,
-                'pharmacy_id': pharmacy_id,
-                'facility_id': facility_id,
-                'payer_group_id': payer_group_id,
-                'invoice_dt': invoice_dt,
-                'first_nm': first_nm,
-                'last_nm': last_nm,
-                'ssn': None,
-                'dob': None,
-                'gender': None,
-                'dispense_dt': row['dispensed'],
-                'product_category': row['rx_type'],
-                'drug_nm': row['drug_nm'],
-                'doctor': None,
-                'rx_nbr': row['rx_no'],
-                'ndc': None,
-                'reject_cd': None,
-                'quantity': row['quantity'],
-                'days_supplied': row['days_supply'],
-                'charge_amt': row['amount'],
-                'copay_amt': None,
-                'copay_flg': 'Y' if row['is_a_copay'] and row['is_a_copay'].upper() == 'COPAY' else None,
-                'census_match_cd': None,
-                'status_cd': None,
-                'charge_confirmed_flg': None,
-                'duplicate_flg': test_mode,
-                'note': row['billing_comment'],
-                'request_credit_flg': None,
-                'credit_request_dt': None,
-                'credit_request_cd': None,
-                'days_overbilled': None
-            }
-
-            load_data.append(PharmacyInvoice(**record))
-        except Exception as e:
-            print(traceback.format_exc(), file=log_file)
-            result = False
-
-    return result, load_data
-
-
-def _process_row_pharmscripts_portal(invoice_data, invoice_batch_log_id, pharmacy_id, facility_id, invoice_dt, source, log_file, test_mode=False):
-    result = True
-    load_data = []
-
-    for row in invoice_data:
-        try:
-            first_nm = get_first_name(row['patient_nm'])
-            last_nm = get_last_name(row['patient_nm'])
-            payer_group_id = get_payer_group(pharmacy_id, row['inv_grp'], source)
-
-            record = {
-                'invoice_batch_id': invoice_batch_log_id,
-                'pharmacy_id': pharmacy_id,
-                'facility_id': facility_id,
-                'payer_group_id': payer_group_id,
-                'invoice_dt': invoice_dt,
-                'first_nm': first_nm,
-                'last_nm': last_nm,
-                'ssn': row['ssn'],
-                'dob': None,
-                'gender': 'M' if row['b_or_g'] == 'B' else 'F' if row['b_or_g'] == 'G' else None,
-                'dispense_dt': row['disp_dt'],
-                'product_category': row['rx_type'],
-                'drug_nm': row['drug'],
-                'doctor': row['physician'],
-                'rx_nbr': row['rx_no'],
-                'ndc': row['ndc'],
-                'reject_cd': None,
-                'quantity': row['qty'],
-                'days_supplied': row['ds'],
-                'charge_amt': row['bill'],
-                'copay_amt': None,
-                'copay_flg': 'Y' if row['copay'].upper() == 'Y' else None,
-                'census_match_cd': None,
-                'status_cd': None,
-                'charge_confirmed_flg': None,
-                'duplicate_flg': test_mode,
-                'note': row['billing_comment'],
-                'request_credit_flg': None,
-                'credit_request_dt': None,
-                'credit_request_cd': None
-            }
-
-            load_data.append(PharmacyInvoice(**record))
-        except Exception as e:
-            print(traceback.format_exc(), file=log_file)
-            result = False
-
-    return result, load_data
-
-
-def _process_row_pharmscripts_email(invoice_data, invoice_batch_log_id, pharmacy_id, facility_id, invoice_dt, source, log_file, test_mode=False):
-    result = True
-    load_data = []
-
-    for row in invoice_data:
-        try:
-            first_nm = get_first_name(row['patient'])
-            last_nm = get_last_name(row['patient'])
-            payer_group_id = get_payer_group(pharmacy_id, row['invoice_grp'], source)
-
-            record = {
-                'invoice_batch_id': invoice_batch_log_id,
-                'pharmacy_id': pharmacy_id,
-                'facility_id': facility_id,
-                'payer_group_id': payer_group_id,
-                'invoice_dt': invoice_dt,
-                'first_nm': first_nm,
-                'last_nm': last_nm,
-                'ssn': row['ssn'],
-                'dob': None,
-                'gender': 'M' if row['b_g'] == 'B' else 'F' if row['b_g'] == 'G' else None,
-                'dispense_dt': row['disp_dt'],
-                'product_category': row['otc_rx'],
-                'drug_nm': row['drug'],
-                'doctor': row['physician'],
-                'rx_nbr': row['rx_no'],
-                'ndc': row['ndc'],
-                'reject_cd': None,
-                'quantity': row['tot_qty_disp'],
-                'days_supplied': row['ds'],
-                'charge_amt': row['tot_bill_amt'],
-                'copay_amt': None,
-                'copay_flg': 'Y' if row['is_a_copay'].upper() == 'Y' else None,
-                'census_match_cd': None,
-                'status_cd': None,
-                'charge_confirmed_flg': None,
-                'duplicate_flg': test_mode,
-                'note': None,
-                'request_credit_flg': None,
-                'credit_request_dt': None,
-                'credit_request_cd': None,
-                'days_overbilled': None
-            }
-
-            load_data.append(PharmacyInvoice(**record))
-        except Exception as e:
-            print(traceback.format_exc(), file=log_file)
-            result = False
-
-    return result, load_data
-
-
-def _process_row_geriscript_general(invoice_data, invoice_batch_log_id, pharmacy_id, facility_id, invoice_dt, source, log_file, test_mode=False):
-    result = True
-    load_data = []
-
-    for row in invoice_data:
-        try:
-            first_nm = get_first_name(row['full_nm'])
-            last_nm = get_last_name(row['full_nm'])
-            payer_group_id = get_payer_group(pharmacy_id, row['invoice_grp'], None)
-            ssn = row['ssn'][:3]+row['ssn'][4:6]+row['ssn'][7:11] if row['ssn'] and row['ssn'][0] != '_' else ''
-
-            record = {
-                'invoice_batch_id': invoice_batch_log_id,
-                'pharmacy_id': pharmacy_id,
-                'facility_id': facility_id,
-                'payer_group_id': payer_group_id,
-                'invoice_dt': invoice_dt,
-                'first_nm': first_nm,
-                'last_nm': last_nm,
-                'ssn': ssn,
-                'dob': row['birth_date'],
-                'gender': row['sex'],
-                'dispense_dt': row['dispense_dt'],
-                'product_category': row['rx_otc'],
-                'drug_nm': row['drug_label_nm'],
-                'doctor': row['doctor'],
-                'rx_nbr': row['rx_no'],
-                'ndc': row['ndc'],
-                'reject_cd': None,
-                'quantity': row['qty'],
-                'days_supplied': row['days_supply'],
-                'charge_amt': row['bill_amt'],
-                'copay_amt': row['copay_amt'],
-                'copay_flg': 'Y' if row['copay_amt'] and float(row['copay_amt']) > 0 else None,
-                'census_match_cd': None,
-                'status_cd': None,
-                'charge_confirmed_flg': None,
-                'duplicate_flg': test_mode,
-                'note': row['billing_comment'],
-                'request_credit_flg': None,
-                'credit_request_dt': None,
-                'credit_request_cd': None,
-                'days_overbilled': None
-            }
-
-            load_data.append(PharmacyInvoice(**record))
-        except Exception as e:
-            print(traceback.format_exc(), file=log_file)
-            result = False
-
-    return result, load_data
-
-
-def _process_row_medwiz_general(invoice_data, invoice_batch_log_id, pharmacy_id, facility_id, invoice_dt, source, log_file, test_mode=False):
-    result = True
-    load_data = []
-
-    for row in invoice_data:
-        try:
-            first_nm = get_first_name(row['name'])
-            last_nm = get_last_name(row['name'])
-            payer_group_id = get_payer_group(pharmacy_id, row['invoice_group'], None)
-
-            record = {
-                'invoice_batch_id': invoice_batch_log_id,
-                'pharmacy_id': pharmacy_id,
-                'facility_id': facility_id,
-                'payer_group_id': payer_group_id,
-                'invoice_dt': invoice_dt,
-                'first_nm': first_nm,
-                'last_nm': last_nm,
-                'ssn': None,
-                'dob': None,
-                'gender': None,
-                'dispense_dt': row['dispense_date'],
-                'product_category': row['distribution_code'],
-                'drug_nm': row['description'],
-                'doctor': None,
-                'rx_nbr': row['rx_no'],
-                'ndc': row['ndc'],
-                'reject_cd': None,
-                'quantity': row['qty'],
-                'days_supplied': row['days_supply'],
-                'charge_amt': row['amount'],
-                'copay_amt': None,
-                'copay_flg': 'Y' if row['copay'].upper() == 'COPAY' else None,
-                'census_match_cd': None,
-                'status_cd': None,
-                'charge_confirmed_flg': None,
-                'duplicate_flg': test_mode,
-                'note': row['billing_comment'],
-                'request_credit_flg': None,
-                'credit_request_dt': None,
-                'credit_request_cd': None,
-                'days_overbilled': None
-            }
-
-            load_data.append(PharmacyInvoice(**record))
-        except Exception as e:
-            print(traceback.format_exc(), file=log_file)
-            result = False
-
-    return result, load_data
-
-
-def _process_row_omnicare_general(invoice_data, invoice_batch_log_id, pharmacy_id, facility_id, invoice_dt, source, log_file, test_mode=False):
-    result = True
-    load_data = []
-
-    for row in invoice_data:
-        try:
-            first_nm = row['patient_first_nm']
-            last_nm = row['patient_last_nm']
-            payer_group_id = get_payer_group(pharmacy_id, row['pay_type_description'], None)
-            ssn = row['patient_ssn'][:3]+row['patient_ssn'][4:6]+row['patient_ssn'][7:11] if row['patient_ssn'] and row['patient_ssn'][0] != '_' else ''
-
-            record = {
-                'invoice_batch_id': invoice_batch_log_id,
-                'pharmacy_id': pharmacy_id,
-                'facility_id': facility_id,
-                'payer_group_id': payer_group_id,
-                'invoice_dt': invoice_dt,
-                'first_nm': first_nm,
-                'last_nm': last_nm,
-                'ssn': ssn,
-                'dob': None,
-                'gender': None,
-                'dispense_dt': row['transaction_dt'],
-                'product_category': row['inventory_category'],
-                'drug_nm': row['description'],
-                'doctor': row['physician'],
-                'rx_nbr': row['rx'],
-                'ndc': row['ndc'],
-                'reject_cd': row['reject_codes'],
-                'quantity': row['qty'],
-                'days_supplied': row['days_supply'],
-                'charge_amt': row['amount'],
-                'copay_amt': row['amount'] if row['copay'] == 'copay' else None,
-                'copay_flg': 'Y' if row['copay'] == 'copay' else None,
-                'census_match_cd': None,
-                'status_cd': None,
-                'charge_confirmed_flg': None,
-                'duplicate_flg': test_mode,
-                'note': row['statement_note'],
-                'request_credit_flg': None,
-                'credit_request_dt': None,
-                'credit_request_cd': None,
-                'days_overbilled': None
-            }
-
-            load_data.append(PharmacyInvoice(**record))
-        except Exception as e:
-            print(traceback.format_exc(), file=log_file)
-            result = False
-
-    return result, load_data
-
-
-def _process_row_pharmerica_email(invoice_data, invoice_batch_log_id, pharmacy_id, facility_id, invoice_dt, source, log_file, test_mode=False):
-    result = True
-    load_data = []
-
-    for row in invoice_data:
-        try:
-            first_nm = get_first_name(row['resident_nm'])
-            last_nm = get_last_name(row['resident_nm'])
-            payer_group_id = get_payer_group(pharmacy_id, row['fin_plan'], source)
-            ssn = row['res_ssn'][:3]+row['res_ssn'][4:6]+row['res_ssn'][7:11] if row['res_ssn'] and row['res_ssn'][0] != '_' else ''
-
-            record = {
-                'invoice_batch_id': invoice_batch_log_id,
-                'pharmacy_id': pharmacy_id,
-                'facility_id': facility_id,
-                'payer_group_id': payer_group_id,
-                'invoice_dt': invoice_dt,
-                'first_nm': first_nm,
-                'last_nm': last_nm,
-                'ssn': ssn,
-                'dob': None,
-                'gender': None,
-                'dispense_dt': row['service_dt'],
-                'product_category': ((row['product_category'] or '') + (row['sales_type'] or '')) or None,
-                'drug_nm': row['trans_desc'],
-                'doctor': row['doctor_nm'],
-                'rx_nbr': row['rx_nbr'],
-                'ndc': row['ndc_nbr'],
-                'reject_cd': None,
-                'quantity': row['quantity'],
-                'days_supplied': row['days_supply'],
-                'charge_amt': row['amount_due'],
-                'copay_amt': None,
-                'copay_flg': None,
-                'census_match_cd': None,
-                'status_cd': None,
-                'charge_confirmed_flg': None,
-                'duplicate_flg': test_mode,
-                'note': row['task_manager_notes'],
-                'request_credit_flg': None,
-                'credit_request_dt': None,
-                'credit_request_cd': None,
-                'days_overbilled': None
-            }
-
-            load_data.append(PharmacyInvoice(**record))
-        except Exception as e:
-            print(traceback.format_exc(), file=log_file)
-            result = False
-
-    return result, load_data
-
-
-def _process_row_pharmerica_portal(invoice_data, invoice_batch_log_id, pharmacy_id, facility_id, invoice_dt, source, log_file, test_mode=False):
-    result = True
-    load_data = []
+def process_file(file_name, test_mode=False, force=False):
+    # validate and load one invoice; returns the outcome, its log and the email text.
+    # force loads the file even if it is the one the month was last loaded from
+    try:
+        result, log_file, invoice_info = validate_file(file_name, test_mode, force)
+        if result and invoice_info is None:
+            email_body = 'Already loaded, skipped'
+        elif result:
+            result = process_invoice(invoice_info, log_file, test_mode)
+            email_body = 'Uploaded successfully' if result else 'Insertion failed'
+        else:
+            email_body = 'Validation failed'
+            # failures are often config problems; see fixes on the next try
+            invalidate_reference_cache()
+    finally:
+        # a fresh session (and identity map) for every invoice
+        session.remove()
 
-    for row in invoice_data:
-        try:
-            first_nm = get_first_name(row['resident_nm'])
-            last_nm = get_last_name(row['resident_nm'])
-            payer_group_id = get_payer_group(pharmacy_id, row['fin_plan'], source)
-            ssn = row['res_ssn'][:3]+row['res_ssn'][4:6]+row['res_ssn'][7:11] if row['res_ssn'] and row['res_ssn'][0] != '_' else ''
-
-            record = {
-                'invoice_batch_id': invoice_batch_log_id,
-                'pharmacy_id': pharmacy_id,
-                'facility_id': facility_id,
-                'payer_group_id': payer_group_id,
-                'invoice_dt': invoice_dt,
-                'first_nm': first_nm,
-                'last_nm': last_nm,
-                'ssn': ssn,
-                'dob': None,
-                'gender': None,
-                'dispense_dt': row['service_dt'],
-                'product_category': row['product_category'],
-                'drug_nm': row['trans_desc'],
-                'doctor': row['doctor_nm'],
-                'rx_nbr': math.floor(row['rx_nbr']),
-                'ndc': row['ndc_nbr'],
-                'reject_cd': None,
-                'quantity': row['quantity'],
-                'days_supplied': row['days_supply'],
-                'charge_amt': row['trans_amount'],
-                'copay_amt': None,
-                'copay_flg': None,
-                'census_match_cd': None,
-                'status_cd': None,
-                'charge_confirmed_flg': None,
-                'duplicate_flg': test_mode,
-                'note': row['task_manager_notes'],
-                'request_credit_flg': None,
-                'credit_request_dt': None,
-                'credit_request_cd': None,
-                'days_overbilled': None
-            }
-
-            load_data.append(PharmacyInvoice(**record))
-        except Exception as e:
-            print(traceback.format_exc(), file=log_file)
-            result = False
+    return result, log_file, email_body
 
-    return result, load_data
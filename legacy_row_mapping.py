@@ -0,0 +1,480 @@
+# The _process_row_* functions as they were before row_mapping.py replaced
+# them, unchanged: one PharmacyInvoice and one payer group query per row.
+# benchmark.py times them as the baseline of the compiled layouts; nothing
+# else imports this module.
+import math
+import traceback
+
+from utilities import *
+
+
+def _process_row_specialty_rx_email(invoice_data, invoice_batch_log_id, pharmacy_id, facility_id, invoice_dt, source, log_file, test_mode=False):
+    result = True
+    load_data = []
+
+    for row in invoice_data:
+        try:
+            first_nm = get_first_name(row['patient'])
+            last_nm = get_last_name(row['patient'])
+            payer_group_id = get_payer_group(pharmacy_id, row['invgrp'], source)
+            ssn = row['ssn_no'][:3]+row['ssn_no'][4:6]+row['ssn_no'][7:11] if row['ssn_no'] and row['ssn_no'][0] != '_' else 0
+
+            record = {
+                'invoice_batch_id': invoice_batch_log_id,
+                'pharmacy_id': pharmacy_id,
+                'facility_id': facility_id,
+                'payer_group_id': payer_group_id,
+                'invoice_dt': invoice_dt,
+                'first_nm': first_nm,
+                'last_nm': last_nm,
+                'ssn': ssn,
+                'dob': None,
+                'gender': None,
+                'dispense_dt': row['dispdt'],
+                'product_category': row['rx_otc'],
+                'drug_nm': row['drug'],
+                'doctor': None,
+                'rx_nbr': row['rx_no'],
+                'ndc': row['ndc'],
+                'reject_cd': None,
+                'quantity': row['qty'],
+                'days_supplied': row['ds'],
+                'charge_amt': row['billamt'],
+                'copay_amt': None,
+                'copay_flg': 'Y' if row['copay'].upper() == 'COPAY' else None,
+                'census_match_cd': None,
+                'status_cd': None,
+                'charge_confirmed_flg': None,
+                'duplicate_flg': test_mode,
+                'note': row['comment'],
+                'request_credit_flg': None,
+                'credit_request_dt': None,
+                'credit_request_cd': None,
+                'days_overbilled': None
+            }
+
+            load_data.append(PharmacyInvoice(**record))
+        except Exception as e:
+            print(traceback.format_exc(), file=log_file)
+            result = False
+
+    return result, load_data
+
+
+def _process_row_specialty_rx_portal(invoice_data, invoice_batch_log_id, pharmacy_id, facility_id, invoice_dt, source, log_file, test_mode=False):
+    result = True
+    load_data = []
+
+    for row in invoice_data:
+        try:
+            first_nm = get_first_name(row['resident'])
+            last_nm = get_last_name(row['resident'])
+            payer_group_id = get_payer_group(pharmacy_id, row['group'], source)
+
+            record = {
+                'invoice_batch_id': invoice_batch_log_id,
+                'pharmacy_id': pharmacy_id,
+                'facility_id': facility_id,
+                'payer_group_id': payer_group_id,
+                'invoice_dt': invoice_dt,
+                'first_nm': first_nm,
+                'last_nm': last_nm,
+                'ssn': None,
+                'dob': None,
+                'gender': None,
+                'dispense_dt': row['dispensed'],
+                'product_category': row['rx_type'],
+                'drug_nm': row['drug_nm'],
+                'doctor': None,
+                'rx_nbr': row['rx_no'],
+                'ndc': None,
+                'reject_cd': None,
+                'quantity': row['quantity'],
+                'days_supplied': row['days_supply'],
+                'charge_amt': row['amount'],
+                'copay_amt': None,
+                'copay_flg': 'Y' if row['is_a_copay'] and row['is_a_copay'].upper() == 'COPAY' else None,
+                'census_match_cd': None,
+                'status_cd': None,
+                'charge_confirmed_flg': None,
+                'duplicate_flg': test_mode,
+                'note': row['billing_comment'],
+                'request_credit_flg': None,
+                'credit_request_dt': None,
+                'credit_request_cd': None,
+                'days_overbilled': None
+            }
+
+            load_data.append(PharmacyInvoice(**record))
+        except Exception as e:
+            print(traceback.format_exc(), file=log_file)
+            result = False
+
+    return result, load_data
+
+
+def _process_row_pharmscripts_portal(invoice_data, invoice_batch_log_id, pharmacy_id, facility_id, invoice_dt, source, log_file, test_mode=False):
+    result = True
+    load_data = []
+
+    for row in invoice_data:
+        try:
+            first_nm = get_first_name(row['patient_nm'])
+            last_nm = get_last_name(row['patient_nm'])
+            payer_group_id = get_payer_group(pharmacy_id, row['inv_grp'], source)
+
+            record = {
+                'invoice_batch_id': invoice_batch_log_id,
+                'pharmacy_id': pharmacy_id,
+                'facility_id': facility_id,
+                'payer_group_id': payer_group_id,
+                'invoice_dt': invoice_dt,
+                'first_nm': first_nm,
+                'last_nm': last_nm,
+                'ssn': row['ssn'],
+                'dob': None,
+                'gender': 'M' if row['b_or_g'] == 'B' else 'F' if row['b_or_g'] == 'G' else None,
+                'dispense_dt': row['disp_dt'],
+                'product_category': row['rx_type'],
+                'drug_nm': row['drug'],
+                'doctor': row['physician'],
+                'rx_nbr': row['rx_no'],
+                'ndc': row['ndc'],
+                'reject_cd': None,
+                'quantity': row['qty'],
+                'days_supplied': row['ds'],
+                'charge_amt': row['bill'],
+                'copay_amt': None,
+                'copay_flg': 'Y' if row['copay'].upper() == 'Y' else None,
+                'census_match_cd': None,
+                'status_cd': None,
+                'charge_confirmed_flg': None,
+                'duplicate_flg': test_mode,
+                'note': row['billing_comment'],
+                'request_credit_flg': None,
+                'credit_request_dt': None,
+                'credit_request_cd': None
+            }
+
+            load_data.append(PharmacyInvoice(**record))
+        except Exception as e:
+            print(traceback.format_exc(), file=log_file)
+            result = False
+
+    return result, load_data
+
+
+def _process_row_pharmscripts_email(invoice_data, invoice_batch_log_id, pharmacy_id, facility_id, invoice_dt, source, log_file, test_mode=False):
+    result = True
+    load_data = []
+
+    for row in invoice_data:
+        try:
+            first_nm = get_first_name(row['patient'])
+            last_nm = get_last_name(row['patient'])
+            payer_group_id = get_payer_group(pharmacy_id, row['invoice_grp'], source)
+
+            record = {
+                'invoice_batch_id': invoice_batch_log_id,
+                'pharmacy_id': pharmacy_id,
+                'facility_id': facility_id,
+                'payer_group_id': payer_group_id,
+                'invoice_dt': invoice_dt,
+                'first_nm': first_nm,
+                'last_nm': last_nm,
+                'ssn': row['ssn'],
+                'dob': None,
+                'gender': 'M' if row['b_g'] == 'B' else 'F' if row['b_g'] == 'G' else None,
+                'dispense_dt': row['disp_dt'],
+                'product_category': row['otc_rx'],
+                'drug_nm': row['drug'],
+                'doctor': row['physician'],
+                'rx_nbr': row['rx_no'],
+                'ndc': row['ndc'],
+                'reject_cd': None,
+                'quantity': row['tot_qty_disp'],
+                'days_supplied': row['ds'],
+                'charge_amt': row['tot_bill_amt'],
+                'copay_amt': None,
+                'copay_flg': 'Y' if row['is_a_copay'].upper() == 'Y' else None,
+                'census_match_cd': None,
+                'status_cd': None,
+                'charge_confirmed_flg': None,
+                'duplicate_flg': test_mode,
+                'note': None,
+                'request_credit_flg': None,
+                'credit_request_dt': None,
+                'credit_request_cd': None,
+                'days_overbilled': None
+            }
+
+            load_data.append(PharmacyInvoice(**record))
+        except Exception as e:
+            print(traceback.format_exc(), file=log_file)
+            result = False
+
+    return result, load_data
+
+
+def _process_row_geriscript_general(invoice_data, invoice_batch_log_id, pharmacy_id, facility_id, invoice_dt, source, log_file, test_mode=False):
+    result = True
+    load_data = []
+
+    for row in invoice_data:
+        try:
+            first_nm = get_first_name(row['full_nm'])
+            last_nm = get_last_name(row['full_nm'])
+            payer_group_id = get_payer_group(pharmacy_id, row['invoice_grp'], None)
+            ssn = row['ssn'][:3]+row['ssn'][4:6]+row['ssn'][7:11] if row['ssn'] and row['ssn'][0] != '_' else ''
+
+            record = {
+                'invoice_batch_id': invoice_batch_log_id,
+                'pharmacy_id': pharmacy_id,
+                'facility_id': facility_id,
+                'payer_group_id': payer_group_id,
+                'invoice_dt': invoice_dt,
+                'first_nm': first_nm,
+                'last_nm': last_nm,
+                'ssn': ssn,
+                'dob': row['birth_date'],
+                'gender': row['sex'],
+                'dispense_dt': row['dispense_dt'],
+                'product_category': row['rx_otc'],
+                'drug_nm': row['drug_label_nm'],
+                'doctor': row['doctor'],
+                'rx_nbr': row['rx_no'],
+                'ndc': row['ndc'],
+                'reject_cd': None,
+                'quantity': row['qty'],
+                'days_supplied': row['days_supply'],
+                'charge_amt': row['bill_amt'],
+                'copay_amt': row['copay_amt'],
+                'copay_flg': 'Y' if row['copay_amt'] and float(row['copay_amt']) > 0 else None,
+                'census_match_cd': None,
+                'status_cd': None,
+                'charge_confirmed_flg': None,
+                'duplicate_flg': test_mode,
+                'note': row['billing_comment'],
+                'request_credit_flg': None,
+                'credit_request_dt': None,
+                'credit_request_cd': None,
+                'days_overbilled': None
+            }
+
+            load_data.append(PharmacyInvoice(**record))
+        except Exception as e:
+            print(traceback.format_exc(), file=log_file)
+            result = False
+
+    return result, load_data
+
+
+def _process_row_medwiz_general(invoice_data, invoice_batch_log_id, pharmacy_id, facility_id, invoice_dt, source, log_file, test_mode=False):
+    result = True
+    load_data = []
+
+    for row in invoice_data:
+        try:
+            first_nm = get_first_name(row['name'])
+            last_nm = get_last_name(row['name'])
+            payer_group_id = get_payer_group(pharmacy_id, row['invoice_group'], None)
+
+            record = {
+                'invoice_batch_id': invoice_batch_log_id,
+                'pharmacy_id': pharmacy_id,
+                'facility_id': facility_id,
+                'payer_group_id': payer_group_id,
+                'invoice_dt': invoice_dt,
+                'first_nm': first_nm,
+                'last_nm': last_nm,
+                'ssn': None,
+                'dob': None,
+                'gender': None,
+                'dispense_dt': row['dispense_date'],
+                'product_category': row['distribution_code'],
+                'drug_nm': row['description'],
+                'doctor': None,
+                'rx_nbr': row['rx_no'],
+                'ndc': row['ndc'],
+                'reject_cd': None,
+                'quantity': row['qty'],
+                'days_supplied': row['days_supply'],
+                'charge_amt': row['amount'],
+                'copay_amt': None,
+                'copay_flg': 'Y' if row['copay'].upper() == 'COPAY' else None,
+                'census_match_cd': None,
+                'status_cd': None,
+                'charge_confirmed_flg': None,
+                'duplicate_flg': test_mode,
+                'note': row['billing_comment'],
+                'request_credit_flg': None,
+                'credit_request_dt': None,
+                'credit_request_cd': None,
+                'days_overbilled': None
+            }
+
+            load_data.append(PharmacyInvoice(**record))
+        except Exception as e:
+            print(traceback.format_exc(), file=log_file)
+            result = False
+
+    return result, load_data
+
+
+def _process_row_omnicare_general(invoice_data, invoice_batch_log_id, pharmacy_id, facility_id, invoice_dt, source, log_file, test_mode=False):
+    result = True
+    load_data = []
+
+    for row in invoice_data:
+        try:
+            first_nm = row['patient_first_nm']
+            last_nm = row['patient_last_nm']
+            payer_group_id = get_payer_group(pharmacy_id, row['pay_type_description'], None)
+            ssn = row['patient_ssn'][:3]+row['patient_ssn'][4:6]+row['patient_ssn'][7:11] if row['patient_ssn'] and row['patient_ssn'][0] != '_' else ''
+
+            record = {
+                'invoice_batch_id': invoice_batch_log_id,
+                'pharmacy_id': pharmacy_id,
+                'facility_id': facility_id,
+                'payer_group_id': payer_group_id,
+                'invoice_dt': invoice_dt,
+                'first_nm': first_nm,
+                'last_nm': last_nm,
+                'ssn': ssn,
+                'dob': None,
+                'gender': None,
+                'dispense_dt': row['transaction_dt'],
+                'product_category': row['inventory_category'],
+                'drug_nm': row['description'],
+                'doctor': row['physician'],
+                'rx_nbr': row['rx'],
+                'ndc': row['ndc'],
+                'reject_cd': row['reject_codes'],
+                'quantity': row['qty'],
+                'days_supplied': row['days_supply'],
+                'charge_amt': row['amount'],
+                'copay_amt': row['amount'] if row['copay'] == 'copay' else None,
+                'copay_flg': 'Y' if row['copay'] == 'copay' else None,
+                'census_match_cd': None,
+                'status_cd': None,
+                'charge_confirmed_flg': None,
+                'duplicate_flg': test_mode,
+                'note': row['statement_note'],
+                'request_credit_flg': None,
+                'credit_request_dt': None,
+                'credit_request_cd': None,
+                'days_overbilled': None
+            }
+
+            load_data.append(PharmacyInvoice(**record))
+        except Exception as e:
+            print(traceback.format_exc(), file=log_file)
+            result = False
+
+    return result, load_data
+
+
+def _process_row_pharmerica_email(invoice_data, invoice_batch_log_id, pharmacy_id, facility_id, invoice_dt, source, log_file, test_mode=False):
+    result = True
+    load_data = []
+
+    for row in invoice_data:
+        try:
+            first_nm = get_first_name(row['resident_nm'])
+            last_nm = get_last_name(row['resident_nm'])
+            payer_group_id = get_payer_group(pharmacy_id, row['fin_plan'], source)
+            ssn = row['res_ssn'][:3]+row['res_ssn'][4:6]+row['res_ssn'][7:11] if row['res_ssn'] and row['res_ssn'][0] != '_' else ''
+
+            record = {
+                'invoice_batch_id': invoice_batch_log_id,
+                'pharmacy_id': pharmacy_id,
+                'facility_id': facility_id,
+                'payer_group_id': payer_group_id,
+                'invoice_dt': invoice_dt,
+                'first_nm': first_nm,
+                'last_nm': last_nm,
+                'ssn': ssn,
+                'dob': None,
+                'gender': None,
+                'dispense_dt': row['service_dt'],
+                'product_category': ((row['product_category'] or '') + (row['sales_type'] or '')) or None,
+                'drug_nm': row['trans_desc'],
+                'doctor': row['doctor_nm'],
+                'rx_nbr': row['rx_nbr'],
+                'ndc': row['ndc_nbr'],
+                'reject_cd': None,
+                'quantity': row['quantity'],
+                'days_supplied': row['days_supply'],
+                'charge_amt': row['amount_due'],
+                'copay_amt': None,
+                'copay_flg': None,
+                'census_match_cd': None,
+                'status_cd': None,
+                'charge_confirmed_flg': None,
+                'duplicate_flg': test_mode,
+                'note': row['task_manager_notes'],
+                'request_credit_flg': None,
+                'credit_request_dt': None,
+                'credit_request_cd': None,
+                'days_overbilled': None
+            }
+
+            load_data.append(PharmacyInvoice(**record))
+        except Exception as e:
+            print(traceback.format_exc(), file=log_file)
+            result = False
+
+    return result, load_data
+
+
+def _process_row_pharmerica_portal(invoice_data, invoice_batch_log_id, pharmacy_id, facility_id, invoice_dt, source, log_file, test_mode=False):
+    result = True
+    load_data = []
+
+    for row in invoice_data:
+        try:
+            first_nm = get_first_name(row['resident_nm'])
+            last_nm = get_last_name(row['resident_nm'])
+            payer_group_id = get_payer_group(pharmacy_id, row['fin_plan'], source)
+            ssn = row['res_ssn'][:3]+row['res_ssn'][4:6]+row['res_ssn'][7:11] if row['res_ssn'] and row['res_ssn'][0] != '_' else ''
+
+            record = {
+                'invoice_batch_id': invoice_batch_log_id,
+                'pharmacy_id': pharmacy_id,
+                'facility_id': facility_id,
+                'payer_group_id': payer_group_id,
+                'invoice_dt': invoice_dt,
+                'first_nm': first_nm,
+                'last_nm': last_nm,
+                'ssn': ssn,
+                'dob': None,
+                'gender': None,
+                'dispense_dt': row['service_dt'],
+                'product_category': row['product_category'],
+                'drug_nm': row['trans_desc'],
+                'doctor': row['doctor_nm'],
+                'rx_nbr': math.floor(row['rx_nbr']),
+                'ndc': row['ndc_nbr'],
+                'reject_cd': None,
+                'quantity': row['quantity'],
+                'days_supplied': row['days_supply'],
+                'charge_amt': row['trans_amount'],
+                'copay_amt': None,
+                'copay_flg': None,
+                'census_match_cd': None,
+                'status_cd': None,
+                'charge_confirmed_flg': None,
+                'duplicate_flg': test_mode,
+                'note': row['task_manager_notes'],
+                'request_credit_flg': None,
+                'credit_request_dt': None,
+                'credit_request_cd': None,
+                'days_overbilled': None
+            }
+
+            load_data.append(PharmacyInvoice(**record))
+        except Exception as e:
+            print(traceback.format_exc(), file=log_file)
+            result = False
+
+    return result, load_data
@@ -0,0 +1,301 @@
+import os
+import re
+import time
+import struct
+import hashlib
+import datetime
+import collections
+
+from sqlalchemy import MetaData, Table, select
+
+from models import *
+
+
+# orm: one PharmacyInvoice object per row (default)
+# bulk: plain tuples through a Core insert with fast_executemany
+# staging: like bulk, into a staging table in chunked commits; the month's
+# rows are then replaced in one short transaction (replace reloads only)
+# reader settings with a bulk_insert_sp_name always load through that procedure
+LOAD_MODE = os.getenv('LOAD_MODE', 'orm')
+LOAD_CHUNK_SIZE = int(os.getenv('LOAD_CHUNK_SIZE', 5000))
+# replace: delete the month's rows for the pharmacy and facility, then insert the invoice
+# diff: only delete the lines that are gone and insert the new ones
+RELOAD_MODE = os.getenv('RELOAD_MODE', 'replace')
+
+# columns filled by the row transformations, in insert order
+LOAD_COLUMNS = (
+    'invoice_batch_id',
+    'pharmacy_id',
+    'facility_id',
+    'payer_group_id',
+    'invoice_dt',
+    'first_nm',
+    'last_nm',
+    'ssn',
+    'dob',
+    'gender',
+    'dispense_dt',
+    'product_category',
+    'drug_nm',
+    'doctor',
+    'rx_nbr',
+    'ndc',
+    'reject_cd',
+    'quantity',
+    'days_supplied',
+    'charge_amt',
+    'copay_amt',
+    'copay_flg',
+    'census_match_cd',
+    'status_cd',
+    'charge_confirmed_flg',
+    'duplicate_flg',
+    'note',
+    'request_credit_flg',
+    'credit_request_dt',
+    'credit_request_cd',
+    'days_overbilled',
+)
+
+
+def _to_date(val):
+    return val.date() if isinstance(val, datetime.datetime) else val
+
+
+def _to_text(val):
+    if val is None or isinstance(val, str):
+        return val
+    if isinstance(val, bool):
+        return str(int(val))
+    return str(val)
+
+
+def _bind_converter(column):
+    # the raw cursor skips SQLAlchemy's type handling, so pass the driver
+    # the same values SQL Server would have converted implicitly
+    if isinstance(column.type, Date):
+        return _to_date
+    if isinstance(column.type, String):
+        return _to_text
+
+
+def get_row_converter(table=PharmacyInvoice.__table__, columns=LOAD_COLUMNS):
+    # converts rows whose values follow `columns`
+    converters = [_bind_converter(table.c[column]) for column in columns]
+
+    def convert(row):
+        return tuple(to_bind(val) if to_bind else val for to_bind, val in zip(converters, row))
+
+    return convert
+
+
+# what identifies an invoice line: everything but the batch it was loaded by
+HASH_COLUMNS = tuple(column for column in LOAD_COLUMNS if column != 'invoice_batch_id')
+
+
+def _to_real(val):
+    return repr(struct.unpack('f', struct.pack('f', float(val)))[0])
+
+
+def _hash_converter(column):
+    # a value as the column stores it, so a new line and the same line read
+    # back from the table hash the same
+    if isinstance(column.type, MONEY):
+        return lambda val: f'{float(val):.4f}'
+    if isinstance(column.type, Float):
+        return _to_real if column.type.precision and column.type.precision <= 24 else lambda val: repr(float(val))
+    if isinstance(column.type, Integer):
+        return int
+    if isinstance(column.type, Date):
+        return lambda val: _to_date(val).isoformat()
+    if isinstance(column.type, String):
+        return _to_text
+    return repr
+
+
+def get_line_hasher(table=PharmacyInvoice.__table__, columns=HASH_COLUMNS):
+    # content hash of a row whose values follow `columns`
+    converters = [_hash_converter(table.c[column]) for column in columns]
+
+    def to_hash(convert, val):
+        if val is None:
+            return None
+        try:
+            return convert(val)
+        except (TypeError, ValueError) as e:
+            # stored values always convert, so this never matches one
+            return ('raw', repr(val))
+
+    def line_hash(row):
+        return hashlib.sha1(repr([to_hash(convert, val) for convert, val in zip(converters, row)]).encode()).digest()
+
+    return line_hash
+
+
+def diff_invoice_lines(rows, filters, log_file, chunk_size=LOAD_CHUNK_SIZE):
+    """Deletes the stored lines matching `filters` that are not in `rows`.
+
+    Returns the rows that are not stored yet, to be inserted. Lines are
+    compared by content hash; an invoice can have the same line more than
+    once, so hashes are matched as many times as they occur.
+    """
+    line_hash = get_line_hasher()
+    hash_indexes = [LOAD_COLUMNS.index(column) for column in HASH_COLUMNS]
+
+    stored = collections.defaultdict(list)
+    query = session.query(PharmacyInvoice.id, *[PharmacyInvoice.__table__.c[column] for column in HASH_COLUMNS]).filter(*filters)
+    for line in query.yield_per(chunk_size):
+        stored[line_hash(line[1:])].append(line[0])
+
+    new_rows = []
+    unchanged = 0
+    for row in rows:
+        ids = stored.get(line_hash([row[idx] for idx in hash_indexes]))
+        if ids:
+            ids.pop()
+            unchanged += 1
+        else:
+            new_rows.append(row)
+
+    # stay well under SQL Server's 2100 parameters per statement
+    removed = [id for ids in stored.values() for id in ids]
+    for chunk in chunked(removed, 1000):
+        session.query(PharmacyInvoice).filter(PharmacyInvoice.id.in_(chunk)).delete(synchronize_session=False)
+
+    print(f"Diff reload: {len(new_rows)} inserted, {len(removed)} deleted, {unchanged} unchanged", file=log_file)
+    return new_rows
+
+
+def get_insert_statement(connection, table=PharmacyInvoice.__table__, columns=LOAD_COLUMNS):
+    return str(table.insert().compile(dialect=connection.dialect, column_keys=list(columns)))
+
+
+def chunked(rows, size):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def bulk_insert_invoices(rows, log_file, chunk_size=LOAD_CHUNK_SIZE, table=PharmacyInvoice.__table__):
+    # runs on the session's connection, so it is part of the same transaction
+    connection = session.connection()
+    statement = get_insert_statement(connection, table)
+    convert = get_row_converter(table)
+    cursor = connection.connection.cursor()
+    if connection.dialect.driver == 'pyodbc':
+        cursor.fast_executemany = True
+
+    total = 0
+    try:
+        for chunk_no, chunk in enumerate(chunked(rows, chunk_size), 1):
+            chunk = [convert(row) for row in chunk]
+            started = time.perf_counter()
+            cursor.executemany(statement, chunk)
+            elapsed = max(time.perf_counter() - started, 1e-6)
+            total += len(chunk)
+            print(f"Inserted chunk {chunk_no}: {len(chunk)} rows in {elapsed:.2f}s ({len(chunk) / elapsed:.0f} rows/s)", file=log_file)
+    finally:
+        cursor.close()
+
+    return total
+
+
+def execute_bulk_insert_sp(cursor, sp_name, invoice_batch_log_id, rows):
+    # the procedure takes the batch id and the whole invoice as one
+    # table-valued parameter whose columns follow LOAD_COLUMNS
+    if not re.match(r'^[\w.\[\]]+$', sp_name):
+        raise ValueError(f"Invalid stored procedure name: {sp_name}")
+
+    cursor.execute(f"{{CALL {sp_name} (?, ?)}}", (invoice_batch_log_id, rows))
+
+
+def call_bulk_insert_sp(sp_name, invoice_batch_log_id, rows, log_file):
+    convert = get_row_converter()
+    rows = [convert(row) for row in rows]
+    if not rows:
+        print(f"No rows to load through {sp_name}", file=log_file)
+        return 0
+
+    # runs on the session's connection, so it is part of the same transaction
+    cursor = session.connection().connection.cursor()
+    try:
+        started = time.perf_counter()
+        execute_bulk_insert_sp(cursor, sp_name, invoice_batch_log_id, rows)
+        elapsed = max(time.perf_counter() - started, 1e-6)
+        print(f"Loaded {len(rows)} rows through {sp_name} in {elapsed:.2f}s ({len(rows) / elapsed:.0f} rows/s)", file=log_file)
+    finally:
+        cursor.close()
+
+    return len(rows)
+
+
+# rows of invoices being loaded, by invoice_batch_id; not one of the
+# reflected models, migrations/002_pharmacy_invoices_staging.sql creates it
+STAGING_TABLE = Table(
+    'pharmacy_invoices_staging', MetaData(),
+    Column('id', Integer, primary_key=True),
+    *[Column(column, PharmacyInvoice.__table__.c[column].type, nullable=PharmacyInvoice.__table__.c[column].nullable) for column in LOAD_COLUMNS],
+    Index('ix_pharmacy_invoices_staging_batch', 'invoice_batch_id')
+)
+
+
+def stage_invoices(rows, log_file, chunk_size=LOAD_CHUNK_SIZE):
+    """Inserts rows into STAGING_TABLE on a connection of its own, committing every chunk.
+
+    Nothing of pharmacy_invoices is locked while the rows are loaded.
+    """
+    with engine.connect() as connection:
+        statement = get_insert_statement(connection, STAGING_TABLE)
+        convert = get_row_converter(STAGING_TABLE)
+        dbapi_connection = connection.connection
+        cursor = dbapi_connection.cursor()
+        if connection.dialect.driver == 'pyodbc':
+            cursor.fast_executemany = True
+
+        total = 0
+        try:
+            for chunk_no, chunk in enumerate(chunked(rows, chunk_size), 1):
+                chunk = [convert(row) for row in chunk]
+                started = time.perf_counter()
+                cursor.executemany(statement, chunk)
+                dbapi_connection.commit()
+                elapsed = max(time.perf_counter() - started, 1e-6)
+                total += len(chunk)
+                print(f"Staged chunk {chunk_no}: {len(chunk)} rows in {elapsed:.2f}s ({len(chunk) / elapsed:.0f} rows/s)", file=log_file)
+        finally:
+            cursor.close()
+
+    return total
+
+
+def swap_staged_invoices(invoice_batch_id, filters, log_file):
+    """Replaces the rows matching `filters` with the batch's staged rows, in one transaction.
+
+    Set based: one DELETE, one INSERT ... SELECT from the staging table and
+    the cleanup of the staged rows. The caller commits; the locks are held
+    until then. Returns the rows moved in.
+    """
+    staged = select(*[STAGING_TABLE.c[column] for column in LOAD_COLUMNS]).where(STAGING_TABLE.c.invoice_batch_id==invoice_batch_id)
+
+    deleted = session.query(PharmacyInvoice).filter(*filters).delete(synchronize_session=False)
+    moved = session.execute(PharmacyInvoice.__table__.insert().from_select(LOAD_COLUMNS, staged)).rowcount
+    session.execute(STAGING_TABLE.delete().where(STAGING_TABLE.c.invoice_batch_id==invoice_batch_id))
+
+    print(f"Swapped in batch {invoice_batch_id}: {deleted} rows deleted, {moved} moved in", file=log_file)
+    return moved
+
+
+def discard_staged_invoices(invoice_batch_id, log_file):
+    # after a failed load; pharmacy_invoices was never touched
+    try:
+        with engine.begin() as connection:
+            removed = connection.execute(STAGING_TABLE.delete().where(STAGING_TABLE.c.invoice_batch_id==invoice_batch_id)).rowcount
+    except Exception as e:
+        print(f"Staged rows of batch {invoice_batch_id} not discarded:", e, file=log_file)
+        return
+    print(f"Discarded {removed} staged rows of batch {invoice_batch_id}", file=log_file)
@@ -0,0 +1,5 @@
+-- fingerprint of the file a batch was loaded from; validate_file skips a
+-- file that is the month's last successful load (models.InvoiceBatchLog)
+IF COL_LENGTH('invoice_batch_logs', 'file_fingerprint') IS NULL
+    ALTER TABLE invoice_batch_logs ADD file_fingerprint varchar(64) COLLATE SQL_Latin1_General_CP1_CI_AS NULL;
+GO
@@ -0,0 +1,43 @@
+-- rows of invoices being loaded, by invoice_batch_id; stage_invoices fills it
+-- and swap_staged_invoices moves a batch into pharmacy_invoices
+-- (loaders.STAGING_TABLE)
+IF OBJECT_ID('pharmacy_invoices_staging', 'U') IS NULL
+BEGIN
+    CREATE TABLE pharmacy_invoices_staging (
+        id int IDENTITY NOT NULL,
+        invoice_batch_id int NOT NULL,
+        pharmacy_id int NOT NULL,
+        facility_id int NOT NULL,
+        payer_group_id int NOT NULL,
+        invoice_dt datetime NOT NULL,
+        first_nm varchar(25) COLLATE SQL_Latin1_General_CP1_CI_AS NULL,
+        last_nm varchar(25) COLLATE SQL_Latin1_General_CP1_CI_AS NOT NULL,
+        ssn varchar(10) COLLATE SQL_Latin1_General_CP1_CI_AS NULL,
+        dob datetime NULL,
+        gender char(1) COLLATE SQL_Latin1_General_CP1_CI_AS NULL,
+        dispense_dt datetime NULL,
+        product_category varchar(150) COLLATE SQL_Latin1_General_CP1_CI_AS NULL,
+        drug_nm varchar(150) COLLATE SQL_Latin1_General_CP1_CI_AS NOT NULL,
+        doctor varchar(30) COLLATE SQL_Latin1_General_CP1_CI_AS NULL,
+        rx_nbr int NULL,
+        ndc varchar(50) COLLATE SQL_Latin1_General_CP1_CI_AS NULL,
+        reject_cd varchar(150) COLLATE SQL_Latin1_General_CP1_CI_AS NULL,
+        quantity real NULL,
+        days_supplied real NULL,
+        charge_amt money NOT NULL,
+        copay_amt money NULL,
+        copay_flg char(1) COLLATE SQL_Latin1_General_CP1_CI_AS NULL,
+        census_match_cd varchar(10) COLLATE SQL_Latin1_General_CP1_CI_AS NULL,
+        status_cd varchar(10) COLLATE SQL_Latin1_General_CP1_CI_AS NULL,
+        charge_confirmed_flg char(1) COLLATE SQL_Latin1_General_CP1_CI_AS NULL,
+        duplicate_flg char(1) COLLATE SQL_Latin1_General_CP1_CI_AS NULL,
+        note varchar(500) COLLATE SQL_Latin1_General_CP1_CI_AS NULL,
+        request_credit_flg char(1) COLLATE SQL_Latin1_General_CP1_CI_AS NULL,
+        credit_request_dt datetime NULL,
+        credit_request_cd char(1) COLLATE SQL_Latin1_General_CP1_CI_AS NULL,
+        days_overbilled real NULL,
+        CONSTRAINT PK_pharmacy_invoices_staging PRIMARY KEY (id)
+    );
+    CREATE INDEX ix_pharmacy_invoices_staging_batch ON pharmacy_invoices_staging (invoice_batch_id);
+END
+GO
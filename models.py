@@ -4,16 +4,29 @@ from sqlalchemy.dialects.mssql import BIT, MONEY, SMALLMONEY, TINYINT
 from sqlalchemy.orm import relationship
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import sessionmaker, scoped_session
 import os
 
 db_host = os.getenv('db_host')
 db_name = os.getenv('db_name')
 db_user = os.getenv('db_user')
 db_password = os.getenv('db_password')
-engine = create_engine(f'mssql+pyodbc://{db_user}:{db_password}@{db_host}/{db_name}?driver=ODBC+Driver+17+for+SQL+Server')
+db_url = os.getenv('db_url') or f'mssql+pyodbc://{db_user}:{db_password}@{db_host}/{db_name}?driver=ODBC+Driver+17+for+SQL+Server'
+
+engine_options = {}
+if not db_url.startswith('sqlite'):
+    engine_options = {
+        'pool_size': int(os.getenv('db_pool_size', 5)),
+        'max_overflow': int(os.getenv('db_max_overflow', 10)),
+        'pool_pre_ping': os.getenv('db_pool_pre_ping', 'true').lower() == 'true',
+        'pool_recycle': int(os.getenv('db_pool_recycle', 3600)),
+    }
+
+engine = create_engine(db_url, **engine_options)
 Session = sessionmaker(bind=engine)
-session = Session()
+# one session per thread (and per worker process); jobs call
+# session.remove() when done so nothing is kept between invoices
+session = scoped_session(Session)
 
 Base = declarative_base()
 
@@ -74,6 +87,7 @@ class InvoiceBatchLog(Base):
     status_cd = Column(TINYINT, nullable=False, server_default=text("((1))"))
     source = Column(TINYINT, server_default=text("((0))"))
     raw_invoice_table_nm = Column(String(80, 'SQL_Latin1_General_CP1_CI_AS'))
+    file_fingerprint = Column(String(64, 'SQL_Latin1_General_CP1_CI_AS'))
 
 
 class InvoiceSource(Base):
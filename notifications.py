@@ -0,0 +1,117 @@
+import os
+import html
+import time
+import email
+import queue
+import datetime
+import threading
+import traceback
+
+from utilities import send_email
+
+
+# files waiting for their email; the poll loop blocks once it is full
+NOTIFY_QUEUE_SIZE = int(os.getenv('NOTIFY_QUEUE_SIZE', 1000))
+NOTIFY_MAX_ATTEMPTS = int(os.getenv('NOTIFY_MAX_ATTEMPTS', 5))
+NOTIFY_BACKOFF_SECONDS = float(os.getenv('NOTIFY_BACKOFF_SECONDS', 1))
+# results within this many seconds go out as one digest; 0 sends an email per file
+NOTIFY_DIGEST_SECONDS = float(os.getenv('NOTIFY_DIGEST_SECONDS', 0))
+
+
+class LocalSesClient:
+    """Stands in for the SES client; keeps the messages instead of sending them."""
+
+    def __init__(self, failures=0):
+        # the first `failures` calls raise, as a throttled SES would
+        self.failures = failures
+        self.calls = 0
+        self.messages = []
+
+    def send_raw_email(self, Source, Destinations, RawMessage):
+        self.calls += 1
+        if self.calls <= self.failures:
+            raise Exception("Rate exceeded")
+        self.messages.append(email.message_from_string(RawMessage['Data']))
+        return {'MessageId': str(len(self.messages))}
+
+
+class NotificationDispatcher:
+    """Sends the result emails of processed files on a background thread.
+
+    notify() only queues the result, so a slow or throttled SES never holds
+    up the poll loop. Failed sends are retried with exponential backoff.
+    With `digest_seconds` set, the results that come in within that window
+    go out as one email with a table of the files; the logs of files that
+    didn't upload are attached.
+    """
+
+    def __init__(self, from_email, to_emails, digest_seconds=NOTIFY_DIGEST_SECONDS, queue_size=NOTIFY_QUEUE_SIZE,
+                 max_attempts=NOTIFY_MAX_ATTEMPTS, backoff=NOTIFY_BACKOFF_SECONDS, ses_client=None):
+        self.from_email = from_email
+        self.to_emails = to_emails
+        self.digest_seconds = digest_seconds
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.ses_client = ses_client
+        self.sent = 0
+        self.failed = 0
+        self.queue = queue.Queue(queue_size)
+        self.thread = threading.Thread(target=self._run, name='notifications', daemon=True)
+        self.thread.start()
+
+    def notify(self, file_name, email_body, log_file, result=True):
+        self.queue.put((file_name, email_body, log_file, result, datetime.datetime.now()))
+
+    def close(self):
+        # sends whatever is queued (and the open digest) before returning
+        self.queue.put(None)
+        self.thread.join()
+
+    def _run(self):
+        pending = []
+        deadline = None
+        while True:
+            try:
+                item = self.queue.get(timeout=max(0, deadline - time.monotonic()) if pending else None)
+            except queue.Empty as e:
+                item = False
+
+            if item:
+                if not self.digest_seconds:
+                    self._send_result(item)
+                    continue
+                if not pending:
+                    deadline = time.monotonic() + self.digest_seconds
+                pending.append(item)
+
+            if pending and (item is None or time.monotonic() >= deadline):
+                self._send_digest(pending)
+                pending = []
+            if item is None:
+                return
+
+    def _send_result(self, item):
+        file_name, email_body, log_file, result, finished = item
+        self._send(f'Invoice Uploaded Successfully ({file_name})', email_body, log_file)
+
+    def _send_digest(self, items):
+        failed = [item for item in items if not item[3]]
+        subject = f'Invoice uploads: {len(items)} files, {len(failed)} failed'
+        rows = ''.join(
+            f'<tr><td>{finished:%Y-%m-%d %H:%M:%S}</td><td>{html.escape(file_name)}</td><td>{html.escape(email_body)}</td></tr>'
+            for file_name, email_body, log_file, result, finished in items)
+        body = f'<table border="1"><tr><th>Finished</th><th>File</th><th>Result</th></tr>{rows}</table>'
+        self._send(subject, body, [item[2] for item in failed if item[2]])
+
+    def _send(self, subject, body, attachment):
+        for attempt in range(self.max_attempts):
+            try:
+                send_email(subject, self.from_email, self.to_emails, body, attachment, ses_client=self.ses_client)
+                self.sent += 1
+                return
+            except Exception as e:
+                if attempt + 1 == self.max_attempts:
+                    self.failed += 1
+                    print('Email not sent:', subject, '\n', traceback.format_exc())
+                    return
+                time.sleep(self.backoff * 2 ** attempt)
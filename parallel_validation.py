@@ -0,0 +1,170 @@
+import os
+import copy
+import itertools
+import collections
+import multiprocessing
+import multiprocessing.util
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from utilities import *
+from loaders import chunked
+from frame_validation import validate_frame
+
+
+# invoices with at least this many rows are validated on a process pool
+PARALLEL_VALIDATION_MIN_ROWS = int(os.getenv('PARALLEL_VALIDATION_MIN_ROWS', 50000))
+VALIDATION_CHUNK_ROWS = int(os.getenv('VALIDATION_CHUNK_ROWS', 10000))
+# 1 validates in the invoice's own process. The poller and the backfill
+# already run an invoice per worker process, so more than cpu_count // WORKERS
+# only makes the processes compete for the same cores.
+VALIDATION_WORKERS = int(os.getenv('VALIDATION_WORKERS', 1))
+
+# the pool of this process, started on first use and kept for later invoices
+_pool = None
+_pool_workers = 0
+_plan_ids = itertools.count()
+
+# in a pool worker: the plan of the invoice it got the last chunk of
+_plan_id = None
+_plan = None
+
+
+def _get_pool(workers):
+    global _pool, _pool_workers
+    if _pool is None or _pool_workers != workers:
+        if _pool:
+            _pool.shutdown()
+        # spawned, not forked: the process this runs in has threads of its
+        # own (the download prefetch) and may be a pool worker itself
+        _pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+        _pool_workers = workers
+        # a pool worker exits through multiprocessing, which joins its child
+        # processes but never runs the atexit hook that stops this pool; this
+        # runs first, before the pool's queues are closed (priority 10)
+        multiprocessing.util.Finalize(None, _pool.shutdown, exitpriority=20)
+
+    return _pool
+
+
+def _get_plan(plan_id, entries):
+    # compiled once per invoice and worker
+    global _plan_id, _plan
+    if plan_id != _plan_id:
+        _plan = [
+            (field_name, column_name, idx, memoize_field(compile_field(field, date_parser), date_parser), required, date_parser, field)
+            for field_name, column_name, idx, required, date_parser, field in entries
+        ]
+        _plan_id = plan_id
+
+    return _plan
+
+
+def _validate_chunk(plan_id, entries, rows):
+    # counters are per chunk; the memos keep their values across chunks
+    plan = _get_plan(plan_id, entries)
+    errors = ErrorCollector()
+    for entry in plan:
+        if entry[5]:
+            entry[5].fast = entry[5].fallback = 0
+        if isinstance(entry[3], FieldMemo):
+            entry[3].hits = entry[3].misses = 0
+    result, data = validate_frame(plan, rows, errors)
+
+    return result, data, errors, [(
+        (entry[5].fast, entry[5].fallback) if entry[5] else None,
+        (entry[3].hits, entry[3].misses) if isinstance(entry[3], FieldMemo) else None
+    ) for entry in plan]
+
+
+def _worker_entries(plan):
+    # what a worker needs to compile the plan again: the field definitions
+    # (detached from the session) and the date formats learned so far
+    entries = []
+    for field_name, column_name, idx, validate, required, date_parser, field in plan:
+        field = RawInvoiceField(
+            field_name=field.field_name,
+            sheet_column_name=field.sheet_column_name,
+            field_type=field.field_type,
+            field_validations=field.field_validations,
+            is_optional=field.is_optional)
+        entries.append((field_name, column_name, idx, required, copy.copy(date_parser), field))
+
+    return entries
+
+
+def _learning_dates(plan):
+    # indexes of the date columns still learning their format; their values
+    # depend on the values before them, so they are validated here, in order
+    return [idx for field_name, column_name, idx, validate, required, date_parser, field in plan
+            if date_parser and date_parser.samples < date_parser.sample_size and idx is not None]
+
+
+def _has_values(rows, idxs):
+    return any(idx < len(row) and clean_text(row[idx]) for row_no, row in rows for idx in idxs)
+
+
+def validate_parallel(plan, rows, errors, workers=VALIDATION_WORKERS, chunk_rows=VALIDATION_CHUNK_ROWS, min_rows=PARALLEL_VALIDATION_MIN_ROWS):
+    """Validates rows of (row_no, values) like validate_frame, in chunks on a process pool.
+
+    Rows are read a chunk at a time and at most two chunks per worker are
+    held at once. The first chunk, and any chunk with values in a column
+    that was still learning its date format, is validated here, so formats
+    are learned from the same values as in one pass. Chunk results are
+    merged in row order; the data, errors and date format counters are the
+    same as validate_frame's; the memo counters of the plan include the
+    workers'.
+    """
+    rows = iter(rows)
+    head = list(itertools.islice(rows, min_rows))
+    if len(head) < min_rows:
+        return validate_frame(plan, head, errors)
+
+    chunks = chunked(itertools.chain(head, rows), chunk_rows)
+    result, data = validate_frame(plan, next(chunks, []), errors)
+    learning = _learning_dates(plan)
+    if workers < 2:
+        for chunk in chunks:
+            _result, _data = validate_frame(plan, chunk, errors)
+            result = result and _result
+            data.extend(_data)
+        return result, data
+
+    def merge(future):
+        nonlocal result
+        _result, _data, _errors, counters = future.result()
+        result = result and _result
+        data.extend(_data)
+        errors.update(_errors)
+        for entry, (dates, memo) in zip(plan, counters):
+            if dates:
+                entry[5].fast += dates[0]
+                entry[5].fallback += dates[1]
+            if memo and isinstance(entry[3], FieldMemo):
+                entry[3].hits += memo[0]
+                entry[3].misses += memo[1]
+
+    global _pool
+    pool = _get_pool(workers)
+    plan_id, entries = next(_plan_ids), _worker_entries(plan)
+    pending = collections.deque()
+    try:
+        for chunk in chunks:
+            if learning and _has_values(chunk, learning):
+                while pending:
+                    merge(pending.popleft())
+                _result, _data = validate_frame(plan, chunk, errors)
+                result = result and _result
+                data.extend(_data)
+                continue
+            pending.append(pool.submit(_validate_chunk, plan_id, entries, chunk))
+            if len(pending) >= 2 * workers:
+                merge(pending.popleft())
+        while pending:
+            merge(pending.popleft())
+    except BrokenProcessPool as e:
+        # a worker died; the next invoice gets a new pool
+        _pool = None
+        raise
+
+    return result, data
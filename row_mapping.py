@@ -0,0 +1,307 @@
+import os
+import math
+import linecache
+import traceback
+import collections
+
+from utilities import get_first_name, get_last_name
+from loaders import LOAD_COLUMNS
+
+
+# Every pharmacy/source layout is declared once: target column <- source
+# field + transform. A transform is the python expression computing the
+# column from `row`, the cleaned data of one invoice row. Columns that are
+# not listed are NULL; the invoice level columns come from the batch.
+Layout = collections.namedtuple('Layout', 'payer_group_field by_source columns')
+
+INVOICE_COLUMNS = ('invoice_batch_id', 'pharmacy_id', 'facility_id', 'invoice_dt', 'duplicate_flg')
+
+GENDERS = {'B': 'M', 'G': 'F'}
+
+# tracebacks logged for each exception type when rows fail to map
+MAPPING_TRACEBACKS = int(os.getenv('MAPPING_TRACEBACKS', 3))
+
+
+class PayerGroupIds(dict):
+    # invoice group -> payer_group_id; each distinct group is resolved once
+    def __init__(self, payer_groups, source):
+        self.payer_groups = payer_groups
+        self.source = source
+
+    def __missing__(self, inv_grp):
+        payer_group_id = self[inv_grp] = self.payer_groups.resolve(inv_grp, self.source)
+        return payer_group_id
+
+
+def ssn_digits(ssn, blank):
+    return ssn[:3]+ssn[4:6]+ssn[7:11] if ssn and ssn[0] != '_' else blank
+
+
+def field(name):
+    return f'row[{name!r}]'
+
+
+def first_name(name):
+    return f'get_first_name({field(name)})'
+
+
+def last_name(name):
+    return f'get_last_name({field(name)})'
+
+
+def ssn(name, blank=''):
+    return f'ssn_digits({field(name)}, {blank!r})'
+
+
+def gender(name):
+    # B(oy) or G(irl)
+    return f'GENDERS.get({field(name)})'
+
+
+def copay_flag(name, value, allow_empty=False):
+    check = f'{field(name)}.upper() == {value!r}'
+    if allow_empty:
+        check = f'{field(name)} and {check}'
+    return f"('Y' if {check} else None)"
+
+
+def positive_flag(name):
+    return f"('Y' if {field(name)} and float({field(name)}) > 0 else None)"
+
+
+def when_equals(name, value, then):
+    return f'({then} if {field(name)} == {value!r} else None)'
+
+
+def floor(name):
+    return f'math.floor({field(name)})'
+
+
+def concat(*names):
+    return '((' + ' + '.join(f"({field(name)} or '')" for name in names) + ') or None)'
+
+
+LAYOUTS = {
+    'specialty_rx_email': Layout('invgrp', True, {
+        'first_nm': first_name('patient'),
+        'last_nm': last_name('patient'),
+        'ssn': ssn('ssn_no', 0),
+        'dispense_dt': field('dispdt'),
+        'product_category': field('rx_otc'),
+        'drug_nm': field('drug'),
+        'rx_nbr': field('rx_no'),
+        'ndc': field('ndc'),
+        'quantity': field('qty'),
+        'days_supplied': field('ds'),
+        'charge_amt': field('billamt'),
+        'copay_flg': copay_flag('copay', 'COPAY'),
+        'note': field('comment'),
+    }),
+    'specialty_rx_portal': Layout('group', True, {
+        'first_nm': first_name('resident'),
+        'last_nm': last_name('resident'),
+        'dispense_dt': field('dispensed'),
+        'product_category': field('rx_type'),
+        'drug_nm': field('drug_nm'),
+        'rx_nbr': field('rx_no'),
+        'quantity': field('quantity'),
+        'days_supplied': field('days_supply'),
+        'charge_amt': field('amount'),
+        'copay_flg': copay_flag('is_a_copay', 'COPAY', allow_empty=True),
+        'note': field('billing_comment'),
+    }),
+    'pharmscripts_portal': Layout('inv_grp', True, {
+        'first_nm': first_name('patient_nm'),
+        'last_nm': last_name('patient_nm'),
+        'ssn': field('ssn'),
+        'gender': gender('b_or_g'),
+        'dispense_dt': field('disp_dt'),
+        'product_category': field('rx_type'),
+        'drug_nm': field('drug'),
+        'doctor': field('physician'),
+        'rx_nbr': field('rx_no'),
+        'ndc': field('ndc'),
+        'quantity': field('qty'),
+        'days_supplied': field('ds'),
+        'charge_amt': field('bill'),
+        'copay_flg': copay_flag('copay', 'Y'),
+        'note': field('billing_comment'),
+    }),
+    'pharmscripts_email': Layout('invoice_grp', True, {
+        'first_nm': first_name('patient'),
+        'last_nm': last_name('patient'),
+        'ssn': field('ssn'),
+        'gender': gender('b_g'),
+        'dispense_dt': field('disp_dt'),
+        'product_category': field('otc_rx'),
+        'drug_nm': field('drug'),
+        'doctor': field('physician'),
+        'rx_nbr': field('rx_no'),
+        'ndc': field('ndc'),
+        'quantity': field('tot_qty_disp'),
+        'days_supplied': field('ds'),
+        'charge_amt': field('tot_bill_amt'),
+        'copay_flg': copay_flag('is_a_copay', 'Y'),
+    }),
+    'geriscript_general': Layout('invoice_grp', False, {
+        'first_nm': first_name('full_nm'),
+        'last_nm': last_name('full_nm'),
+        'ssn': ssn('ssn'),
+        'dob': field('birth_date'),
+        'gender': field('sex'),
+        'dispense_dt': field('dispense_dt'),
+        'product_category': field('rx_otc'),
+        'drug_nm': field('drug_label_nm'),
+        'doctor': field('doctor'),
+        'rx_nbr': field('rx_no'),
+        'ndc': field('ndc'),
+        'quantity': field('qty'),
+        'days_supplied': field('days_supply'),
+        'charge_amt': field('bill_amt'),
+        'copay_amt': field('copay_amt'),
+        'copay_flg': positive_flag('copay_amt'),
+        'note': field('billing_comment'),
+    }),
+    'medwiz_general': Layout('invoice_group', False, {
+        'first_nm': first_name('name'),
+        'last_nm': last_name('name'),
+        'dispense_dt': field('dispense_date'),
+        'product_category': field('distribution_code'),
+        'drug_nm': field('description'),
+        'rx_nbr': field('rx_no'),
+        'ndc': field('ndc'),
+        'quantity': field('qty'),
+        'days_supplied': field('days_supply'),
+        'charge_amt': field('amount'),
+        'copay_flg': copay_flag('copay', 'COPAY'),
+        'note': field('billing_comment'),
+    }),
+    'omnicare_general': Layout('pay_type_description', False, {
+        'first_nm': field('patient_first_nm'),
+        'last_nm': field('patient_last_nm'),
+        'ssn': ssn('patient_ssn'),
+        'dispense_dt': field('transaction_dt'),
+        'product_category': field('inventory_category'),
+        'drug_nm': field('description'),
+        'doctor': field('physician'),
+        'rx_nbr': field('rx'),
+        'ndc': field('ndc'),
+        'reject_cd': field('reject_codes'),
+        'quantity': field('qty'),
+        'days_supplied': field('days_supply'),
+        'charge_amt': field('amount'),
+        'copay_amt': when_equals('copay', 'copay', field('amount')),
+        'copay_flg': when_equals('copay', 'copay', "'Y'"),
+        'note': field('statement_note'),
+    }),
+    'pharmerica_email': Layout('fin_plan', True, {
+        'first_nm': first_name('resident_nm'),
+        'last_nm': last_name('resident_nm'),
+        'ssn': ssn('res_ssn'),
+        'dispense_dt': field('service_dt'),
+        'product_category': concat('product_category', 'sales_type'),
+        'drug_nm': field('trans_desc'),
+        'doctor': field('doctor_nm'),
+        'rx_nbr': field('rx_nbr'),
+        'ndc': field('ndc_nbr'),
+        'quantity': field('quantity'),
+        'days_supplied': field('days_supply'),
+        'charge_amt': field('amount_due'),
+        'note': field('task_manager_notes'),
+    }),
+    'pharmerica_portal': Layout('fin_plan', True, {
+        'first_nm': first_name('resident_nm'),
+        'last_nm': last_name('resident_nm'),
+        'ssn': ssn('res_ssn'),
+        'dispense_dt': field('service_dt'),
+        'product_category': field('product_category'),
+        'drug_nm': field('trans_desc'),
+        'doctor': field('doctor_nm'),
+        'rx_nbr': floor('rx_nbr'),
+        'ndc': field('ndc_nbr'),
+        'quantity': field('quantity'),
+        'days_supplied': field('days_supply'),
+        'charge_amt': field('trans_amount'),
+        'note': field('task_manager_notes'),
+    }),
+}
+
+_MAPPING_SOURCE = '''\
+def map_rows(rows, {args}):
+    return [{values} for row in rows]
+
+
+def map_row(row, {args}):
+    return {values}
+'''
+
+_compiled = {}
+
+
+def compile_layout(layout_name):
+    """Compile a layout into map_rows(rows, ...) and map_row(row, ...).
+
+    Both return tuples in LOAD_COLUMNS order. map_rows is a single list
+    comprehension with no per-row dict or exception handling; map_row maps
+    one row, for finding the rows map_rows failed on.
+    """
+    if layout_name not in _compiled:
+        layout = LAYOUTS[layout_name]
+        unknown = set(layout.columns) - set(LOAD_COLUMNS)
+        if unknown:
+            raise ValueError(f"Unknown columns in layout {layout_name}: {', '.join(sorted(unknown))}")
+
+        values = []
+        for column in LOAD_COLUMNS:
+            if column in INVOICE_COLUMNS:
+                values.append(column)
+            elif column == 'payer_group_id':
+                values.append(f'payer_group_ids[{field(layout.payer_group_field)}]')
+            else:
+                values.append(layout.columns.get(column, 'None'))
+
+        source = _MAPPING_SOURCE.format(
+            args=', '.join(INVOICE_COLUMNS + ('payer_group_ids',)),
+            values='(' + ', '.join(values) + ')')
+        # keep the source around so tracebacks in the log show the failing line
+        file_name = f'<layout {layout_name}>'
+        linecache.cache[file_name] = (len(source), None, source.splitlines(True), file_name)
+
+        namespace = {
+            'math': math,
+            'get_first_name': get_first_name,
+            'get_last_name': get_last_name,
+            'ssn_digits': ssn_digits,
+            'GENDERS': GENDERS,
+        }
+        exec(compile(source, file_name, 'exec'), namespace)
+        _compiled[layout_name] = (namespace['map_rows'], namespace['map_row'])
+
+    return _compiled[layout_name]
+
+
+def map_invoice(layout_name, invoice_data, invoice_batch_id, pharmacy_id, facility_id, invoice_dt, source, payer_groups, log_file, test_mode=False):
+    map_rows, map_row = compile_layout(layout_name)
+    payer_group_ids = PayerGroupIds(payer_groups, source if LAYOUTS[layout_name].by_source else None)
+    args = (invoice_batch_id, pharmacy_id, facility_id, invoice_dt, test_mode, payer_group_ids)
+
+    try:
+        return True, map_rows(invoice_data, *args)
+    except Exception as e:
+        pass
+
+    # every failing row is counted, the first few of each error get a traceback
+    failures = collections.Counter()
+    load_data = []
+    for row in invoice_data:
+        try:
+            load_data.append(map_row(row, *args))
+        except Exception as e:
+            failures[type(e).__name__] += 1
+            if failures[type(e).__name__] <= MAPPING_TRACEBACKS:
+                print(traceback.format_exc(), file=log_file)
+
+    for error, count in failures.most_common():
+        print(f"{error}: {count} rows", file=log_file)
+
+    return not failures, load_data
@@ -0,0 +1,233 @@
+import os
+import hashlib
+import datetime
+import tempfile
+
+import pyarrow as pa
+
+
+SHEET_CACHE_DIR = os.getenv('SHEET_CACHE_DIR', 'cache/sheets')
+# 0 turns the cache off
+SHEET_CACHE_MAX_BYTES = int(os.getenv('SHEET_CACHE_MAX_BYTES', 1024 * 1024 * 1024))
+# sheet rows per record batch; memory use of reads and writes is bounded by it
+SHEET_CACHE_BATCH_ROWS = int(os.getenv('SHEET_CACHE_BATCH_ROWS', 10000))
+# part of the file names, so files of an older layout are never read
+SHEET_CACHE_FORMAT = 2
+
+# python type of a cell value -> arrow type it is stored as
+CELL_TYPES = {
+    str: pa.string(),
+    bool: pa.bool_(),
+    int: pa.int64(),
+    float: pa.float64(),
+    datetime.datetime: pa.timestamp('us'),
+    datetime.date: pa.date32(),
+    datetime.time: pa.time64('us'),
+    datetime.timedelta: pa.duration('us'),
+}
+
+
+def get_sheet_schema(sheet_name):
+    # one arrow row per sheet row: its length, and for every cell type the
+    # column indexes and values of the cells of that type. The schema is
+    # the same for every sheet, so batches can be written as rows come in.
+    fields = [pa.field('length', pa.int32())]
+    for cell_type, arrow_type in CELL_TYPES.items():
+        fields.append(pa.field(f'{cell_type.__name__}:idx', pa.list_(pa.int32())))
+        fields.append(pa.field(f'{cell_type.__name__}', pa.list_(arrow_type)))
+    return pa.schema(fields, metadata={'sheet_name': sheet_name} if sheet_name is not None else None)
+
+
+def rows_to_batch(rows, schema):
+    lengths = []
+    offsets = {cell_type: [0] for cell_type in CELL_TYPES}
+    indexes = {cell_type: [] for cell_type in CELL_TYPES}
+    values = {cell_type: [] for cell_type in CELL_TYPES}
+    for row in rows:
+        lengths.append(len(row))
+        for idx, val in enumerate(row):
+            if val is not None:
+                cell_type = type(val)
+                if cell_type not in CELL_TYPES:
+                    raise TypeError(f"Can't cache a {cell_type.__name__} cell")
+                indexes[cell_type].append(idx)
+                values[cell_type].append(val)
+        for cell_type, type_offsets in offsets.items():
+            type_offsets.append(len(values[cell_type]))
+
+    arrays = [pa.array(lengths, type=pa.int32())]
+    for cell_type, arrow_type in CELL_TYPES.items():
+        type_offsets = pa.array(offsets[cell_type], type=pa.int32())
+        arrays.append(pa.ListArray.from_arrays(type_offsets, pa.array(indexes[cell_type], type=pa.int32())))
+        arrays.append(pa.ListArray.from_arrays(type_offsets, pa.array(values[cell_type], type=arrow_type)))
+
+    return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+
+def batch_to_rows(batch):
+    cells = [[None] * length for length in batch.column(0).to_pylist()]
+    for i in range(len(CELL_TYPES)):
+        indexes, values = batch.column(1 + 2 * i), batch.column(2 + 2 * i)
+        flat_values = values.flatten().to_pylist()
+        if not flat_values:
+            continue
+        flat_indexes = indexes.flatten().to_pylist()
+        offsets = indexes.offsets.to_pylist()
+        for row_no, row in enumerate(cells):
+            for k in range(offsets[row_no], offsets[row_no + 1]):
+                row[flat_indexes[k]] = flat_values[k]
+
+    return [tuple(row) for row in cells]
+
+
+class SheetCache:
+    """Parsed sheets on local disk, as Arrow IPC (feather) files.
+
+    An entry is the sheet name and the raw rows read from one sheet of an
+    object, so a re-queued invoice skips the download and the xlsx parse.
+    Rows are written and read in record batches as they stream by, never
+    all at once.
+    Object keys include the S3 ETag (or the local file's mtime and size),
+    so a changed file is never served from the cache. Files are evicted
+    least recently used first once they add up to more than `max_bytes`.
+    """
+
+    def __init__(self, path=SHEET_CACHE_DIR, max_bytes=SHEET_CACHE_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses}
+
+    def _object_prefix(self, object_key):
+        return hashlib.sha1(repr(object_key).encode()).hexdigest()
+
+    def _file_path(self, object_key, sheet_name):
+        # <object>-<configured sheet name>
+        sheet = hashlib.sha1(repr((SHEET_CACHE_FORMAT, sheet_name)).encode()).hexdigest()[:16]
+        return os.path.join(self.path, f'{self._object_prefix(object_key)}-{sheet}.arrow')
+
+    def get(self, object_key, sheet_name, log_file):
+        # (sheet name, iterator of rows) or None; sheet_name is the configured
+        # one, None for the first sheet. Rows are decoded a batch at a time.
+        if not self.max_bytes:
+            return None
+
+        file_path = self._file_path(object_key, sheet_name)
+        try:
+            source = pa.memory_map(file_path)
+            reader = pa.ipc.open_file(source)
+            if not reader.schema.remove_metadata().equals(get_sheet_schema(None)):
+                raise ValueError("Unexpected schema")
+            read_sheet_name = reader.schema.metadata[b'sheet_name'].decode()
+        except FileNotFoundError as e:
+            self.misses += 1
+            print("Sheet cache miss", file=log_file)
+            return None
+        except Exception as e:
+            self.misses += 1
+            print("Sheet cache entry unreadable:", e, file=log_file)
+            return None
+
+        try:
+            # mtime is the last use
+            os.utime(file_path)
+        except OSError as e:
+            pass
+
+        self.hits += 1
+        print("Sheet cache hit, skipped download and parse", file=log_file)
+        return read_sheet_name, self._read(source, reader)
+
+    def _read(self, source, reader):
+        try:
+            for i in range(reader.num_record_batches):
+                yield from batch_to_rows(reader.get_batch(i))
+        finally:
+            source.close()
+
+    def put(self, object_key, sheet_name, read_sheet_name, rows, log_file):
+        """The rows, passed through as they are written to the cache.
+
+        read_sheet_name is the sheet the rows were read from. The entry is
+        only stored once the rows run out; if the caller stops early or a
+        cell can't be cached, nothing is.
+        """
+        if not self.max_bytes:
+            return rows
+        return self._write(self._file_path(object_key, sheet_name), read_sheet_name, rows, log_file)
+
+    def _write(self, file_path, read_sheet_name, rows, log_file):
+        writer = sink = tmp_path = None
+        try:
+            schema = get_sheet_schema(read_sheet_name)
+            os.makedirs(self.path, exist_ok=True)
+            # other workers may read the file at any time; only complete
+            # files get the real name
+            fd, tmp_path = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+            os.close(fd)
+            sink = pa.OSFile(tmp_path, 'wb')
+            writer = pa.ipc.new_file(sink, schema)
+        except Exception as e:
+            print("Sheet not cached:", e, file=log_file)
+
+        batch = []
+        try:
+            for row in rows:
+                yield row
+                if writer:
+                    batch.append(row)
+                    if len(batch) == SHEET_CACHE_BATCH_ROWS:
+                        writer = self._write_batch(writer, schema, batch, log_file)
+                        batch = []
+
+            if writer and batch:
+                writer = self._write_batch(writer, schema, batch, log_file)
+            if writer:
+                try:
+                    writer.close()
+                    sink.close()
+                    os.replace(tmp_path, file_path)
+                except Exception as e:
+                    print("Sheet not cached:", e, file=log_file)
+                else:
+                    self.evict()
+        finally:
+            if sink:
+                sink.close()
+            if tmp_path and os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def _write_batch(self, writer, schema, batch, log_file):
+        # the writer, or None once the sheet can't be cached
+        try:
+            writer.write_batch(rows_to_batch(batch, schema))
+            return writer
+        except Exception as e:
+            print("Sheet not cached:", e, file=log_file)
+            return None
+
+    def evict(self):
+        entries = []
+        for entry in os.scandir(self.path):
+            if entry.name.endswith('.arrow'):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError as e:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total = sum(size for mtime, size, file_path in entries)
+        for mtime, size, file_path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(file_path)
+            except FileNotFoundError as e:
+                pass
+            total -= size
+
+
+sheet_cache = SheetCache()
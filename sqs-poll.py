@@ -1,33 +1,100 @@
 import os
+import time
+import traceback
+import contextlib
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
 
 import invoice_process
 
-from utilities import send_email, get_sqs_resource
+from models import engine
+from utilities import get_sqs_resource
+from notifications import NotificationDispatcher
 
 
 QUEUE_NAME = os.getenv('QUEUE_NAME')
-MAX_QUEUE_MESSAGES = 1
-
-sqs = get_sqs_resource()
-queue = sqs.get_queue_by_name(QueueName=QUEUE_NAME)
+MAX_QUEUE_MESSAGES = 10
+WAIT_TIME_SECONDS = 20
+WORKERS = int(os.getenv('WORKERS', 1))
+# messages received ahead of a free worker, per worker
+PREFETCH = int(os.getenv('PREFETCH', 1))
+VISIBILITY_TIMEOUT = int(os.getenv('VISIBILITY_TIMEOUT', 300))
 
 from_email = os.getenv("FROM_EMAIL", 'LTC <reporter@ltc.com>')
 to_email = os.getenv("TO_EMAIL", 'info@ltc.com')
 
 TEST_MODE = True
 
-while True:
-    for message in queue.receive_messages(MaxNumberOfMessages=MAX_QUEUE_MESSAGES, WaitTimeSeconds=5):
-        file_name = message.body.replace('+', ' ')
-        print (file_name, '='*10)
-        message.delete()
-
-        result, log_file, invoice_info = invoice_process.validate_file(file_name, TEST_MODE)
-        if result:
-            result = invoice_process.process_invoice(invoice_info, log_file, TEST_MODE)
-            email_body = 'Uploaded successfully' if result else 'Insertion failed'
-        else:
-            email_body = 'Validation failed'
-
-        subject = f'Invoice Uploaded Successfully ({file_name})'
-        send_email(subject, from_email, [to_email], email_body, log_file)
+
+def init_worker():
+    # never share pooled connections with the parent process
+    engine.dispose()
+
+
+def extend_visibility(in_flight):
+    # keep files that are still queued or running hidden from other consumers
+    now = time.monotonic()
+    for job in in_flight.values():
+        if now - job['extended'] > VISIBILITY_TIMEOUT / 2:
+            job['message'].change_visibility(VisibilityTimeout=VISIBILITY_TIMEOUT)
+            job['extended'] = now
+
+
+def finish(future, job, notifications):
+    try:
+        result, log_file, email_body = future.result()
+    except Exception as e:
+        # leave the message on the queue; it becomes visible again after the timeout
+        print(job['file_name'], 'failed', '\n', traceback.format_exc())
+        return
+
+    # the email goes out in the background
+    notifications.notify(job['file_name'], email_body, log_file, result)
+    job['message'].delete()
+    print(job['file_name'], email_body, f'({time.monotonic() - job["received"]:.1f}s)')
+
+
+def main():
+    sqs = get_sqs_resource()
+    queue = sqs.get_queue_by_name(QueueName=QUEUE_NAME)
+    in_flight = {}
+    notifications = NotificationDispatcher(from_email, to_email)
+
+    # on the way out, queued emails are still sent
+    with contextlib.ExitStack() as pools, contextlib.closing(notifications):
+        pool = pools.enter_context(ProcessPoolExecutor(max_workers=WORKERS, initializer=init_worker))
+        while True:
+            capacity = WORKERS * (1 + PREFETCH) - len(in_flight)
+            if capacity > 0:
+                messages = queue.receive_messages(
+                    MaxNumberOfMessages=min(capacity, MAX_QUEUE_MESSAGES),
+                    WaitTimeSeconds=1 if in_flight else WAIT_TIME_SECONDS,
+                    VisibilityTimeout=VISIBILITY_TIMEOUT,
+                    MessageAttributeNames=['force']
+                )
+                for message in messages:
+                    file_name = message.body.replace('+', ' ')
+                    # a message with a "force" attribute of "true" reloads a file that was loaded already
+                    force = ((message.message_attributes or {}).get('force') or {}).get('StringValue', '').lower() == 'true'
+                    print (file_name, '='*10)
+                    try:
+                        future = pool.submit(invoice_process.process_file, file_name, TEST_MODE, force)
+                    except BrokenProcessPool as e:
+                        # a worker died (e.g. out of memory on a big sheet); the files it
+                        # had failed in finish() and their messages become visible again
+                        print('Worker pool broken, starting a new one')
+                        pool.shutdown(wait=False)
+                        pool = pools.enter_context(ProcessPoolExecutor(max_workers=WORKERS, initializer=init_worker))
+                        future = pool.submit(invoice_process.process_file, file_name, TEST_MODE, force)
+                    now = time.monotonic()
+                    in_flight[future] = {'message': message, 'file_name': file_name, 'received': now, 'extended': now}
+
+            if in_flight:
+                done, _ = wait(in_flight, timeout=0 if capacity > 0 else 5, return_when=FIRST_COMPLETED)
+                for future in done:
+                    finish(future, in_flight.pop(future), notifications)
+                extend_visibility(in_flight)
+
+
+if __name__ == '__main__':
+    main()
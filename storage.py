@@ -0,0 +1,72 @@
+import os
+import hashlib
+
+from utilities import get_s3_client, get_s3_bucket, download_s3_object
+
+
+# a directory laid out like the bucket (<year>/<month>/<facility>/<source>/<file>) to read invoices from instead of S3
+INVOICE_STORAGE_DIR = os.getenv('INVOICE_STORAGE_DIR')
+
+
+class S3Storage:
+    """Invoices in the S3 bucket."""
+
+    def list(self, prefix):
+        paginator = get_s3_client().get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=get_s3_bucket(), Prefix=prefix):
+            for obj in page.get('Contents', []):
+                # folder objects end with '/'
+                if not obj['Key'].endswith('/'):
+                    yield obj['Key']
+
+    def stat(self, key):
+        # (object key for the sheet cache, version id, fingerprint of the content)
+        head = get_s3_client().head_object(Bucket=get_s3_bucket(), Key=key)
+        return (get_s3_bucket(), key, head['ETag']), head.get('VersionId'), 'etag:' + head['ETag'].strip('"')
+
+    def open(self, key, version_id=None):
+        # on versioned buckets the download is pinned to the version stat() saw
+        return download_s3_object(key, version_id)
+
+
+class LocalStorage:
+    """Invoices in a local directory tree, keyed like the bucket."""
+
+    def __init__(self, root):
+        self.root = root
+
+    def _path(self, key):
+        return os.path.join(self.root, *key.split('/'))
+
+    def list(self, prefix):
+        # prefixes end at a folder, e.g. "2026/9/"
+        top = self._path(prefix.rstrip('/'))
+        for dir_path, dir_names, file_names in os.walk(top):
+            dir_names.sort()
+            for file_name in sorted(file_names):
+                yield os.path.relpath(os.path.join(dir_path, file_name), self.root).replace(os.sep, '/')
+
+    def stat(self, key):
+        path = self._path(key)
+        stat = os.stat(path)
+        sha1 = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                sha1.update(chunk)
+        return (path, stat.st_mtime_ns, stat.st_size), None, 'sha1:' + sha1.hexdigest()
+
+    def open(self, key, version_id=None):
+        return open(self._path(key), 'rb')
+
+
+_storage = LocalStorage(INVOICE_STORAGE_DIR) if INVOICE_STORAGE_DIR else S3Storage()
+
+
+def get_storage():
+    return _storage
+
+
+def use_storage(storage):
+    # e.g. a LocalStorage for a backfill from disk; per process
+    global _storage
+    _storage = storage
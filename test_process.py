@@ -1,7 +1,27 @@
+import io
+import os
+import re
+import gzip
 import math
+import time
+import decimal
+import hashlib
+import sqlite3
+import tempfile
+import datetime
 
 import invoice_process
 
+from openpyxl import load_workbook
+
+from loaders import LOAD_COLUMNS, get_row_converter, get_line_hasher, execute_bulk_insert_sp
+from row_mapping import map_invoice
+from frame_validation import validate_frame
+from parallel_validation import validate_parallel
+from sheet_cache import SheetCache
+from notifications import LocalSesClient, NotificationDispatcher
+from create_folder import get_folder
+from storage import LocalStorage
 from utilities import *
 
 
@@ -21,6 +41,262 @@ def test_get_last_name_1():
     assert get_last_name('John') == None
 
 
+def test_payer_group_index():
+    payer_groups = PayerGroupIndex([
+        (1, None, 'MEDICARE'),
+        (2, 1, 'MEDICAID'),
+        (3, None, 'Medicaid'),
+        (4, 2, 'MEDICAID'),
+    ])
+
+    assert payer_groups.resolve('medicare ', 1) == 1
+    assert payer_groups.resolve('MEDICAID', 1) == 2
+    assert payer_groups.resolve('MEDICAID', 2) == 3
+    assert payer_groups.resolve('MEDICAID', None) == 3
+    assert payer_groups.unresolved(['MEDICARE', 'PRIVATE', None], 1) == ['None', 'PRIVATE']
+
+
+def test_map_invoice():
+    payer_groups = PayerGroupIndex([(5, 2, 'MEDICARE')])
+    row = {
+        'resident_nm': 'Doe,John', 'fin_plan': 'MEDICARE', 'res_ssn': '123-45-6789', 'service_dt': datetime.datetime(2020, 10, 2),
+        'product_category': 'RX', 'sales_type': None, 'trans_desc': 'Drug', 'doctor_nm': None, 'rx_nbr': 1234,
+        'ndc_nbr': '0001', 'quantity': 30, 'days_supply': 30, 'amount_due': 1.5, 'task_manager_notes': None,
+    }
+    log_file = io.StringIO()
+
+    result, load_data = map_invoice('pharmerica_email', [row], 7, 1, 3, datetime.date(2020, 10, 1), 2, payer_groups, log_file, True)
+    record = dict(zip(LOAD_COLUMNS, load_data[0]))
+
+    assert result == True
+    assert (record['invoice_batch_id'], record['payer_group_id'], record['duplicate_flg']) == (7, 5, True)
+    assert (record['first_nm'], record['last_nm'], record['ssn']) == ('Doe', 'John', '123456789')
+    assert record['product_category'] == 'RX'
+    assert record['copay_flg'] is None
+
+    result, load_data = map_invoice('pharmerica_email', [row, dict(row, resident_nm=None)], 7, 1, 3, datetime.date(2020, 10, 1), 2, payer_groups, log_file, True)
+
+    assert result == False
+    assert len(load_data) == 1
+    assert 'get_first_name(row' in log_file.getvalue()
+
+    # one traceback per row only up to MAPPING_TRACEBACKS, then just the count
+    log_file = io.StringIO()
+    result, load_data = map_invoice('pharmerica_email', [dict(row, resident_nm=None)] * 10, 7, 1, 3, datetime.date(2020, 10, 1), 2, payer_groups, log_file, True)
+
+    assert result == False
+    assert log_file.getvalue().count('Traceback') == 3
+    assert 'AttributeError: 10 rows' in log_file.getvalue()
+
+
+def test_row_converter():
+    convert = get_row_converter(columns=('invoice_dt', 'ssn', 'duplicate_flg', 'quantity'))
+
+    row = convert((datetime.datetime(2020, 10, 1), 0, True, 1.5))
+
+    assert row == (datetime.date(2020, 10, 1), '0', '1', 1.5)
+
+
+def test_line_hasher():
+    line_hash = get_line_hasher(columns=('invoice_dt', 'ssn', 'rx_nbr', 'quantity', 'charge_amt', 'copay_flg'))
+
+    new_line = (datetime.datetime(2020, 10, 1), 0, 1234567.0, 0.1, 12.5, None)
+    # the same line as read back from the table: real, money, date columns
+    stored_line = (datetime.date(2020, 10, 1), '0', 1234567, 0.10000000149011612, decimal.Decimal('12.5000'), None)
+
+    assert line_hash(new_line) == line_hash(stored_line)
+    assert line_hash(new_line) != line_hash(new_line[:-1] + ('Y',))
+    assert line_hash(new_line) != line_hash(new_line[:4] + (12.51, None))
+    # a value the column can't hold never matches
+    assert line_hash(new_line[:4] + ('$12.50', None)) != line_hash(stored_line)
+
+
+class SqliteProcedureCursor:
+    # stand-in for a SQL Server cursor: runs {CALL sp (?, ?)} as a python
+    # procedure against a sqlite connection
+    def __init__(self, connection, procedures):
+        self.connection = connection
+        self.procedures = procedures
+
+    def execute(self, sql, params):
+        sp_name = re.match(r'^\{CALL (\S+) \(\?, \?\)\}$', sql).group(1)
+        self.procedures[sp_name](self.connection, *params)
+
+
+def test_execute_bulk_insert_sp():
+    connection = sqlite3.connect(':memory:')
+    connection.execute(f"create table raw_invoices ({', '.join(LOAD_COLUMNS)})")
+
+    def load_raw_invoices(connection, invoice_batch_id, rows):
+        placeholders = ', '.join('?' * len(LOAD_COLUMNS))
+        connection.executemany(f"insert into raw_invoices values ({placeholders})", rows)
+
+    convert = get_row_converter()
+    row = dict.fromkeys(LOAD_COLUMNS)
+    row.update(invoice_batch_id=7, last_nm='Doe', charge_amt=1.5)
+    rows = [convert(tuple(row.values())) for _ in range(3)]
+    cursor = SqliteProcedureCursor(connection, {'dbo.load_raw_invoices': load_raw_invoices})
+
+    execute_bulk_insert_sp(cursor, 'dbo.load_raw_invoices', 7, rows)
+
+    assert connection.execute("select count(*), sum(charge_amt) from raw_invoices where invoice_batch_id = 7").fetchone() == (3, 4.5)
+
+
+def test_aws_clients_are_reused():
+    assert get_s3_client() is get_s3_client()
+
+    stats = get_aws_client_stats()
+
+    assert stats[('client', 's3', None, None)]['created'] == 1
+
+
+def test_reference_cache():
+    cache = ReferenceCache(max_entries=2)
+    cache.loaded_at = time.monotonic()
+
+    assert cache.get('facility', 'A', lambda db: 1) == 1
+    assert cache.get('facility', 'A', lambda db: 2) == 1
+    assert cache.get('facility', 'B', lambda db: None) is None
+    assert cache.get('facility', 'C', lambda db: 3) == 3
+    assert cache.get('facility', 'A', lambda db: 4) == 4
+
+    assert cache.stats() == {'hits': 1, 'misses': 4, 'entries': 2}
+
+
+def test_sheet_cache():
+    rows = [
+        ('Name', 'SSN', 'Dispense Dt', 'Qty'),
+        ('DOE,JOHN', '123-45-6789', datetime.datetime(2020, 10, 2, 13, 5), 30),
+        ('ROE,JANE', 123456789, '10/03/2020', 2.5, None, True),
+        (None, '', datetime.date(2020, 10, 4), -0.0),
+        (datetime.time(7, 30), datetime.timedelta(days=1)),
+    ]
+    log = io.StringIO()
+    with tempfile.TemporaryDirectory() as path:
+        cache = SheetCache(path, max_bytes=10**6)
+        assert cache.get(('a', 1), None, log) is None
+        assert not os.path.exists(cache._file_path(('a', 1), None))
+        # only rows that were read all the way through are stored
+        partial = cache.put(('a', 1), None, 'Sheet1', iter(rows), log)
+        assert next(partial) == rows[0]
+        partial.close()
+        assert not os.path.exists(cache._file_path(('a', 1), None))
+        assert os.listdir(path) == []
+        assert list(cache.put(('a', 1), None, 'Sheet1', iter(rows), log)) == rows
+        assert os.path.exists(cache._file_path(('a', 1), None))
+        assert cache.get(('a', 1), 'Sheet2', log) is None
+        cached_name, cached_rows = cache.get(('a', 1), None, log)
+        assert cached_name == 'Sheet1'
+        cached_rows = list(cached_rows)
+        assert cached_rows == rows
+        assert [list(map(type, row)) for row in cached_rows] == [list(map(type, row)) for row in rows]
+
+        # every test file survives the round trip
+        for file_name in sorted(os.listdir('test_files')):
+            ws = load_workbook('test_files/' + file_name, read_only=True).worksheets[0]
+            ws.reset_dimensions()
+            sheet_rows = [tuple(row) for row in ws.iter_rows(values_only=True)]
+            assert list(cache.put(file_name, None, ws.title, sheet_rows, log)) == sheet_rows
+            cached_name, cached_rows = cache.get(file_name, None, log)
+            assert (cached_name, list(cached_rows)) == (ws.title, sheet_rows)
+
+        # the least recently used entries go first
+        cache.max_bytes = os.path.getsize(cache._file_path(('a', 1), None)) + 1
+        time.sleep(0.01)
+        assert cache.get(('a', 1), None, log)
+        cache.evict()
+        assert os.listdir(path) == [os.path.basename(cache._file_path(('a', 1), None))]
+
+    assert cache.stats() == {'hits': 2 + len(os.listdir('test_files')), 'misses': 2}
+    assert "Sheet not cached" not in log.getvalue()
+
+    # turned off, the rows are passed on as they are
+    assert SheetCache(max_bytes=0).put(('a', 1), None, 'Sheet1', rows, log) is rows
+
+
+def test_stage_timer():
+    timer = StageTimer()
+    with timer.stage('validation') as stage:
+        stage.rows = 3
+    with timer.stage('insert'):
+        time.sleep(0.01)
+    with timer.stage('insert'):
+        pass
+
+    log = io.StringIO()
+    timer.log(log)
+    lines = log.getvalue().splitlines()
+    assert re.match(r'^Stage validation: \d+\.\d{3}s, 3 rows$', lines[0])
+    assert re.match(r'^Stage insert: 0\.0[1-9]\ds$', lines[1])
+
+    # only new stages on the next call
+    with timer.stage('commit'):
+        pass
+    log = io.StringIO()
+    timer.log(log)
+    assert log.getvalue().startswith('Stage commit:')
+    assert log.getvalue().count('\n') == 1
+
+
+def test_notifications():
+    with tempfile.TemporaryDirectory() as path:
+        small, big = os.path.join(path, 'small.txt'), os.path.join(path, 'big.txt')
+        with open(small, 'w') as f:
+            f.write('Invoice is valid.\n')
+        with open(big, 'w') as f:
+            f.write('Row: 1\n' * EMAIL_GZIP_MIN_BYTES)
+
+        # one email per file; throttled sends are retried
+        ses = LocalSesClient(failures=2)
+        notifications = NotificationDispatcher('from@ltc.com', 'to@ltc.com', digest_seconds=0, backoff=0, ses_client=ses)
+        notifications.notify('2020/10/a.xlsx', 'Uploaded successfully', small)
+        notifications.notify('2020/10/b.xlsx', 'Validation failed', big, False)
+        notifications.close()
+
+        assert ses.calls == 4
+        assert [message['Subject'] for message in ses.messages] == [
+            'Invoice Uploaded Successfully (2020/10/a.xlsx)', 'Invoice Uploaded Successfully (2020/10/b.xlsx)']
+        attachments = [part for part in ses.messages[1].walk() if part.get_filename()]
+        assert attachments[0].get_filename() == big + '.gz'
+        assert gzip.decompress(attachments[0].get_payload(decode=True)) == open(big, 'rb').read()
+
+        # one digest for the window, with the logs of the failed files
+        ses = LocalSesClient()
+        notifications = NotificationDispatcher('from@ltc.com', 'to@ltc.com', digest_seconds=60, ses_client=ses)
+        notifications.notify('2020/10/a.xlsx', 'Uploaded successfully', small)
+        notifications.notify('2020/10/b.xlsx', 'Validation failed', small, False)
+        notifications.close()
+
+        assert len(ses.messages) == 1
+        assert ses.messages[0]['Subject'] == 'Invoice uploads: 2 files, 1 failed'
+        body = ses.messages[0].get_payload()[0].get_payload(decode=True).decode()
+        assert '2020/10/a.xlsx' in body and 'Validation failed' in body
+        assert [part.get_filename() for part in ses.messages[0].walk() if part.get_filename()] == [small]
+
+
+def test_get_folder():
+    assert get_folder('2026/9/Beacon/Portal/invoice.xlsx') == '2026/9/Beacon/Portal/'
+    assert get_folder('2026/9/Beacon/Portal/') == '2026/9/Beacon/Portal/'
+
+
+def test_local_storage():
+    with tempfile.TemporaryDirectory() as path:
+        for key in ('2026/9/Beacon/Portal/b.xlsx', '2026/9/Beacon/Email/a.xlsx', '2026/10/Beacon/Portal/c.xlsx'):
+            os.makedirs(os.path.join(path, *key.split('/')[:-1]), exist_ok=True)
+            with open(os.path.join(path, *key.split('/')), 'wb') as f:
+                f.write(key.encode())
+
+        storage = LocalStorage(path)
+        assert list(storage.list('2026/9/')) == ['2026/9/Beacon/Email/a.xlsx', '2026/9/Beacon/Portal/b.xlsx']
+        assert list(storage.list('2026/11/')) == []
+
+        object_key, version_id, file_fingerprint = storage.stat('2026/9/Beacon/Email/a.xlsx')
+        assert version_id is None
+        assert file_fingerprint == 'sha1:' + hashlib.sha1(b'2026/9/Beacon/Email/a.xlsx').hexdigest()
+        with storage.open('2026/9/Beacon/Email/a.xlsx') as f:
+            assert f.read() == b'2026/9/Beacon/Email/a.xlsx'
+
+
 def test_validate_field_int():
     field = RawInvoiceField(
         sheet_column_name='Test',
@@ -81,6 +357,41 @@ def test_validate_field_date():
     assert is_valid is not None
 
 
+def test_date_column_parser():
+    date_parser = DateColumnParser(sample_size=3)
+
+    for val in ['09/01/2020', '09/02/2020', '09/03/2020']:
+        date_parser.parse(val)
+
+    assert date_parser.date_format == '%m/%d/%Y'
+    assert date_parser.parse('12/14/2020') == datetime.datetime(2020, 12, 14)
+    assert date_parser.parse('Dec 15 2020') == datetime.datetime(2020, 12, 15)
+    assert date_parser.fast == 1
+    assert date_parser.fallback == 4
+
+
+def test_field_memo():
+    calls = []
+    memo = FieldMemo(lambda val: calls.append(val) or (True, '', val.upper()), size=2)
+    for val in ['a', 'b', 'a', 'c', 'b', 'a']:
+        assert memo(val) == (True, '', val.upper())
+
+    # 'b' was the least recently used when 'c' came in
+    assert calls == ['a', 'b', 'c', 'b', 'a']
+    assert (memo.hits, memo.misses) == (1, 5)
+
+    # a hit counts for the date parser as the parse it stands for
+    date_parser = DateColumnParser(sample_size=2)
+    memo = FieldMemo(compile_field(RawInvoiceField(field_type='date', field_validations=''), date_parser), date_parser)
+    for val in ['09/01/2020', '09/01/2020', '09/02/2020', '09/02/2020', 'Dec 15 2020', 'Dec 15 2020']:
+        memo(val)
+
+    assert (date_parser.fast, date_parser.fallback) == (2, 4)
+    assert (memo.hits, memo.misses) == (2, 2)
+    memo.reset()
+    assert not memo.results
+
+
 def test_validate_field_string():
     field = RawInvoiceField(
         sheet_column_name='Test',
@@ -156,10 +467,87 @@ def test_validate_field_string_Name():
     assert is_valid == True
 
 
+def test_validate_row_plan():
+    fields = [
+        RawInvoiceField(field_name='rx_no', sheet_column_name='Rx', field_type='int', field_validations='IsNotEmpty', is_optional=False),
+        RawInvoiceField(field_name='patient', sheet_column_name='Patient', field_type='string', field_validations='IsNotEmpty,Name', is_optional=False),
+        RawInvoiceField(field_name='note', sheet_column_name='Note', field_type='string', field_validations='', is_optional=True),
+    ]
+    plan = compile_validation_plan(fields, ['Patient', 'Rx'])
+
+    assert [entry[2] for entry in plan] == [1, 0, None]
+    assert [entry[5] for entry in plan] == [None, None, None]
+
+    errors = ErrorCollector(examples=2)
+    is_valid, row = validate_row(plan, ('John,Doe', ' 1234 '), 2, errors)
+
+    assert is_valid == True
+    assert row == {'rx_no': 1234, 'patient': 'John,Doe', 'note': None}
+
+    for row_idx in (3, 4, 5):
+        is_valid, row = validate_row(plan, ('John,Doe', None), row_idx, errors)
+        assert is_valid == False
+
+    assert errors.counts == {('Rx', 'Should not be empty'): 3}
+    assert errors.rows[('Rx', 'Should not be empty')] == [3, 4]
+
+    log_file = io.StringIO()
+    errors.log(log_file)
+    assert 'Column: Rx , Msg: Should not be empty , 3 rows: 3, 4, ...' in log_file.getvalue()
+
+
+def read_test_file(file_name, field_configs, is_date_column):
+    # the rows of a test file and a field for every column under every configuration,
+    # plus a date field for the columns where is_date_column(...) of the cells are dates
+    wb = load_workbook('test_files/' + file_name, read_only=True)
+    ws = wb[wb.sheetnames[0]]
+    ws.reset_dimensions()
+    header, rows = read_sheet(ws.iter_rows(values_only=True), 0, 0, 0)
+    rows = list(rows)
+    wb.close()
+
+    fields = [
+        RawInvoiceField(field_name=f'{column}_{field_type}', sheet_column_name=column, field_type=field_type, field_validations=field_validations, is_optional=False)
+        for column in header for field_type, field_validations in field_configs
+    ] + [
+        RawInvoiceField(field_name=f'{column}_date', sheet_column_name=column, field_type='date', field_validations='', is_optional=True)
+        for i, column in enumerate(header) if is_date_column(i < len(row) and isinstance(row[i], datetime.datetime) for row_idx, row in rows)
+    ]
+    return header, rows, fields
+
+
+def test_validate_frame():
+    # every column of every test file under a few field configurations
+    field_configs = [('string', 'IsNotEmpty,Name'), ('string', 'Ssn,MaxLength50'), ('char', 'BorG'), ('int', ''), ('decimal', 'IsNotEmpty')]
+
+    for file_name in sorted(os.listdir('test_files')):
+        header, rows, fields = read_test_file(file_name, field_configs, all)
+
+        plan = compile_validation_plan(fields, header)
+        errors, log_file = ErrorCollector(), io.StringIO()
+        data = []
+        for row_idx, row in rows:
+            is_valid, cleaned_data = validate_row(plan, row, row_idx, errors)
+            if is_valid:
+                data.append(cleaned_data)
+        errors.log(log_file)
+        log_date_parsers(plan, log_file)
+
+        frame_plan = compile_validation_plan(fields, header)
+        frame_errors, frame_log_file = ErrorCollector(), io.StringIO()
+        result, frame_data = validate_frame(frame_plan, iter(rows), frame_errors)
+        frame_errors.log(frame_log_file)
+        log_date_parsers(frame_plan, frame_log_file)
+
+        assert frame_log_file.getvalue() == log_file.getvalue(), file_name
+        assert frame_data == data, file_name
+        assert result == (len(data) == len(rows)), file_name
+
+
 def test_pharmscripts_portal():
     file_name = '2020/10/Deer Meadows NEW/Portal/Pharmscripts Portal Invoice.xlsx'
 
-    result, log_file, invoice_info = invoice_process.validate_file(file_name, True)
+    result, log_file, invoice_info = invoice_process.validate_file(file_name, True, force=True)
     assert result == True
 
     result = invoice_process.process_invoice(invoice_info, log_file, True)
@@ -194,24 +582,47 @@ def test_pharmscripts_portal():
     assert record is not None
 
 
+def test_validate_parallel():
+    field_configs = [('string', 'IsNotEmpty,Name'), ('string', 'Ssn'), ('char', 'BorG'), ('int', ''), ('decimal', 'IsNotEmpty')]
+
+    for file_name in sorted(os.listdir('test_files')):
+        header, rows, fields = read_test_file(file_name, field_configs, any)
+
+        logs, results = [], []
+        for validate in (validate_frame, lambda plan, rows, errors: validate_parallel(plan, rows, errors, workers=2, chunk_rows=2, min_rows=0)):
+            plan = compile_validation_plan(fields, header)
+            for entry in plan:
+                if entry[5]:
+                    # formats are learned within the first chunk
+                    entry[5].sample_size = 1
+            errors, log_file = ErrorCollector(), io.StringIO()
+            results.append(validate(plan, iter(rows), errors))
+            errors.log(log_file)
+            log_date_parsers(plan, log_file)
+            logs.append(log_file.getvalue())
+
+        assert results[1] == results[0], file_name
+        assert logs[1] == logs[0], file_name
+
+
 def test_pharmscripts_portal_missing_name():
     file_name = '2020/10/Deer Meadows NEW/Portal/Pharmscripts Portal Invoice - missing columns.xlsx'
 
-    result, log_file, invoice_info = invoice_process.validate_file(file_name, True)
+    result, log_file, invoice_info = invoice_process.validate_file(file_name, True, force=True)
     assert result == False
 
 
 def test_pharmscripts_email_invalid_bed():
     file_name = '2020/10/Deer Meadows NEW/Email/Pharmscripts Emailed Invoice - invalid bed.xlsx'
 
-    result, log_file, invoice_info = invoice_process.validate_file(file_name, True)
+    result, log_file, invoice_info = invoice_process.validate_file(file_name, True, force=True)
     assert result == False
 
 
 def test_pharmscripts_email():
     file_name = '2020/10/Deer Meadows NEW/Email/Pharmscripts Emailed Invoice.xlsx'
 
-    result, log_file, invoice_info = invoice_process.validate_file(file_name, True)
+    result, log_file, invoice_info = invoice_process.validate_file(file_name, True, force=True)
     assert result == True
 
     result = invoice_process.process_invoice(invoice_info, log_file, True)
@@ -248,7 +659,7 @@ def test_pharmscripts_email():
 def test_process_row_omnicare_general():
     file_name = '2020/10/Beacon/General/Omnicare Email.xlsx'
 
-    result, log_file, invoice_info = invoice_process.validate_file(file_name, True)
+    result, log_file, invoice_info = invoice_process.validate_file(file_name, True, force=True)
     assert result == True
 
     result = invoice_process.process_invoice(invoice_info, log_file, True)
@@ -288,14 +699,14 @@ def test_process_row_omnicare_general():
 def test_process_row_omnicare_general_invalid_amount():
     file_name = '2020/10/Beacon/General/Omnicare Email - invalid amount.xlsx'
 
-    result, log_file, invoice_info = invoice_process.validate_file(file_name, True)
+    result, log_file, invoice_info = invoice_process.validate_file(file_name, True, force=True)
     assert result == False
 
 
 def test_pharmerica_email():
     file_name = '2020/10/Ridgewood/Email/Cartersville May Invoice.xlsx'
 
-    result, log_file, invoice_info = invoice_process.validate_file(file_name, True)
+    result, log_file, invoice_info = invoice_process.validate_file(file_name, True, force=True)
     assert result == True
 
     result = invoice_process.process_invoice(invoice_info, log_file, True)
@@ -333,7 +744,7 @@ def test_pharmerica_email():
 def test_pharmerica_portal():
     file_name = '2020/10/Ridgewood/Portal/Pharmerica Portal Invoice.xlsx'
 
-    result, log_file, invoice_info = invoice_process.validate_file(file_name, True)
+    result, log_file, invoice_info = invoice_process.validate_file(file_name, True, force=True)
     assert result == True
 
     result = invoice_process.process_invoice(invoice_info, log_file, True)
@@ -372,7 +783,7 @@ def test_pharmerica_portal():
 def test_geriscript_general():
     file_name = '2020/10/Green Acres/General/Geriscript invoice.xlsx'
 
-    result, log_file, invoice_info = invoice_process.validate_file(file_name, True)
+    result, log_file, invoice_info = invoice_process.validate_file(file_name, True, force=True)
     assert result == True
 
     result = invoice_process.process_invoice(invoice_info, log_file, True)
@@ -416,7 +827,7 @@ def test_geriscript_general():
 def test_speciality_rx_portal():
     file_name = '2020/10/Ashbrook/Portal/Specialty Portal Invoice.xlsx'
 
-    result, log_file, invoice_info = invoice_process.validate_file(file_name, True)
+    result, log_file, invoice_info = invoice_process.validate_file(file_name, True, force=True)
     assert result == True
 
     result = invoice_process.process_invoice(invoice_info, log_file, True)
@@ -458,7 +869,7 @@ def test_speciality_rx_portal():
 def test_speciality_rx_email():
     file_name = '2020/10/Ashbrook/Email/Specialty Emailed Version.xlsx'
 
-    result, log_file, invoice_info = invoice_process.validate_file(file_name, True)
+    result, log_file, invoice_info = invoice_process.validate_file(file_name, True, force=True)
     assert result == True
 
     result = invoice_process.process_invoice(invoice_info, log_file, True)
@@ -1,4 +1,11 @@
 import re
+import gzip
+import time
+import datetime
+import tempfile
+import threading
+import contextlib
+import collections
 
 from email.mime.text import MIMEText
 from email.mime.application import MIMEApplication
@@ -6,8 +13,11 @@ from email.mime.multipart import MIMEMultipart
 
 import boto3
 import pyodbc
+from botocore.config import Config
+from boto3.s3.transfer import TransferConfig
 import dateparser
 from sqlalchemy import or_
+from sqlalchemy.orm import joinedload, selectinload
 
 from models import *
 import os
@@ -18,24 +28,93 @@ def get_s3_bucket():
     return os.getenv('bucket')
 
 
+AWS_MAX_POOL_CONNECTIONS = int(os.getenv('AWS_MAX_POOL_CONNECTIONS', 10))
+AWS_MAX_ATTEMPTS = int(os.getenv('AWS_MAX_ATTEMPTS', 5))
+AWS_RETRY_MODE = os.getenv('AWS_RETRY_MODE', 'standard')
+
+_aws_lock = threading.Lock()
+_aws_clients = {}
+_aws_stats = {}
+_aws_pid = None
+
+
+def _count_aws_call(key):
+    def count(**kwargs):
+        _aws_stats[key]['calls'] += 1
+    return count
+
+
+def _get_aws(kind, service, region_name=None):
+    # one client per service for the whole process; resources are not
+    # thread safe, so those are kept per thread
+    global _aws_pid
+    key = (kind, service, region_name, threading.get_ident() if kind == 'resource' else None)
+    with _aws_lock:
+        if _aws_pid != os.getpid():
+            # never reuse connections inherited from the parent process
+            _aws_clients.clear()
+            _aws_stats.clear()
+            _aws_pid = os.getpid()
+
+        aws = _aws_clients.get(key)
+        if aws is None:
+            config = Config(
+                max_pool_connections=AWS_MAX_POOL_CONNECTIONS,
+                retries={'max_attempts': AWS_MAX_ATTEMPTS, 'mode': AWS_RETRY_MODE}
+            )
+            factory = boto3.client if kind == 'client' else boto3.resource
+            aws = _aws_clients[key] = factory(service, region_name=region_name, config=config)
+            stats = _aws_stats.setdefault(key, {'created': 0, 'calls': 0})
+            stats['created'] += 1
+            client = aws if kind == 'client' else aws.meta.client
+            client.meta.events.register('before-call', _count_aws_call(key))
+
+    return aws
+
+
+def get_aws_client_stats():
+    # {(kind, service, region, thread): {'created': n, 'calls': n}}
+    with _aws_lock:
+        return {key: dict(stats) for key, stats in _aws_stats.items()}
+
+
 def get_s3_client():
-    return boto3.client(
-        's3'
-    )
+    return _get_aws('client', 's3')
+
+
+# objects are kept in memory up to this size, then in a temp file of the job's own
+S3_SPOOL_MAX_BYTES = int(os.getenv('S3_SPOOL_MAX_BYTES', 64 * 1024 * 1024))
+# larger objects are fetched as parallel ranged GETs
+S3_TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=int(os.getenv('S3_MULTIPART_THRESHOLD', 8 * 1024 * 1024)),
+    multipart_chunksize=int(os.getenv('S3_MULTIPART_CHUNKSIZE', 8 * 1024 * 1024)),
+    max_concurrency=int(os.getenv('S3_MAX_CONCURRENCY', AWS_MAX_POOL_CONNECTIONS))
+)
+
+
+def download_s3_object(key, version_id=None):
+    # a readable file object at position 0
+    buffer = tempfile.SpooledTemporaryFile(max_size=S3_SPOOL_MAX_BYTES)
+    try:
+        get_s3_client().download_fileobj(
+            get_s3_bucket(), key, buffer,
+            ExtraArgs={'VersionId': version_id} if version_id else None,
+            Config=S3_TRANSFER_CONFIG
+        )
+    except Exception as e:
+        buffer.close()
+        raise
+    buffer.seek(0)
+
+    return buffer
 
 
 def get_sqs_resource():
-    return boto3.resource(
-        'sqs',
-        region_name='us-east-1',
-    )
+    return _get_aws('resource', 'sqs', region_name='us-east-1')
 
 
 def get_ses_client():
-    return boto3.client(
-        'ses',
-        region_name='us-east-1',
-    )
+    return _get_aws('client', 'ses', region_name='us-east-1')
 
 
 def clean_text(val):
@@ -54,6 +133,41 @@ def get_valid_rows_count(ws):
         pass
 
 
+def iter_sheet_rows(rows):
+    # same terminator as get_valid_rows_count: stop at the first blank row
+    for row_no, values in enumerate(rows, 1):
+        if all(v is None or str(v).strip() == '' for v in values):
+            return
+        yield row_no, values
+
+
+def skip_last(rows, count):
+    # hold back the last `count` items without knowing the total up front
+    buffer = collections.deque()
+    for row in rows:
+        buffer.append(row)
+        if len(buffer) > count:
+            yield buffer.popleft()
+
+
+def read_sheet(rows, header_row_index, skip_rows_after_header, skip_ending_rows):
+    # single forward pass over the sheet values; returns the header and an
+    # iterator of (row number, values) for the data rows
+    rows = iter_sheet_rows(rows)
+    header = None
+    row_no = 0
+    for row_no, values in rows:
+        if row_no == header_row_index + 1:
+            header = [get_clean_header_column(v) for v in values if v]
+        if row_no == header_row_index + skip_rows_after_header + 1:
+            break
+
+    if not row_no:
+        return None, iter(())
+
+    return header or [], skip_last(rows, skip_ending_rows)
+
+
 def get_valid_cols_count(ws):
     ncols = ws.max_column
     for col in range(1, ncols):
@@ -62,7 +176,13 @@ def get_valid_cols_count(ws):
     return ncols
 
 
-def send_email(subject, from_email, to_emails, body, attachment=None):
+EMAIL_GZIP_MIN_BYTES = int(os.getenv('EMAIL_GZIP_MIN_BYTES', 256 * 1024))
+# buffer of the invoice log files
+LOG_BUFFER_BYTES = int(os.getenv('LOG_BUFFER_BYTES', 1024 * 1024))
+
+
+def send_email(subject, from_email, to_emails, body, attachment=None, ses_client=None):
+    # attachment is a file path or a list of them
     message = MIMEMultipart()
     message['Subject'] = subject
     message['From'] = from_email
@@ -70,14 +190,20 @@ def send_email(subject, from_email, to_emails, body, attachment=None):
     # message body
     part = MIMEText(body, 'html')
     message.attach(part)
-    # attachment
-    if attachment:
-        attachment_body = open(attachment).read()
-        part = MIMEApplication(str.encode(attachment_body))
-        part.add_header('Content-Disposition', 'attachment', filename=attachment)
+    # attachments
+    for file_path in [attachment] if isinstance(attachment, str) else attachment or []:
+        with open(file_path, 'rb') as f:
+            attachment_body = f.read()
+        filename = file_path
+        # big logs go compressed; SES limits the raw message size
+        if len(attachment_body) > EMAIL_GZIP_MIN_BYTES:
+            attachment_body = gzip.compress(attachment_body)
+            filename += '.gz'
+        part = MIMEApplication(attachment_body)
+        part.add_header('Content-Disposition', 'attachment', filename=filename)
         message.attach(part)
 
-    resp = get_ses_client().send_raw_email(
+    resp = (ses_client or get_ses_client()).send_raw_email(
         Source=message['From'],
         Destinations=to_emails.split(','),
         RawMessage={
@@ -106,22 +232,125 @@ def get_facilities():
     return session.query(Facility).filter(Facility.delete_by==None)
 
 
+REFERENCE_CACHE_TTL = int(os.getenv('REFERENCE_CACHE_TTL', 300))
+REFERENCE_CACHE_SIZE = int(os.getenv('REFERENCE_CACHE_SIZE', 10000))
+
+
+class ReferenceCache:
+    """Facilities, invoice sources, facility pharmacy maps and reader settings.
+
+    Everything is loaded in one eager pass through a private session and
+    kept detached, with relationships (pharmacy, facility,
+    raw_invoice_fields) already loaded. The snapshot is reloaded after
+    `ttl` seconds or on invalidate(). Keys the snapshot doesn't have
+    (e.g. names that differ only in case) are queried once and cached,
+    including misses. At most `max_entries` keys are kept, least recently
+    used first out.
+    """
+
+    def __init__(self, ttl=REFERENCE_CACHE_TTL, max_entries=REFERENCE_CACHE_SIZE):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = collections.OrderedDict()
+        self.loaded_at = None
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.RLock()
+
+    def invalidate(self):
+        with self.lock:
+            self.entries.clear()
+            self.loaded_at = None
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'entries': len(self.entries)}
+
+    def get(self, kind, key, query):
+        # query(db) runs only when the key is not cached
+        with self.lock:
+            if self.loaded_at is None or time.monotonic() - self.loaded_at > self.ttl:
+                self._load()
+
+            entry_key = (kind, key)
+            if entry_key in self.entries:
+                self.entries.move_to_end(entry_key)
+                self.hits += 1
+                return self.entries[entry_key]
+
+            self.misses += 1
+            db = Session()
+            try:
+                value = query(db)
+            finally:
+                db.close()
+            self._put(entry_key, value)
+
+            return value
+
+    def _put(self, entry_key, value):
+        self.entries[entry_key] = value
+        self.entries.move_to_end(entry_key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def _load(self):
+        db = Session()
+        try:
+            facilities = db.query(Facility).order_by(Facility.id).all()
+            sources = db.query(InvoiceSource).order_by(InvoiceSource.id).all()
+            pharmacy_maps = db.query(FacilityPharmacyMap).options(
+                joinedload(FacilityPharmacyMap.pharmacy),
+                joinedload(FacilityPharmacyMap.facility)).order_by(FacilityPharmacyMap.id).all()
+            reader_settings = db.query(PharmacyInvoiceReaderSetting).options(
+                selectinload(PharmacyInvoiceReaderSetting.raw_invoice_fields)).order_by(PharmacyInvoiceReaderSetting.id).all()
+        finally:
+            db.close()
+
+        entries = {}
+        # first row wins, like .first() in the lookups below
+        for facility in facilities:
+            entries.setdefault(('facility', facility.facility_nm), facility)
+        for source in sources:
+            entries.setdefault(('source', source.source_nm), source)
+        for pharmacy_map in pharmacy_maps:
+            entries.setdefault(('pharmacy', pharmacy_map.facility_id), pharmacy_map)
+        for reader_setting in reader_settings:
+            entries.setdefault(('reader_setting', (reader_setting.pharmacy_id, reader_setting.invoice_source_id)), reader_setting)
+
+        self.entries.clear()
+        for entry_key, value in entries.items():
+            self._put(entry_key, value)
+        self.loaded_at = time.monotonic()
+
+
+reference_cache = ReferenceCache()
+
+
+def invalidate_reference_cache():
+    reference_cache.invalidate()
+
+
 def get_facility(file_name):
     facility_name = file_name.split('/')[2]
-    facility = session.query(Facility).filter(Facility.facility_nm==facility_name).first()
+    facility = reference_cache.get('facility', facility_name, lambda db: db.query(Facility).filter(
+        Facility.facility_nm==facility_name).first())
 
     return facility
 
 
 def get_source(file_name):
     source_name = file_name.split('/')[3]
-    source = session.query(InvoiceSource).filter(InvoiceSource.source_nm==source_name).first()
+    source = reference_cache.get('source', source_name, lambda db: db.query(InvoiceSource).filter(
+        InvoiceSource.source_nm==source_name).first())
 
     return source
 
 
 def get_pharmacy(facility):
-    pharmcy_map = session.query(FacilityPharmacyMap).filter(FacilityPharmacyMap.facility_id==facility.id).first()
+    pharmcy_map = reference_cache.get('pharmacy', facility.id, lambda db: db.query(FacilityPharmacyMap).options(
+        joinedload(FacilityPharmacyMap.pharmacy),
+        joinedload(FacilityPharmacyMap.facility)).filter(
+        FacilityPharmacyMap.facility_id==facility.id).order_by(FacilityPharmacyMap.id).first())
 
     return pharmcy_map
 
@@ -136,6 +365,50 @@ def get_payer_group(pharmacy_id, inv_grp, source):
     return payer_group.id if payer_group else None
 
 
+def _payer_group_key(name):
+    # the column collation is case-insensitive and ignores trailing spaces
+    return str(name).rstrip().lower() if name is not None else None
+
+
+class PayerGroupIndex:
+    """All payer group maps of a pharmacy, loaded once per invoice.
+
+    resolve() gives the same answer as get_payer_group: the first map, in
+    id order, whose source and name are either NULL or equal to the ones
+    asked for. Each distinct (invoice group, source) is resolved once.
+    """
+
+    def __init__(self, payer_groups):
+        # payer_groups: (id, source, name) rows in id order
+        self.maps = {}
+        self.resolved = {}
+        for id, source, name in payer_groups:
+            self.maps.setdefault((source, _payer_group_key(name)), id)
+
+    def resolve(self, inv_grp, source):
+        name = _payer_group_key(inv_grp)
+        key = (source, name)
+        if key not in self.resolved:
+            candidates = {(source, name), (source, None), (None, name), (None, None)}
+            ids = [self.maps[k] for k in candidates if k in self.maps]
+            self.resolved[key] = min(ids) if ids else None
+
+        return self.resolved[key]
+
+    def unresolved(self, inv_grps, source):
+        return sorted({str(inv_grp) for inv_grp in inv_grps if self.resolve(inv_grp, source) is None})
+
+
+def get_payer_group_index(pharmacy_id):
+    payer_groups = session.query(
+        PayerGroupPharmacyMap.id,
+        PayerGroupPharmacyMap.source,
+        PayerGroupPharmacyMap.name).filter(
+        PayerGroupPharmacyMap.pharmacy_id==pharmacy_id).order_by(PayerGroupPharmacyMap.id)
+
+    return PayerGroupIndex(payer_groups)
+
+
 def get_reader_settings(pharmacy):
     reader_settings = session.query(PharmacyInvoiceReaderSetting).filter(
         PharmacyInvoiceReaderSetting.pharmacy_id==pharmacy.id)
@@ -145,136 +418,438 @@ def get_reader_settings(pharmacy):
 
 def get_reader_setting(pharmacy, source):
     source_id = source.id if source else 0
-    reader_settings = session.query(PharmacyInvoiceReaderSetting).filter(
+    reader_settings = reference_cache.get('reader_setting', (pharmacy.id, source_id), lambda db: db.query(PharmacyInvoiceReaderSetting).options(
+        selectinload(PharmacyInvoiceReaderSetting.raw_invoice_fields)).filter(
         PharmacyInvoiceReaderSetting.pharmacy_id==pharmacy.id,
-        PharmacyInvoiceReaderSetting.invoice_source_id==source_id).first()
+        PharmacyInvoiceReaderSetting.invoice_source_id==source_id).order_by(PharmacyInvoiceReaderSetting.id).first())
 
     return reader_settings
 
 
-def validate_field(field, val):
-    # val is not empty
-    is_valid = True
-    msg = ''
-    _val = None
+SSN_PATTERN = re.compile(r"^\d{9}|\d{3}-\d{2}-\d{4}$|^$")
+BLANK_SSN_PATTERN = re.compile(r"^___-__-____$|^$")
+VALIDATION_PLAN_CACHE_SIZE = int(os.getenv('VALIDATION_PLAN_CACHE_SIZE', 64))
+DATE_SAMPLE_SIZE = int(os.getenv('DATE_SAMPLE_SIZE', 20))
+# example rows logged for each (column, message) of the validation errors
+VALIDATION_ERROR_EXAMPLES = int(os.getenv('VALIDATION_ERROR_EXAMPLES', 10))
+# distinct values of a column whose validation results are kept; 0 turns the memo off
+VALIDATION_MEMO_SIZE = int(os.getenv('VALIDATION_MEMO_SIZE', 10000))
+# unambiguous four digit year layouts only; anything else goes to dateparser
+DATE_FORMATS = (
+    '%m/%d/%Y',
+    '%Y-%m-%d %H:%M:%S',
+    '%Y-%m-%d',
+    '%m-%d-%Y',
+    '%Y/%m/%d',
+    '%m/%d/%Y %H:%M:%S',
+    '%m/%d/%Y %H:%M',
+    '%m/%d/%Y %I:%M:%S %p',
+    '%d-%b-%Y',
+    '%b %d, %Y',
+    '%B %d, %Y',
+)
+
+
+def _convert_int(val):
+    try:
+        return True, '', int(val)
+    except Exception as e:
+        return False, "Invalid number", None
 
-    if field.field_type in ['int', 'long']:
-        try:
-            _val = int(val)
-        except Exception as e:
-            msg = "Invalid number"
-            is_valid = False
-    elif field.field_type == 'char':
-        is_valid = len(val) == 1
-        if not is_valid:
-            msg = 'Invalid char'
-    elif field.field_type == 'decimal':
-        try:
-            _val = float(val.replace("$", "").replace("(", "").replace(")", ""))
-        except Exception as e:
-            is_valid = False
-            msg = "Invalid decimal"
-    elif field.field_type == 'date':
+
+def _convert_char(val):
+    if len(val) == 1:
+        return True, '', None
+    return False, 'Invalid char', None
+
+
+def _convert_decimal(val):
+    try:
+        return True, '', float(val.replace("$", "").replace("(", "").replace(")", ""))
+    except Exception as e:
+        return False, "Invalid decimal", None
+
+
+def _strptime(val, date_format):
+    try:
+        return datetime.datetime.strptime(val, date_format)
+    except ValueError:
+        pass
+
+
+class DateColumnParser:
+    """Parses one date column, learning its format from the first values.
+
+    The first `sample_size` non-empty values go through dateparser; every
+    format in DATE_FORMATS that reproduces all of those results survives.
+    Afterwards values are parsed with the first surviving format and only
+    the ones that don't match it fall back to dateparser.
+    """
+
+    def __init__(self, sample_size=DATE_SAMPLE_SIZE):
+        self.sample_size = sample_size
+        self.reset()
+
+    def reset(self):
+        self.date_format = None
+        self.candidates = list(DATE_FORMATS)
+        self.samples = 0
+        self.matched = 0
+        self.fast = 0
+        self.fallback = 0
+
+    def parse(self, val):
+        if self.date_format:
+            _val = _strptime(val, self.date_format)
+            if _val:
+                self.fast += 1
+                return _val
+
+        self.fallback += 1
         _val = dateparser.parse(val)
+        if self.samples < self.sample_size:
+            self._learn(val, _val)
+
+        return _val
+
+    def _learn(self, val, parsed):
+        self.samples += 1
+        if parsed:
+            self.matched += 1
+            self.candidates = [f for f in self.candidates if _strptime(val, f) == parsed]
+
+        if self.samples == self.sample_size and self.matched and self.candidates:
+            self.date_format = self.candidates[0]
+
+
+def _date_converter(date_parser):
+    def convert(val):
+        _val = date_parser.parse(val)
         if not _val:
-            is_valid = False
-            msg = "Invalid date"
-
-    if field.field_validations:
-        for rule in field.field_validations.split(','):
-            _msg = ''
-
-            if rule == 'Ssn':
-                pat1 = re.compile("^\d{9}|\d{3}-\d{2}-\d{4}$|^$")
-                pat2 = re.compile("^___-__-____$|^$")
-                is_valid = pat1.match(val) or pat2.match(val)
-                if not is_valid:
-                    _msg = "Invalid SSN"
-            elif rule == 'MorF':
-                is_valid = val.upper() in ['M', 'F']
-                if not is_valid:
-                    _msg = "Should be M or F"
-            elif rule == 'BorG':
-                is_valid = val.upper() in ['B', 'G']
-                if not is_valid:
-                    _msg = "Should be B or G"
-            elif rule == 'MaxLength50':
-                is_valid = len(val) < 50
-                if not is_valid:
-                    _msg = "Length should be less than 50"
-            elif rule == 'MaxLength150':
-                is_valid = len(val) < 150
-                if not is_valid:
-                    _msg = "Length should be less than 150"
-            elif rule == 'MaxLength500':
-                is_valid = len(val) < 500
-                if not is_valid:
-                    _msg = "Length should be less than 500"
-            elif rule == 'MaxLength1000':
-                is_valid = len(val) < 1000
-                if not is_valid:
-                    _msg = "Length should be less than 1000"
-            elif rule == 'Name':
-                try:
-                    first_name, last_name = val.split(',')
-                    is_valid = len(first_name) < 25 and len(last_name) < 25
-                except Exception as e:
-                    is_valid = False
-                    _msg = "Invalid name"
+            return False, "Invalid date", None
+        return True, '', _val
+    return convert
+
+
+def _check_ssn(val):
+    is_valid = SSN_PATTERN.match(val) or BLANK_SSN_PATTERN.match(val)
+    return is_valid, '' if is_valid else "Invalid SSN"
+
 
+def _check_name(val):
+    try:
+        first_name, last_name = val.split(',')
+        return len(first_name) < 25 and len(last_name) < 25, ''
+    except Exception as e:
+        return False, "Invalid name"
+
+
+def _one_of(choices, msg):
+    def check(val):
+        is_valid = val.upper() in choices
+        return is_valid, '' if is_valid else msg
+    return check
+
+
+def _max_length(length):
+    msg = f"Length should be less than {length}"
+
+    def check(val):
+        is_valid = len(val) < length
+        return is_valid, '' if is_valid else msg
+    return check
+
+
+FIELD_CONVERTERS = {
+    'int': _convert_int,
+    'long': _convert_int,
+    'char': _convert_char,
+    'decimal': _convert_decimal,
+}
+
+FIELD_RULES = {
+    'Ssn': _check_ssn,
+    'MorF': _one_of(('M', 'F'), "Should be M or F"),
+    'BorG': _one_of(('B', 'G'), "Should be B or G"),
+    'MaxLength50': _max_length(50),
+    'MaxLength150': _max_length(150),
+    'MaxLength500': _max_length(500),
+    'MaxLength1000': _max_length(1000),
+    'Name': _check_name,
+}
+
+
+def compile_field(field, date_parser=None):
+    # resolve the field type and the comma separated rules once per field
+    if field.field_type == 'date':
+        convert = _date_converter(date_parser or DateColumnParser())
+    else:
+        convert = FIELD_CONVERTERS.get(field.field_type)
+    rules = [FIELD_RULES[rule] for rule in (field.field_validations or '').split(',') if rule in FIELD_RULES]
+
+    def validate(val):
+        # val is not empty
+        if convert:
+            is_valid, msg, _val = convert(val)
+        else:
+            is_valid, msg, _val = True, '', None
+
+        for rule in rules:
+            is_valid, _msg = rule(val)
             if _msg:
                 msg = msg + ', ' + _msg if msg else _msg
 
-    return is_valid, msg, _val or val
+        return is_valid, msg, _val or val
+
+    return validate
+
+
+def validate_field(field, val):
+    return compile_field(field)(val)
+
+
+class FieldMemo:
+    """validate() of one column, memoized by raw value, least recently used out.
+
+    A date column's values only go through the memo once its format is
+    learned; a hit adds to the date parser's counters what the parse did.
+    """
+
+    def __init__(self, validate, date_parser=None, size=VALIDATION_MEMO_SIZE):
+        self.validate = validate
+        self.date_parser = date_parser
+        self.size = size
+        self.results = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def reset(self):
+        # date results depend on the format learned for the invoice
+        if self.date_parser:
+            self.results.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def __call__(self, val):
+        date_parser = self.date_parser
+        if date_parser and date_parser.samples < date_parser.sample_size:
+            return self.validate(val)
+
+        cached = self.results.get(val)
+        if cached:
+            self.results.move_to_end(val)
+            self.hits += 1
+            result, fast, fallback = cached
+            if date_parser:
+                date_parser.fast += fast
+                date_parser.fallback += fallback
+            return result
+
+        self.misses += 1
+        if date_parser:
+            fast, fallback = date_parser.fast, date_parser.fallback
+        result = self.validate(val)
+        self.results[val] = (result, date_parser.fast - fast, date_parser.fallback - fallback) if date_parser else (result, 0, 0)
+        if len(self.results) > self.size:
+            self.results.popitem(last=False)
+        return result
+
+
+def memoize_field(validate, date_parser=None):
+    return FieldMemo(validate, date_parser) if VALIDATION_MEMO_SIZE else validate
+
+
+def compile_validation_plan(invoice_fields, header):
+    # one (field name, column, column index, validator, required, date parser, field) entry per field
+    plan = []
+    for field in invoice_fields:
+        idx = header.index(field.sheet_column_name) if field.sheet_column_name in header else None
+        required = bool(not field.is_optional and field.field_validations and 'IsNotEmpty' in field.field_validations)
+        date_parser = DateColumnParser() if field.field_type == 'date' else None
+        validate = memoize_field(compile_field(field, date_parser), date_parser)
+        plan.append((field.field_name, field.sheet_column_name, idx, validate, required, date_parser, field))
+
+    return plan
+
 
+_validation_plans = {}
+
+
+def get_validation_plan(invoice_reader_settings, header):
+    invoice_fields = invoice_reader_settings.raw_invoice_fields
+    # the field definitions are part of the key so config fixes are picked up
+    key = (
+        invoice_reader_settings.id,
+        tuple(header),
+        tuple((f.field_name, f.sheet_column_name, f.field_type, f.field_validations, f.is_optional) for f in invoice_fields)
+    )
+    plan = _validation_plans.get(key)
+    if plan is None:
+        if len(_validation_plans) >= VALIDATION_PLAN_CACHE_SIZE:
+            _validation_plans.clear()
+        plan = _validation_plans[key] = compile_validation_plan(invoice_fields, header)
 
-def validate_row(invoice_fields, header, row, row_idx, log_file):
-    # type list -> dict
+    return plan
+
+
+def reset_validation_plan(plan):
+    # formats are inferred again for every invoice; memo hits are counted per invoice
+    for entry in plan:
+        if entry[5]:
+            entry[5].reset()
+        if isinstance(entry[3], FieldMemo):
+            entry[3].reset()
+
+
+def get_memo_stats(plan):
+    memos = [entry[3] for entry in plan if isinstance(entry[3], FieldMemo)]
+    return sum(memo.hits for memo in memos), sum(memo.misses for memo in memos)
+
+
+def log_date_parsers(plan, log_file):
+    for field_name, column_name, idx, validate, required, date_parser, field in plan:
+        if date_parser and (date_parser.fast or date_parser.fallback):
+            print(f"Dates ({column_name}): format {date_parser.date_format or 'not inferred'},",
+                  f"fast path {date_parser.fast}, dateparser {date_parser.fallback}", file=log_file)
+
+
+def validate_row(plan, row, row_idx, errors):
+    # type list -> dict; errors is an ErrorCollector
     _row = {}
     is_valid = True
-    for field in invoice_fields:
-        val = None
-        if field.sheet_column_name in header:
-            idx = header.index(field.sheet_column_name)
-            val = clean_text(row[idx].value)
+    for field_name, column_name, idx, validate, required, date_parser, field in plan:
+        val = clean_text(row[idx]) if idx is not None and idx < len(row) else None
 
-        if field.sheet_column_name not in header or not val:
-            if not field.is_optional and field.field_validations and 'IsNotEmpty' in field.field_validations:
+        if not val:
+            if required:
                 is_valid = False
-                msg = "Should not be empty"
-                print("Row:", row_idx, "," , "Column:", field.sheet_column_name, ",", "Msg:", msg, file=log_file)
+                errors.add(row_idx, column_name, "Should not be empty")
             else:
                 # add column as long as it is not invalid
-                _row[field.field_name] = val                
+                _row[field_name] = val
         else:
-            _is_valid, msg, val = validate_field(field, val)
+            _is_valid, msg, val = validate(val)
 
             if _is_valid:
-                _row[field.field_name] = val
+                _row[field_name] = val
             else:
                 is_valid = False
-                print("Row:", row_idx, "," , "Column:", field.sheet_column_name, ",", "Msg:", msg, file=log_file)
+                errors.add(row_idx, column_name, msg)
 
     return is_valid, _row
 
 
-def start_batch_logging(facility_pharmacy_map, invoice_dt, source_id):
+class ErrorCollector:
+    """Validation errors of one invoice, counted by (column, message).
+
+    Only the first `examples` row numbers of each are kept, so a column
+    that is wrong on every row logs one line, not one per row.
+    """
+
+    def __init__(self, examples=VALIDATION_ERROR_EXAMPLES):
+        self.examples = examples
+        self.counts = collections.Counter()
+        self.rows = collections.defaultdict(list)
+
+    def add(self, row_idx, column_name, msg):
+        key = (column_name, msg)
+        self.counts[key] += 1
+        if len(self.rows[key]) < self.examples:
+            self.rows[key].append(row_idx)
+
+    def update(self, other):
+        # other's errors come after this collector's
+        for key, count in other.counts.items():
+            self.counts[key] += count
+            self.rows[key].extend(other.rows[key][:self.examples - len(self.rows[key])])
+
+    def log(self, log_file):
+        if not self.counts:
+            return
+        print(f"Validation errors: {sum(self.counts.values())}", file=log_file)
+        for (column_name, msg), count in self.counts.most_common():
+            rows = ', '.join(str(row_idx) for row_idx in self.rows[(column_name, msg)])
+            more = ", ..." if count > len(self.rows[(column_name, msg)]) else ""
+            print(f"Column: {column_name} , Msg: {msg} , {count} rows: {rows}{more}", file=log_file)
+        print(file=log_file)
+
+
+class Stage:
+    def __init__(self, name):
+        self.name = name
+        self.seconds = 0.0
+        self.rows = None
+        # memo hits and misses, where a stage has a memo
+        self.hits = None
+        self.misses = None
+
+
+class StageTimer:
+    """Wall time (and rows, where it applies) of each stage of one invoice.
+
+    `started_at` is when the job started; stages are logged in the order
+    they ran. A stage that runs more than once adds up.
+    """
+
+    def __init__(self):
+        self.started_at = datetime.datetime.now()
+        self.stages = {}
+        self.logged = 0
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        if name not in self.stages:
+            self.stages[name] = Stage(name)
+        stage = self.stages[name]
+        started = time.perf_counter()
+        try:
+            yield stage
+        finally:
+            stage.seconds += time.perf_counter() - started
+
+    def log(self, log_file):
+        # the stages that ran since the last call
+        stages = list(self.stages.values())[self.logged:]
+        self.logged += len(stages)
+        for stage in stages:
+            rows = f", {stage.rows} rows" if stage.rows is not None else ""
+            if stage.hits or stage.misses:
+                rows += f", memo {stage.hits} hits / {stage.misses} misses ({stage.hits / (stage.hits + stage.misses):.0%})"
+            print(f"Stage {stage.name}: {stage.seconds:.3f}s{rows}", file=log_file)
+
+
+def start_batch_logging(facility_pharmacy_map, invoice_dt, source_id, import_start_tm=None):
     log = InvoiceBatchLog(facility_pharmacy_map_id=facility_pharmacy_map.id,
                           invoice_dt=invoice_dt,
+                          import_start_tm=import_start_tm or datetime.datetime.now().time(),
                           status_cd=0,
-                          source=source_id)
+                          source=source_id,
+                          raw_invoice_table_nm=facility_pharmacy_map.pharmacy.raw_invoice_table_nm)
     session.add(log)
     session.commit()
 
     return log.id
 
 
-def stop_batch_logging(invoice_batch_log_id):
+def stop_batch_logging(invoice_batch_log_id, file_fingerprint=None):
+    # the fingerprint is only recorded for successful loads
     log = session.query(InvoiceBatchLog).get(invoice_batch_log_id)
     log.status_cd = 1
+    log.import_end_tm = datetime.datetime.now().time()
+    log.file_fingerprint = file_fingerprint
     session.commit()
 
 
+def get_last_file_fingerprint(facility_pharmacy_map, invoice_dt):
+    # fingerprint of the file the month was last loaded from successfully
+    log = session.query(InvoiceBatchLog.file_fingerprint).filter(
+        InvoiceBatchLog.facility_pharmacy_map_id==facility_pharmacy_map.id,
+        InvoiceBatchLog.invoice_dt==invoice_dt,
+        InvoiceBatchLog.file_fingerprint!=None).order_by(InvoiceBatchLog.id.desc()).first()
+
+    return log.file_fingerprint if log else None
+
+
 def get_first_name(name):
     first_name = name.split(',')[0].strip()
     return first_name